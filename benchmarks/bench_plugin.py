@@ -0,0 +1,230 @@
+"""Measure overhead of pytest-hoverfly: starting Hoverfly, loading simulations,
+saving recordings and the cost the plugin adds to every test.
+
+Runs against Hoverfly from ${HOVERFLY_HOST}, ${HOVERFLY_PROXY_PORT} and ${HOVERFLY_ADMIN_PORT}
+(or ${HOVERFLY_INSTANCES}) if set, otherwise against the in-process python backend.
+
+    python benchmarks/bench_plugin.py --output before.json
+    python benchmarks/bench_plugin.py --compare before.json
+"""
+from __future__ import annotations
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import typing as t
+from pathlib import Path
+
+from pytest_hoverfly.base import Hoverfly, get_container
+from pytest_hoverfly.blobs import BodyStore
+from pytest_hoverfly.client import HoverflyClient
+from pytest_hoverfly.engine import ReplayEngine
+from pytest_hoverfly.steps import (
+    load_simulation,
+    run,
+    save_recording,
+)
+from pytest_hoverfly.storage import write_simulation
+
+
+Results = t.Dict[str, t.Dict[str, float]]
+
+TEST_FILE = """
+import pytest
+from pytest_hoverfly import hoverfly
+
+{marker}
+@pytest.mark.parametrize("n", range({tests}))
+def test_overhead(n):
+    pass
+"""
+
+
+def synthetic_simulation(pairs: int, body_size: int = 256) -> t.Dict[str, t.Any]:
+    return {
+        "data": {
+            "pairs": [
+                {
+                    "request": {
+                        "method": [{"matcher": "exact", "value": "GET"}],
+                        "scheme": [{"matcher": "exact", "value": "https"}],
+                        "destination": [{"matcher": "exact", "value": "example.com"}],
+                        "path": [{"matcher": "exact", "value": f"/items/{i}"}],
+                        "headers": {"Accept": [{"matcher": "exact", "value": "application/json"}]},
+                    },
+                    "response": {
+                        "status": 200,
+                        "body": json.dumps({"id": i, "payload": "x" * body_size}),
+                        "encodedBody": False,
+                        "headers": {"Content-Type": ["application/json"], "Authorization": ["secret"]},
+                    },
+                }
+                for i in range(pairs)
+            ]
+        },
+        "meta": {"schemaVersion": "v5"},
+    }
+
+
+def measure(
+    func: t.Callable[[], t.Any], rounds: int, setup: t.Callable[[], t.Any] = lambda: None
+) -> t.Dict[str, float]:
+    timings = []
+    for _ in range(rounds):
+        setup()
+        started = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - started)
+
+    return {"median": statistics.median(timings), "min": min(timings), "rounds": rounds}
+
+
+@contextlib.contextmanager
+def hoverfly_instance() -> t.Iterator[Hoverfly]:
+    instance = Hoverfly.try_from_env(os.environ)
+    if instance:
+        yield instance
+        return
+
+    engine = ReplayEngine()
+    try:
+        yield engine.start()
+    finally:
+        engine.stop()
+
+
+def bench_startup(results: Results, rounds: int, docker: bool) -> None:
+    def start_engine():
+        engine = ReplayEngine()
+        engine.start()
+        engine.stop()
+
+    results["startup[python]"] = measure(start_engine, rounds)
+
+    if docker:
+
+        def start_container():
+            gen = get_container()
+            next(gen)
+            gen.close()
+
+        results["startup[docker]"] = measure(start_container, rounds)
+
+
+def bench_simulations(results: Results, client: HoverflyClient, sizes: t.List[int], rounds: int, tmp: Path) -> None:
+    body_store = BodyStore(tmp / "_bodies")
+
+    for size in sizes:
+        data = synthetic_simulation(size)
+        path = tmp / f"simulation_{size}.json"
+        write_simulation(path, data)
+
+        def forget():
+            client.loaded_simulation = None
+
+        results[f"load[{size} pairs]"] = measure(
+            lambda: run(client, load_simulation(client, path, body_store)), rounds, forget
+        )
+        # the previous round left the simulation loaded, so only state is restored
+        results[f"reload[{size} pairs]"] = measure(
+            lambda: run(client, load_simulation(client, path, body_store)), rounds
+        )
+        results[f"save_recording[{size} pairs]"] = measure(
+            lambda: save_recording(synthetic_simulation(size), tmp / "recording.json", body_store, None), rounds
+        )
+
+    client.delete_simulation()
+
+
+def bench_suite(results: Results, test_counts: t.List[int], rounds: int, tmp: Path) -> None:
+    """Per-test overhead of the plugin: run the same empty tests with and without @hoverfly."""
+    simulations = tmp / "suite_simulations"
+    simulations.mkdir()
+    write_simulation(simulations / "simulation.json", synthetic_simulation(10))
+    (tmp / "pytest.ini").write_text("[pytest]\n")
+
+    args = [
+        sys.executable,
+        "-m",
+        "pytest",
+        "-q",
+        "-p",
+        "no:cacheprovider",
+        "--hoverfly-simulation-path",
+        str(simulations),
+    ]
+    if not Hoverfly.try_from_env(os.environ):
+        args += ["--hoverfly-backend", "python"]
+
+    for tests in test_counts:
+        durations = {}
+        for marker in ("", "@hoverfly('simulation')"):
+            (tmp / "test_overhead.py").write_text(TEST_FILE.format(marker=marker, tests=tests))
+            durations[marker] = measure(lambda: subprocess.run(args, cwd=tmp, check=True, capture_output=True), rounds)
+
+        plain, marked = durations[""], durations["@hoverfly('simulation')"]
+        results[f"suite[{tests} tests]"] = marked
+        results[f"per_test_overhead[{tests} tests]"] = {
+            "median": (marked["median"] - plain["median"]) / tests,
+            "min": (marked["min"] - plain["min"]) / tests,
+            "rounds": rounds,
+        }
+
+
+def compare(results: Results, previous: Results) -> None:
+    print(f"{'benchmark':40s} {'before':>10s} {'after':>10s} {'ratio':>7s}")
+    for name, result in results.items():
+        before = previous.get(name, {}).get("median")
+        after = result["median"]
+        if before:
+            print(f"{name:40s} {before * 1000:8.2f}ms {after * 1000:8.2f}ms {after / before:6.2f}x")
+        else:
+            print(f"{name:40s} {'-':>10s} {after * 1000:8.2f}ms")
+
+
+def main(argv: t.Optional[t.List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="10,1000,10000", help="Comma-separated numbers of pairs in simulations.")
+    parser.add_argument("--tests", default="100,1000", help="Comma-separated numbers of tests in a suite.")
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--docker", action="store_true", help="Also measure startup of a Hoverfly container.")
+    parser.add_argument("--output", type=Path, help="Save results to this JSON file.")
+    parser.add_argument("--compare", type=Path, help="Compare with results saved by a previous run.")
+    args = parser.parse_args(argv)
+
+    sizes = [int(s) for s in args.sizes.split(",")]
+    test_counts = [int(s) for s in args.tests.split(",")]
+    results: Results = {}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        bench_startup(results, args.rounds, args.docker)
+        with hoverfly_instance() as instance:
+            client = HoverflyClient(instance)
+            try:
+                bench_simulations(results, client, sizes, args.rounds, Path(tmp))
+            finally:
+                client.close()
+        bench_suite(results, test_counts, args.rounds, Path(tmp))
+
+    if args.compare:
+        compare(results, json.loads(args.compare.read_text())["results"])
+    else:
+        for name, result in results.items():
+            print(f"{name:40s} {result['median'] * 1000:8.2f}ms (min {result['min'] * 1000:.2f}ms)")
+
+    if args.output:
+        data = {"python": platform.python_version(), "platform": platform.platform(), "results": results}
+        args.output.write_text(json.dumps(data, indent=2))
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,125 @@
+from __future__ import annotations
+
+import asyncio
+import ssl
+import typing as t
+from pathlib import Path
+
+import aiohttp
+
+from .base import Hoverfly, backoff
+from .client import JOURNAL_TIME_SCALE, query_params
+
+
+class AsyncHoverflyClient:
+    """Asyncio counterpart of `HoverflyClient`, for tests that run in an event loop.
+
+    Like `HoverflyClient`, it retries only connection errors: a request that reached
+    Hoverfly is never sent twice. The session is bound to the event loop it was created in.
+
+    aiohttp reads SSL_CERT_FILE once, when it's imported, so it doesn't trust Hoverfly's
+    certificate `cert` even in a patched environment. Pass `ssl_context` to sessions of tests.
+    """
+
+    def __init__(
+        self,
+        hoverfly: Hoverfly,
+        timeout: float = 30.0,
+        retries: int = 3,
+        cert: t.Optional[Path] = None,
+    ):
+        self.hoverfly = hoverfly
+        self.timeout = timeout
+        self.retries = retries
+        # Trusts only Hoverfly, which signs certificates of all hosts it proxies
+        self.ssl_context: t.Optional[ssl.SSLContext] = ssl.create_default_context(cafile=str(cert)) if cert else None
+        # Content hash of the simulation currently loaded in simulate mode, if any
+        self.loaded_simulation: t.Optional[str] = None
+        # Hoverfly state right after the simulation was loaded, e.g. starting steps of sequences
+        self.initial_state: t.Dict[str, str] = {}
+
+        # so that requests to hoverfly admin endpoint are not proxied :)
+        self.session = aiohttp.ClientSession(trust_env=False, timeout=aiohttp.ClientTimeout(total=timeout))
+
+    async def close(self) -> None:
+        await self.session.close()
+
+    async def __aenter__(self) -> AsyncHoverflyClient:
+        return self
+
+    async def __aexit__(self, *exc_info: t.Any) -> None:
+        await self.close()
+
+    async def request(self, method: str, path: str, **kwargs: t.Any) -> t.Any:
+        """Send a request and return its decoded JSON body."""
+        if "params" in kwargs:
+            kwargs["params"] = {k: str(v) for k, v in kwargs["params"].items()}
+
+        delays = backoff(initial=0.05, cap=1.0)
+        for attempt in range(self.retries + 1):
+            try:
+                async with self.session.request(method, f"{self.hoverfly.admin_endpoint}{path}", **kwargs) as resp:
+                    resp.raise_for_status()
+                    return await resp.json(content_type=None)
+            except aiohttp.ClientConnectorError:
+                # the request wasn't sent, so it's safe to try again
+                if attempt == self.retries:
+                    raise
+                await asyncio.sleep(next(delays))
+
+    async def get_simulation(self) -> t.Dict[str, t.Any]:
+        return await self.request("GET", "/simulation")
+
+    async def put_simulation(self, data: t.Union[bytes, str, t.Iterable[bytes], t.AsyncIterable[bytes]]) -> None:
+        if not isinstance(data, (bytes, str)) and not hasattr(data, "__aiter__"):
+            # e.g. chunks of a file, don't block the event loop reading them
+            data = _in_thread(iter(data))
+        await self.request("PUT", "/simulation", data=data)
+
+    async def delete_simulation(self) -> None:
+        self.loaded_simulation = None
+        await self.request("DELETE", "/simulation")
+
+    async def set_mode(self, mode: str, arguments: t.Optional[t.Mapping[str, t.Any]] = None) -> None:
+        payload: t.Dict[str, t.Any] = {"mode": mode}
+        if arguments is not None:
+            payload["arguments"] = arguments
+
+        await self.request("PUT", "/hoverfly/mode", json=payload)
+
+    async def get_logs(
+        self,
+        limit: t.Optional[int] = None,
+        since: t.Optional[float] = None,
+    ) -> t.List[t.Dict[str, t.Any]]:
+        return (await self.request("GET", "/logs", params=query_params(limit=limit, since=since)))["logs"]
+
+    async def get_journal(
+        self,
+        offset: int = 0,
+        limit: t.Optional[int] = None,
+        since: t.Optional[float] = None,
+    ) -> t.Dict[str, t.Any]:
+        params = query_params(offset=offset, limit=limit, since=since, since_scale=JOURNAL_TIME_SCALE)
+        return await self.request("GET", "/journal", params=params)
+
+    async def delete_journal(self) -> None:
+        await self.request("DELETE", "/journal")
+
+    async def get_state(self) -> t.Dict[str, str]:
+        return (await self.request("GET", "/state")).get("state") or {}
+
+    async def put_state(self, state: t.Mapping[str, str]) -> None:
+        await self.request("PUT", "/state", json={"state": state})
+
+    async def delete_state(self) -> None:
+        await self.request("DELETE", "/state")
+
+
+async def _in_thread(chunks: t.Iterator[bytes]) -> t.AsyncIterator[bytes]:
+    loop = asyncio.get_running_loop()
+    while True:
+        chunk = await loop.run_in_executor(None, next, chunks, None)
+        if chunk is None:
+            return
+        yield chunk
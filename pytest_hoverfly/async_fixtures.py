@@ -0,0 +1,99 @@
+"""Fixtures for tests running in an event loop, used with `@hoverfly(..., asynchronous=True)`.
+Registered as a plugin when pytest-asyncio and aiohttp are installed.
+"""
+from __future__ import annotations
+
+import typing as t
+
+import pytest_asyncio
+
+from .async_client import AsyncHoverflyClient
+from .blobs import BodyStore
+from .client import HoverflyClient
+from .helpers import get_scoped_fixture
+from .steps import (
+    record_missing,
+    record_simulation,
+    replay_simulation,
+    run_async,
+)
+
+
+@pytest_asyncio.fixture
+async def async_hoverfly_client(hoverfly_client: HoverflyClient, request) -> AsyncHoverflyClient:
+    """Async client for the admin API of `hoverfly_instance`, bound to the test's event loop.
+    It knows which simulation `hoverfly_client` has loaded and tells it back, so that
+    sync and async tests may share it. Its `ssl_context` makes aiohttp trust Hoverfly.
+    """
+    hoverfly = hoverfly_client.hoverfly
+    cert = hoverfly.cert or request.config.option.hoverfly_cert
+    client = AsyncHoverflyClient(hoverfly, timeout=hoverfly_client.timeout, cert=cert)
+    client.loaded_simulation = hoverfly_client.loaded_simulation
+    client.initial_state = hoverfly_client.initial_state
+
+    yield client
+
+    hoverfly_client.loaded_simulation = client.loaded_simulation
+    hoverfly_client.initial_state = client.initial_state
+    await client.close()
+
+
+@pytest_asyncio.fixture
+async def _async_simulation_replayer(
+    async_hoverfly_client: AsyncHoverflyClient,
+    request,
+    _body_store: BodyStore,
+    _phase_timings: t.Dict[str, float],
+):
+    """Same as `_simulation_replayer`, but doesn't block the event loop."""
+    get_scoped_fixture(request, "_patch_env")
+    loaded = get_scoped_fixture(request, "_loaded_simulations")
+    steps = replay_simulation(async_hoverfly_client, request, _body_store, _phase_timings, loaded)
+    await run_async(async_hoverfly_client, steps)
+    yield
+    await run_async(async_hoverfly_client, steps)
+
+
+@pytest_asyncio.fixture
+async def _async_simulation_recorder(
+    async_hoverfly_client: AsyncHoverflyClient,
+    request,
+    _patch_env,
+    _body_store: BodyStore,
+    _phase_timings: t.Dict[str, float],
+):
+    """Same as `_simulation_recorder`, but doesn't block the event loop."""
+    steps = record_simulation(async_hoverfly_client, request, _body_store, _phase_timings, stateful=False)
+    await run_async(async_hoverfly_client, steps)
+    yield
+    await run_async(async_hoverfly_client, steps)
+
+
+@pytest_asyncio.fixture
+async def _async_stateful_simulation_recorder(
+    async_hoverfly_client: AsyncHoverflyClient,
+    request,
+    _patch_env,
+    _body_store: BodyStore,
+    _phase_timings: t.Dict[str, float],
+):
+    """Same as `_stateful_simulation_recorder`, but doesn't block the event loop."""
+    steps = record_simulation(async_hoverfly_client, request, _body_store, _phase_timings, stateful=True)
+    await run_async(async_hoverfly_client, steps)
+    yield
+    await run_async(async_hoverfly_client, steps)
+
+
+@pytest_asyncio.fixture
+async def _async_missing_simulation_recorder(
+    async_hoverfly_client: AsyncHoverflyClient,
+    request,
+    _patch_env,
+    _body_store: BodyStore,
+    _phase_timings: t.Dict[str, float],
+):
+    """Same as `_missing_simulation_recorder`, but doesn't block the event loop."""
+    steps = record_missing(async_hoverfly_client, request, _body_store, _phase_timings)
+    await run_async(async_hoverfly_client, steps)
+    yield
+    await run_async(async_hoverfly_client, steps)
@@ -0,0 +1,65 @@
+from __future__ import annotations
+
+import concurrent.futures
+import traceback
+import typing as t
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+
+import pytest
+
+
+class BackgroundWriter:
+    """Saves recordings in a background thread, so that the next test starts meanwhile,
+    see --hoverfly-background-teardown.
+
+    Recordings are written one at a time, in order, so the last recording of a file wins.
+    A test that reads a simulation waits until it's written. A failed write is reported
+    as an error in teardown of the test that recorded it.
+    """
+
+    def __init__(self):
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="hoverfly-write")
+        self._pending: t.Dict[Path, Future] = {}
+        self._jobs: t.List[t.Tuple[pytest.Item, Future]] = []
+
+    def submit(self, item: pytest.Item, path: Path, func: t.Callable[..., t.Any], *args: t.Any) -> None:
+        """Run `func(*args)` that writes `path` on behalf of `item`."""
+        future = self._executor.submit(func, *args)
+        self._pending[path] = future
+        self._jobs.append((item, future))
+
+    def wait_for(self, path: Path) -> None:
+        """Wait until pending writes of `path` are done. Their errors are reported elsewhere."""
+        future = self._pending.pop(path, None)
+        if future is not None:
+            concurrent.futures.wait([future])
+
+    @pytest.hookimpl(hookwrapper=True)
+    def pytest_runtest_protocol(self, item, nextitem):
+        yield
+        self._report_failures()
+
+    def pytest_sessionfinish(self, session) -> None:
+        self._executor.shutdown(wait=True)
+        self._report_failures()
+
+    def _report_failures(self) -> None:
+        for item, future in [job for job in self._jobs if job[1].done()]:
+            self._jobs.remove((item, future))
+            error = future.exception()
+            if error is None:
+                continue
+
+            longrepr = "Saving the recording in background failed:\n" + "".join(
+                traceback.format_exception(type(error), error, error.__traceback__)
+            )
+            report = pytest.TestReport(
+                item.nodeid,
+                item.location,
+                {keyword: 1 for keyword in item.keywords},
+                "failed",
+                longrepr,
+                "teardown",
+            )
+            item.ihook.pytest_runtest_logreport(report=report)
@@ -1,22 +1,38 @@
 from __future__ import annotations
 
 import dataclasses as dc
+import hashlib
+import json
 import os
+import random
 import socket
+import threading
 import time
 import typing as t
 import urllib.error
 import urllib.request
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from http.client import RemoteDisconnected
+from pathlib import Path
 
 from docker import DockerClient
 from docker.errors import ImageNotFound
 from docker.models.containers import Container
 
+from .snapshot import SNAPSHOT_REPOSITORY, find_snapshot
+from .timing import timed
+
 
 IMAGE = "spectolabs/hoverfly:v1.3.7"
 CONTAINER_BASENAME = "test-hoverfly"
+XDIST_WORKER_ENV = "PYTEST_XDIST_WORKER"
+XDIST_WORKER_COUNT_ENV = "PYTEST_XDIST_WORKER_COUNT"
+REUSE_LABEL = "pytest-hoverfly.reuse-key"
+
+
+class HoverflyExited(RuntimeError):
+    pass
 
 
 @dc.dataclass(frozen=True)
@@ -24,6 +40,10 @@ class Hoverfly:
     host: str
     admin_port: int
     proxy_port: int
+    # CA certificate clients must trust, if it's not the default Hoverfly's one
+    cert: t.Optional[Path] = dc.field(default=None, compare=False)
+    # Hoverfly reads body files of simulations itself, from a snapshot image
+    body_files: bool = dc.field(default=False, compare=False)
 
     @property
     def admin_endpoint(self) -> str:
@@ -43,32 +63,90 @@ class Hoverfly:
 
     @classmethod
     def try_from_env(cls, env: t.Mapping[str, str]) -> t.Optional[Hoverfly]:
+        """Return an externally managed instance meant for this process, if any.
+        Under pytest-xdist each worker gets its own instance from ${HOVERFLY_INSTANCES}.
+        """
+        instances = cls.list_from_env(env)
+        if not instances:
+            return None
+
+        worker_count = env.get(XDIST_WORKER_COUNT_ENV)
+        return select_for_worker(instances, env.get(XDIST_WORKER_ENV), int(worker_count) if worker_count else None)
+
+    @classmethod
+    def list_from_env(cls, env: t.Mapping[str, str]) -> t.List[Hoverfly]:
+        """${HOVERFLY_INSTANCES} is a comma-separated list of `host:proxy_port:admin_port` triples.
+        It takes precedence over ${HOVERFLY_HOST}, ${HOVERFLY_PROXY_PORT} and ${HOVERFLY_ADMIN_PORT}.
+        """
+        raw_instances = env.get("HOVERFLY_INSTANCES")
+        if raw_instances:
+            return [cls.from_triple(triple) for triple in raw_instances.split(",") if triple.strip()]
+
         hoverfly_host = env.get("HOVERFLY_HOST")
         proxy_port = env.get("HOVERFLY_PROXY_PORT")
         admin_port = env.get("HOVERFLY_ADMIN_PORT")
 
         if hoverfly_host and proxy_port and admin_port:
-            return Hoverfly(hoverfly_host, int(admin_port), int(proxy_port))
+            return [Hoverfly(hoverfly_host, int(admin_port), int(proxy_port))]
+
+        return []
+
+    @classmethod
+    def from_triple(cls, triple: str) -> Hoverfly:
+        try:
+            host, proxy_port, admin_port = triple.strip().rsplit(":", 2)
+            return Hoverfly(host, int(admin_port), int(proxy_port))
+        except ValueError as e:
+            raise ValueError(f"Expected `host:proxy_port:admin_port`, got: {triple!r}") from e
 
     def is_ready(self) -> bool:
         return self.admin_endpoint_is_ready() and self.proxy_is_ready()
 
     def admin_endpoint_is_ready(self):
         try:
-            urllib.request.urlopen(f"{self.admin_endpoint}/state")
-            return True
-        except (urllib.error.URLError, RemoteDisconnected):
+            with urllib.request.urlopen(f"{self.admin_endpoint}/state"):
+                return True
+        except (urllib.error.URLError, RemoteDisconnected, ConnectionResetError):
             return False
 
     def proxy_is_ready(self):
         try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.connect((self.host, self.proxy_port))
-            return True
+            with socket.create_connection((self.host, self.proxy_port)):
+                return True
         except ConnectionRefusedError:
             return False
 
 
+def worker_index(worker_id: t.Optional[str]) -> int:
+    """pytest-xdist names workers gw0, gw1, ..."""
+    if not worker_id or not worker_id.startswith("gw"):
+        return 0
+
+    return int(worker_id[2:])
+
+
+def select_for_worker(
+    instances: t.Sequence[Hoverfly],
+    worker_id: t.Optional[str],
+    worker_count: t.Optional[int] = None,
+) -> Hoverfly:
+    """Each xdist worker gets a dedicated instance. Workers sharing one would overwrite each
+    other's simulations, and each of them would think its own simulation is still loaded.
+    """
+    if not worker_id:
+        return instances[0]
+
+    index = worker_index(worker_id)
+    workers = max(worker_count or 0, index + 1)
+    if workers > len(instances):
+        raise RuntimeError(
+            f"Not enough Hoverfly instances for {workers} xdist workers: {len(instances)} provided. "
+            "Workers can't share an instance, pass one per worker in HOVERFLY_INSTANCES."
+        )
+
+    return instances[index]
+
+
 def get_container(
     container_name: t.Optional[str] = None,
     ports: t.Optional[t.Dict[str, t.Optional[t.List[t.Dict[str, int]]]]] = None,
@@ -76,7 +154,19 @@ def get_container(
     timeout: float = 3.0,
     docker_factory: t.Callable[[], DockerClient] = DockerClient.from_env,
     create_container_kwargs: t.Optional[t.Mapping[str, t.Any]] = None,
+    reuse: bool = False,
+    timings: t.Optional[t.Dict[str, float]] = None,
+    snapshot_of: t.Optional[Path] = None,
+    snapshot_repository: str = SNAPSHOT_REPOSITORY,
+    pull_snapshot: bool = False,
 ):
+    """Yield a Hoverfly instance. With `reuse`, a running container started by a previous
+    session with the same image and arguments is reattached to, and the container is left
+    running at the end. If `timings` is given, it's filled with durations of startup phases.
+
+    If a snapshot image of simulations in `snapshot_of` directory is found, it's used instead
+    of `image`, see snapshot.find_snapshot.
+    """
     external_service = Hoverfly.try_from_env(os.environ)
     if external_service:
         yield external_service
@@ -85,70 +175,222 @@ def get_container(
     if not ports:
         ports = {"8500/tcp": None, "8888/tcp": None}
 
+    # containers of different xdist workers are started in parallel, one per worker
+    worker_id = os.environ.get(XDIST_WORKER_ENV)
+
     if not container_name:
-        container_name = f"{CONTAINER_BASENAME}-{uuid.uuid4().hex}"
+        prefix = f"{CONTAINER_BASENAME}-{worker_id}" if worker_id else CONTAINER_BASENAME
+        container_name = f"{prefix}-{uuid.uuid4().hex}"
+
+    service_host = os.environ.get("SERVICE_HOST", "localhost")
+    create_container_kwargs = dict(create_container_kwargs or {})
 
     # DockerClient goes to docker API to fetch version during initialization
     # we instantiate it only here to avoid network calls if we don't need the client
     docker = docker_factory()
 
+    body_files = False
+    if snapshot_of is not None:
+        with timed(timings, "image"):
+            snapshot = find_snapshot(docker, image, snapshot_of, snapshot_repository, pull=pull_snapshot)
+        if snapshot:
+            image, body_files = snapshot, True
+
+    if reuse:
+        key = reuse_key(image, ports, create_container_kwargs, worker_id)
+        reusable = _find_reusable_container(docker, key, service_host)
+        if reusable:
+            yield dc.replace(reusable, body_files=body_files)
+            return
+
+        create_container_kwargs["labels"] = {**create_container_kwargs.get("labels", {}), REUSE_LABEL: key}
+
+    with timed(timings, "image"):
+        try:
+            docker.images.get(image)
+        except ImageNotFound:
+            docker.images.pull(image)
+
+    with timed(timings, "create"):
+        raw_container = docker.containers.create(
+            image=image,
+            name=container_name,
+            detach=True,
+            ports=ports,
+            **create_container_kwargs,
+        )
+
     try:
-        docker.images.get(image)
-    except ImageNotFound:
-        docker.images.pull(image)
-
-    raw_container = docker.containers.create(
-        image=image,
-        name=container_name,
-        detach=True,
-        ports=ports,
-        **(create_container_kwargs or {}),
-    )
-
-    raw_container.start()
-    _wait_until_ports_are_ready(raw_container, ports, timeout)
-
-    container = Hoverfly.from_container(
-        os.environ.get("SERVICE_HOST", "localhost"),
-        raw_container,
-    )
+        with timed(timings, "start"):
+            raw_container.start()
+
+        watcher = _LogWatcher(raw_container)
+        watcher.start()
+        try:
+            with timed(timings, "ports"):
+                _wait_until_ports_are_ready(raw_container, ports, timeout)
+
+            container = dc.replace(Hoverfly.from_container(service_host, raw_container), body_files=body_files)
+            with timed(timings, "ready"):
+                wait_until_ready(container, timeout, hint=watcher.started)
+        finally:
+            watcher.stop()
+    except BaseException:
+        _remove_container(raw_container)
+        raise
+
+    if reuse:
+        yield container
+        return
 
     try:
-        _wait_until_ready(container, timeout)
         yield container
     finally:
-        # we don't care about gracefull exit
-        raw_container.kill(signal=9)
-        raw_container.remove(v=True, force=True)
+        _remove_container(raw_container)
+
+
+class BackgroundContainer:
+    """Runs `get_container` in a background thread, so that container startup
+    overlaps with whatever the caller does meanwhile.
+    """
+
+    def __init__(self, **get_container_kwargs: t.Any):
+        self._container = get_container(**get_container_kwargs)
+        self._stopped = False
+
+        executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="hoverfly-start")
+        self._future = executor.submit(next, self._container)
+        executor.shutdown(wait=False)
+
+    def result(self) -> Hoverfly:
+        """Wait for the container to start. Startup errors are re-raised here."""
+        return self._future.result()
+
+    def stop(self) -> None:
+        if self._stopped:
+            return
+
+        self._stopped = True
+        try:
+            self._future.result()
+        except BaseException:
+            # get_container cleans up after a failed start by itself
+            return
+
+        self._container.close()
+
+
+def reuse_key(
+    image: str,
+    ports: t.Mapping[str, t.Any],
+    create_container_kwargs: t.Mapping[str, t.Any],
+    worker_id: t.Optional[str],
+) -> str:
+    """Containers are only reused by sessions that would've created an identical one."""
+    params = {"image": image, "ports": ports, "kwargs": create_container_kwargs, "worker": worker_id}
+    return hashlib.sha256(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+
+def _find_reusable_container(docker: DockerClient, key: str, service_host: str) -> t.Optional[Hoverfly]:
+    # only running containers are listed
+    for raw_container in docker.containers.list(filters={"label": f"{REUSE_LABEL}={key}"}):
+        container = Hoverfly.from_container(service_host, raw_container)
+        if container.is_ready():
+            return container
+
+        _remove_container(raw_container)
+
+    return None
 
 
-def _wait_until_ready(container: Hoverfly, timeout: float) -> None:
-    now = time.monotonic()
-    delay = 0.001
+def _remove_container(raw_container: Container) -> None:
+    # we don't care about gracefull exit
+    raw_container.remove(v=True, force=True)
 
-    while (time.monotonic() - now) < timeout:
+
+def backoff(initial: float = 0.001, cap: float = 0.1) -> t.Iterator[float]:
+    """Exponential delays with jitter, capped so that we don't oversleep readiness by much."""
+    delay = initial
+    while True:
+        yield random.uniform(delay / 2, delay)
+        delay = min(delay * 2, cap)
+
+
+def wait_until_ready(
+    container: Hoverfly,
+    timeout: float,
+    hint: t.Optional[threading.Event] = None,
+    exited: t.Optional[t.Callable[[], bool]] = None,
+) -> None:
+    """Probe Hoverfly until it responds. If a `hint` is given, the probe is repeated
+    as soon as it's set, without waiting for the next backoff step. If `exited` returns True,
+    Hoverfly won't ever respond, so HoverflyExited is raised without waiting for the timeout.
+    """
+    deadline = time.monotonic() + timeout
+
+    for delay in backoff():
         if container.is_ready():
-            break
+            return
+
+        if exited is not None and exited():
+            raise HoverflyExited("Hoverfly exited before it was ready")
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError(f"Container for Hoverfly did not start in {timeout}s")
+
+        if hint is not None and not hint.is_set():
+            hint.wait(min(delay, remaining))
         else:
-            time.sleep(delay)
-            delay *= 2
-    else:
-        raise TimeoutError(f"Container for Hoverfly did not start in {timeout}s")
+            time.sleep(min(delay, remaining))
 
 
 def _wait_until_ports_are_ready(raw_container: Container, ports: t.Dict[str, t.Any], timeout: float) -> None:
     """Docker takes some time to allocate ports so they may not be immediately available."""
-    now = time.monotonic()
-    delay = 0.001
+    deadline = time.monotonic() + timeout
 
-    while (time.monotonic() - now) < timeout:
+    for delay in backoff():
         raw_container.reload()
         # value of a port is either a None or an empty list when it's not ready
         ready = {k: v for k, v in raw_container.ports.items() if v}
         if set(ports).issubset(ready):
-            break
-        else:
-            time.sleep(delay)
-            delay *= 2
-    else:
-        raise TimeoutError(f"Docker failed to expose ports in {timeout}s")
+            return
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError(f"Docker failed to expose ports in {timeout}s")
+
+        time.sleep(min(delay, remaining))
+
+
+class _LogWatcher(threading.Thread):
+    """Follows container logs and sets `started` once Hoverfly reports that both
+    the proxy and the admin API are starting. It's only a hint: readiness is
+    still confirmed by probing, since the log line comes right before listening.
+    """
+
+    MARKERS = (b"serving proxy", b"Admin interface is starting")
+
+    def __init__(self, raw_container: Container):
+        super().__init__(name="hoverfly-log-watcher", daemon=True)
+        self.started = threading.Event()
+        self._stream = raw_container.logs(stream=True, follow=True)
+
+    def run(self) -> None:
+        seen = set()
+        # a marker may be split between chunks
+        tail = b""
+        try:
+            for chunk in self._stream:
+                text = tail + chunk
+                seen.update(m for m in self.MARKERS if m in text)
+                if len(seen) == len(self.MARKERS):
+                    self.started.set()
+                    return
+                tail = text[-64:]
+        except Exception:  # noqa
+            # the stream is closed by stop(), and anyway probing doesn't need us
+            pass
+
+    def stop(self) -> None:
+        self._stream.close()
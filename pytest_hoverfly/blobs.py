@@ -0,0 +1,133 @@
+from __future__ import annotations
+
+import base64
+import collections
+import hashlib
+import os
+import threading
+import typing as t
+import uuid
+from pathlib import Path
+
+from .storage import iter_chunks, simulation_reader
+
+
+# Directory inside the simulations dir where externalized bodies are stored
+BODIES_DIR = "_bodies"
+BODY_FILE_MARKER = b'"bodyFile"'
+DEFAULT_CACHE_SIZE = 256 * 1024 * 1024
+
+
+def _pairs(simulation: t.Mapping[str, t.Any]) -> t.List[t.Dict[str, t.Any]]:
+    return simulation.get("data", {}).get("pairs", [])
+
+
+def _raw_body(response: t.Mapping[str, t.Any]) -> bytes:
+    body = response.get("body") or ""
+    return base64.b64decode(body) if response.get("encodedBody") else body.encode()
+
+
+class BodyStore:
+    """Content-addressed store of response bodies, so that a large body is kept once
+    no matter how many simulations contain it.
+
+    Simulations refer to stored bodies with Hoverfly's `bodyFile` field. The plugin puts
+    bodies back inline before uploading a simulation, so Hoverfly doesn't need access to
+    the store. Bodies read from disk are cached for subsequent tests, up to `cache_size` bytes.
+    """
+
+    def __init__(self, directory: Path, cache_size: int = DEFAULT_CACHE_SIZE):
+        self.directory = directory
+        self.cache_size = cache_size
+        self._cache: t.OrderedDict[str, bytes] = collections.OrderedDict()
+        self._cached_bytes = 0
+        # keys of bodies this store wrote, e.g. not in a snapshot image built before them
+        self.written: t.Set[str] = set()
+        # simulations may be prepared in threads
+        self._lock = threading.Lock()
+
+    def put(self, data: bytes) -> str:
+        key = hashlib.sha256(data).hexdigest()
+        path = self.directory / key
+        if not path.exists():
+            self.directory.mkdir(parents=True, exist_ok=True)
+            # write to a temporary file first, so that a concurrent reader never sees half of a body
+            tmp = self.directory / f".{key}.{uuid.uuid4().hex}"
+            tmp.write_bytes(data)
+            os.replace(tmp, path)
+            with self._lock:
+                self.written.add(key)
+
+        return key
+
+    def get(self, key: str) -> bytes:
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+
+        data = (self.directory / key).read_bytes()
+        if len(data) <= self.cache_size:
+            with self._lock:
+                if key not in self._cache:
+                    self._cache[key] = data
+                    self._cached_bytes += len(data)
+                while self._cached_bytes > self.cache_size:
+                    _, evicted = self._cache.popitem(last=False)
+                    self._cached_bytes -= len(evicted)
+
+        return data
+
+    def has(self, key: str) -> bool:
+        return key in self._cache or (self.directory / key).exists()
+
+    def externalize(self, simulation: t.Mapping[str, t.Any], threshold: int) -> int:
+        """Move response bodies larger than `threshold` bytes to the store. Returns how many were moved."""
+        moved = 0
+        for pair in _pairs(simulation):
+            response = pair["response"]
+            if response.get("bodyFile"):
+                continue
+
+            body = _raw_body(response)
+            if len(body) > threshold:
+                response["bodyFile"] = self.put(body)
+                response["body"] = ""
+                response["encodedBody"] = False
+                moved += 1
+
+        return moved
+
+    def inline(self, simulation: t.Mapping[str, t.Any]) -> int:
+        """Put stored bodies back into the simulation. Body files that aren't in the store
+        are left for Hoverfly to resolve. Returns how many bodies were inlined.
+        """
+        inlined = 0
+        for pair in _pairs(simulation):
+            response = pair["response"]
+            key = response.get("bodyFile")
+            if not key or not self.has(key):
+                continue
+
+            body = self.get(key)
+            try:
+                response["body"], response["encodedBody"] = body.decode(), False
+            except UnicodeDecodeError:
+                response["body"], response["encodedBody"] = base64.b64encode(body).decode(), True
+            del response["bodyFile"]
+            inlined += 1
+
+        return inlined
+
+
+def uses_body_files(path: Path) -> bool:
+    """Check whether a simulation refers to body files without parsing it."""
+    with simulation_reader(path) as stream:
+        # the marker may be split between chunks
+        tail = b""
+        for chunk in iter_chunks(stream):
+            if BODY_FILE_MARKER in tail + chunk:
+                return True
+            tail = chunk[-len(BODY_FILE_MARKER) :]  # noqa: E203
+
+    return False
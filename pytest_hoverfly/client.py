@@ -0,0 +1,112 @@
+from __future__ import annotations
+
+import typing as t
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from .base import Hoverfly
+
+
+# Hoverfly filters logs by `from` in seconds, but the journal in milliseconds
+JOURNAL_TIME_SCALE = 1000
+
+
+class HoverflyClient:
+    """Client for Hoverfly's admin API. It keeps connections alive between calls,
+    so one instance should be shared by all tests.
+
+    Only connection errors are retried: a request that reached Hoverfly is never
+    sent twice, since simulation uploads are streamed and can't be replayed.
+    """
+
+    def __init__(self, hoverfly: Hoverfly, timeout: float = 30.0, retries: int = 3):
+        self.hoverfly = hoverfly
+        self.timeout = timeout
+        # Content hash of the simulation currently loaded in simulate mode, if any
+        self.loaded_simulation: t.Optional[str] = None
+        # Hoverfly state right after the simulation was loaded, e.g. starting steps of sequences
+        self.initial_state: t.Dict[str, str] = {}
+
+        self.session = requests.Session()
+        # so that requests to hoverfly admin endpoint are not proxied :)
+        self.session.trust_env = False
+        adapter = HTTPAdapter(max_retries=Retry(total=retries, read=0, redirect=0, backoff_factor=0.05))
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def close(self) -> None:
+        self.session.close()
+
+    def request(self, method: str, path: str, **kwargs: t.Any) -> requests.Response:
+        kwargs.setdefault("timeout", self.timeout)
+        resp = self.session.request(method, f"{self.hoverfly.admin_endpoint}{path}", **kwargs)
+        resp.raise_for_status()
+        return resp
+
+    def get_simulation(self) -> t.Dict[str, t.Any]:
+        return self.request("GET", "/simulation").json()
+
+    def put_simulation(self, data: t.Union[bytes, str, t.Iterable[bytes]]) -> None:
+        self.request("PUT", "/simulation", data=data)
+
+    def delete_simulation(self) -> None:
+        self.loaded_simulation = None
+        self.request("DELETE", "/simulation")
+
+    def set_mode(self, mode: str, arguments: t.Optional[t.Mapping[str, t.Any]] = None) -> None:
+        payload: t.Dict[str, t.Any] = {"mode": mode}
+        if arguments is not None:
+            payload["arguments"] = arguments
+
+        self.request("PUT", "/hoverfly/mode", json=payload)
+
+    def get_logs(self, limit: t.Optional[int] = None, since: t.Optional[float] = None) -> t.List[t.Dict[str, t.Any]]:
+        """Last `limit` log entries (Hoverfly returns 500 by default), optionally only those logged
+        at or after `since`, a Unix timestamp.
+        """
+        return self.request("GET", "/logs", params=query_params(limit=limit, since=since)).json()["logs"]
+
+    def get_journal(
+        self,
+        offset: int = 0,
+        limit: t.Optional[int] = None,
+        since: t.Optional[float] = None,
+    ) -> t.Dict[str, t.Any]:
+        """A page of the journal, optionally only entries started at or after `since`, a Unix timestamp."""
+        params = query_params(offset=offset, limit=limit, since=since, since_scale=JOURNAL_TIME_SCALE)
+        return self.request("GET", "/journal", params=params).json()
+
+    def iter_journal(self, page_size: int = 500) -> t.Iterator[t.Dict[str, t.Any]]:
+        """All journal entries. Hoverfly returns the journal in pages, 25 entries by default."""
+        offset = 0
+        while True:
+            page = self.get_journal(offset, page_size)
+            entries = page.get("journal") or []
+            yield from entries
+
+            offset += len(entries)
+            if not entries or offset >= page.get("total", offset):
+                return
+
+    def delete_journal(self) -> None:
+        self.request("DELETE", "/journal")
+
+    def get_state(self) -> t.Dict[str, str]:
+        return self.request("GET", "/state").json().get("state") or {}
+
+    def put_state(self, state: t.Mapping[str, str]) -> None:
+        self.request("PUT", "/state", json={"state": state})
+
+    def delete_state(self) -> None:
+        self.request("DELETE", "/state")
+
+
+def query_params(since: t.Optional[float] = None, since_scale: int = 1, **params: t.Any) -> t.Dict[str, t.Any]:
+    """Query of the admin API without unset parameters, `since` is sent as `from`."""
+    if since is not None:
+        # whole units, seconds unless scaled
+        params["from"] = int(since * since_scale)
+
+    return {k: v for k, v in params.items() if v is not None}
@@ -0,0 +1,176 @@
+from __future__ import annotations
+
+import argparse
+import copy
+import dataclasses as dc
+import json
+import typing as t
+from pathlib import Path
+
+from .storage import (
+    SIMULATION_SUFFIXES,
+    read_simulation,
+    write_simulation,
+)
+
+
+# Response headers that differ between otherwise identical responses
+VOLATILE_HEADERS = frozenset(("date", "age", "expires"))
+SEQUENCE_PREFIX = "sequence:"
+
+
+@dc.dataclass
+class CompactionResult:
+    pairs_before: int
+    pairs_after: int
+
+    @property
+    def removed(self) -> int:
+        return self.pairs_before - self.pairs_after
+
+
+def _fingerprint(value: t.Any) -> str:
+    return json.dumps(value, sort_keys=True, separators=(",", ":"))
+
+
+def _request_fingerprint(request: t.Mapping[str, t.Any]) -> str:
+    """Identity of a request regardless of the state it requires."""
+    return _fingerprint({k: v for k, v in request.items() if k != "requiresState"})
+
+
+def _response_fingerprint(response: t.Mapping[str, t.Any]) -> str:
+    """Identity of a response as a client sees it: state transitions and volatile headers are ignored."""
+    response = {k: v for k, v in response.items() if k not in ("transitionsState", "removesState")}
+    headers = response.get("headers") or {}
+    response["headers"] = {k: v for k, v in headers.items() if k.lower() not in VOLATILE_HEADERS}
+    return _fingerprint(response)
+
+
+def _sequence_step(pair: t.Mapping[str, t.Any]) -> t.Optional[t.Tuple[str, int]]:
+    requires_state = pair["request"].get("requiresState") or {}
+    keys = [k for k in requires_state if k.startswith(SEQUENCE_PREFIX)]
+    if len(keys) != 1 or len(requires_state) != 1:
+        return None
+
+    number = _step_number(requires_state[keys[0]])
+    return None if number is None else (keys[0], number)
+
+
+def _step_number(value: t.Any) -> t.Optional[int]:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def dedupe_pairs(pairs: t.List[t.Dict[str, t.Any]]) -> t.List[t.Dict[str, t.Any]]:
+    """Drop pairs with a request identical to an earlier one. Hoverfly always serves
+    the first of them, so the rest only take space and matching time.
+    """
+    seen = set()
+    result = []
+    for pair in pairs:
+        key = _fingerprint(pair["request"])
+        if key not in seen:
+            seen.add(key)
+            result.append(pair)
+
+    return result
+
+
+def collapse_sequences(pairs: t.List[t.Dict[str, t.Any]]) -> t.List[t.Dict[str, t.Any]]:
+    """Merge the steps a recorded sequence ends with, if they got the same response, e.g. a job
+    polled a few times after it finished. The first of them transitions to itself instead,
+    so it's served however many times it's requested.
+
+    Hoverfly gives the last captured step a transition to a step that doesn't exist, so
+    a merged step that kept it would be served once. Repeated steps in the middle of
+    a sequence are kept: merging them would serve fewer responses than were recorded.
+    """
+    sequences: t.Dict[str, t.Dict[int, t.List[t.Dict[str, t.Any]]]] = {}
+    for pair in pairs:
+        step = _sequence_step(pair)
+        if step:
+            sequences.setdefault(step[0], {}).setdefault(step[1], []).append(pair)
+
+    dropped = set()
+    for key, steps in sequences.items():
+        # a step with several requests isn't a simple chain of responses
+        if any(len(step_pairs) > 1 for step_pairs in steps.values()):
+            continue
+
+        chain = [steps[number][0] for number in sorted(steps)]
+        last = chain[-1]
+        next_step = (last["response"].get("transitionsState") or {}).get(key)
+        if next_step is not None and _step_number(next_step) in steps:
+            # the sequence loops back, it doesn't end
+            continue
+
+        run = [last]
+        for pair in reversed(chain[:-1]):
+            if _request_fingerprint(pair["request"]) != _request_fingerprint(last["request"]) or (
+                _response_fingerprint(pair["response"]) != _response_fingerprint(last["response"])
+            ):
+                break
+            run.insert(0, pair)
+
+        if len(run) < 2:
+            continue
+
+        kept = run[0]
+        kept["response"].setdefault("transitionsState", {})[key] = kept["request"]["requiresState"][key]
+        dropped.update(id(pair) for pair in run[1:])
+
+    return [pair for pair in pairs if id(pair) not in dropped]
+
+
+def compact_simulation(data: t.Dict[str, t.Any], sequences: bool = False) -> CompactionResult:
+    """Compact simulation in place. Stateful sequences are merged only with `sequences`,
+    see collapse_sequences.
+    """
+    pairs = data["data"]["pairs"]
+    compacted = dedupe_pairs(collapse_sequences(pairs) if sequences else pairs)
+    data["data"]["pairs"] = compacted
+    return CompactionResult(len(pairs), len(compacted))
+
+
+def compact_file(path: Path, sequences: bool = False) -> CompactionResult:
+    data = read_simulation(path)
+    original = copy.deepcopy(data)
+    result = compact_simulation(data, sequences)
+    if data != original:
+        write_simulation(path, data)
+
+    return result
+
+
+def find_simulations(paths: t.Iterable[Path]) -> t.List[Path]:
+    files = []
+    for path in paths:
+        if path.is_dir():
+            files += sorted(p for p in path.iterdir() if p.name.endswith(SIMULATION_SUFFIXES))
+        else:
+            files.append(path)
+
+    return files
+
+
+def main(argv: t.Optional[t.Sequence[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Remove redundant pairs from Hoverfly simulations in place.")
+    parser.add_argument("paths", nargs="+", type=Path, help="Simulation files or directories with them.")
+    parser.add_argument(
+        "--sequences",
+        action="store_true",
+        help="Also merge repeated responses a stateful sequence ends with into one that is served every time.",
+    )
+    args = parser.parse_args(argv)
+
+    for path in find_simulations(args.paths):
+        result = compact_file(path, args.sequences)
+        print(f"{path}: {result.pairs_before} -> {result.pairs_after} pairs")
+
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,483 @@
+from __future__ import annotations
+
+import asyncio
+import base64
+import datetime
+import ipaddress
+import json
+import ssl
+import tempfile
+import threading
+import time
+import typing as t
+import urllib.parse
+from http import HTTPStatus
+from pathlib import Path
+
+from .base import Hoverfly
+from .client import JOURNAL_TIME_SCALE
+from .matching import (
+    Request,
+    Simulation,
+    UnsupportedMatcher,
+)
+from .profiles import sample_delay
+
+
+try:
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.x509.oid import ExtendedKeyUsageOID, NameOID
+except ImportError:  # pragma: no cover
+    x509 = None
+
+
+# Hop-by-hop or recomputed headers that must not be copied from a recorded response
+SKIPPED_RESPONSE_HEADERS = {"content-length", "transfer-encoding", "connection", "keep-alive"}
+MAX_LOGS = 1000
+# Hoverfly's default number of journal entries per page and of log entries returned
+JOURNAL_PAGE_SIZE = 25
+LOGS_PAGE_SIZE = 500
+ADMIN_PREFIX = "/api/v2"
+
+
+class _HttpMessage(t.NamedTuple):
+    method: str
+    target: str
+    headers: t.List[t.Tuple[str, str]]
+    body: bytes
+
+    def header(self, name: str) -> t.Optional[str]:
+        name = name.lower()
+        for k, v in self.headers:
+            if k.lower() == name:
+                return v
+        return None
+
+
+async def _read_request(reader: asyncio.StreamReader) -> t.Optional[_HttpMessage]:
+    line = await reader.readline()
+    if not line.strip():
+        return None
+
+    try:
+        method, target, _ = line.decode("latin-1").split(" ", 2)
+    except ValueError as e:
+        raise ValueError(f"Malformed request line: {line!r}") from e
+
+    headers = []
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, colon, value = line.decode("latin-1").partition(":")
+        if not colon or not name.strip():
+            raise ValueError(f"Malformed header: {line!r}")
+        headers.append((name.strip(), value.strip()))
+
+    message = _HttpMessage(method, target, headers, b"")
+    if (message.header("Transfer-Encoding") or "").lower() == "chunked":
+        chunks = []
+        while True:
+            size = int((await reader.readline()).split(b";")[0], 16)
+            if size == 0:
+                await reader.readline()
+                break
+            chunks.append(await reader.readexactly(size))
+            await reader.readline()
+        body = b"".join(chunks)
+    else:
+        body = await reader.readexactly(int(message.header("Content-Length") or 0))
+
+    return message._replace(body=body)
+
+
+def _write_response(
+    writer: asyncio.StreamWriter,
+    status: int,
+    body: bytes = b"",
+    headers: t.Iterable[t.Tuple[str, str]] = (),
+) -> None:
+    try:
+        reason = HTTPStatus(status).phrase
+    except ValueError:
+        reason = ""
+
+    lines = [f"HTTP/1.1 {status} {reason}"]
+    lines += [f"{k}: {v}" for k, v in headers]
+    lines.append(f"Content-Length: {len(body)}")
+    writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body)
+
+
+def _json_response(writer: asyncio.StreamWriter, payload: t.Any, status: int = 200) -> None:
+    _write_response(writer, status, json.dumps(payload).encode(), [("Content-Type", "application/json")])
+
+
+class _CertificateAuthority:
+    """Self-signed CA used to intercept HTTPS. Certificates for hosts are issued on demand."""
+
+    def __init__(self, directory: Path):
+        if x509 is None:
+            raise RuntimeError(
+                "cryptography is required for the python backend. "
+                "Install it with `pip install pytest-hoverfly[python]`."
+            )
+
+        self._directory = directory
+        self._contexts: t.Dict[str, ssl.SSLContext] = {}
+
+        # EC keys are generated in microseconds, unlike RSA ones
+        self._key = ec.generate_private_key(ec.SECP256R1())
+        self._name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "pytest-hoverfly CA")])
+        cert = (
+            self._builder(self._name, self._key.public_key())
+            .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+            .add_extension(self._key_usage(ca=True), critical=True)
+            .sign(self._key, hashes.SHA256())
+        )
+
+        self.cert_path = directory / "ca.pem"
+        self.cert_path.write_bytes(cert.public_bytes(serialization.Encoding.PEM))
+
+    def _builder(self, subject, public_key):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        return (
+            x509.CertificateBuilder()
+            .subject_name(subject)
+            .issuer_name(self._name)
+            .public_key(public_key)
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(now - datetime.timedelta(days=1))
+            .not_valid_after(now + datetime.timedelta(days=30))
+            .add_extension(x509.SubjectKeyIdentifier.from_public_key(public_key), critical=False)
+        )
+
+    def _key_usage(self, ca: bool):
+        return x509.KeyUsage(
+            digital_signature=True,
+            content_commitment=False,
+            key_encipherment=False,
+            data_encipherment=False,
+            key_agreement=False,
+            key_cert_sign=ca,
+            crl_sign=ca,
+            encipher_only=False,
+            decipher_only=False,
+        )
+
+    def context_for(self, host: str) -> ssl.SSLContext:
+        if host in self._contexts:
+            return self._contexts[host]
+
+        key = ec.generate_private_key(ec.SECP256R1())
+        try:
+            alt_name = x509.IPAddress(ipaddress.ip_address(host))
+        except ValueError:
+            alt_name = x509.DNSName(host)
+
+        cert = (
+            self._builder(x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, host)]), key.public_key())
+            .add_extension(x509.BasicConstraints(ca=False, path_length=None), critical=True)
+            .add_extension(self._key_usage(ca=False), critical=True)
+            .add_extension(x509.ExtendedKeyUsage([ExtendedKeyUsageOID.SERVER_AUTH]), critical=False)
+            .add_extension(x509.SubjectAlternativeName([alt_name]), critical=False)
+            .add_extension(x509.AuthorityKeyIdentifier.from_issuer_public_key(self._key.public_key()), critical=False)
+            .sign(self._key, hashes.SHA256())
+        )
+
+        path = self._directory / f"{len(self._contexts)}.pem"
+        path.write_bytes(
+            cert.public_bytes(serialization.Encoding.PEM)
+            + key.private_bytes(
+                serialization.Encoding.PEM,
+                serialization.PrivateFormat.PKCS8,
+                serialization.NoEncryption(),
+            )
+        )
+
+        context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        context.load_cert_chain(path)
+        self._contexts[host] = context
+        return context
+
+
+class ReplayEngine:
+    """In-process replacement for Hoverfly in simulate mode, so that recorded simulations
+    can be replayed without Docker. It serves a proxy and the subset of Hoverfly's admin
+    API that the plugin uses, on an asyncio loop running in a background thread.
+    """
+
+    def __init__(self, host: str = "127.0.0.1"):
+        self.host = host
+        self.simulation = Simulation({})
+        self.logs: t.List[t.Dict[str, t.Any]] = []
+        self.journal: t.List[t.Dict[str, t.Any]] = []
+
+        self._tmpdir = tempfile.TemporaryDirectory(prefix="pytest-hoverfly-")
+        self._ca: t.Optional[_CertificateAuthority] = None
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="hoverfly-engine", daemon=True)
+        self._servers: t.List[asyncio.AbstractServer] = []
+        # Strong references to handlers of open connections, otherwise a task may be garbage
+        # collected after TLS interception replaces the protocol that referenced it
+        self._connections: t.Dict[asyncio.Task, asyncio.StreamWriter] = {}
+
+    def start(self) -> Hoverfly:
+        self._ca = _CertificateAuthority(Path(self._tmpdir.name))
+        self._thread.start()
+        admin_port, proxy_port = asyncio.run_coroutine_threadsafe(self._start_servers(), self._loop).result()
+        return Hoverfly(self.host, admin_port, proxy_port, cert=self._ca.cert_path)
+
+    def stop(self) -> None:
+        if self._thread.is_alive():
+            asyncio.run_coroutine_threadsafe(self._stop_servers(), self._loop).result()
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+        self._loop.close()
+        self._tmpdir.cleanup()
+
+    async def _start_servers(self) -> t.Tuple[int, int]:
+        for handler in (self._handle_admin, self._handle_proxy):
+            self._servers.append(await asyncio.start_server(self._tracked(handler), self.host, 0))
+
+        admin, proxy = (server.sockets[0].getsockname()[1] for server in self._servers)
+        return admin, proxy
+
+    async def _stop_servers(self) -> None:
+        for server in self._servers:
+            server.close()
+
+        # Connections kept alive by clients. Aborting them makes handlers see EOF and return,
+        # a graceful TLS shutdown would wait for clients to respond.
+        for writer in list(self._connections.values()):
+            writer.transport.abort()
+        if self._connections:
+            await asyncio.wait(list(self._connections), timeout=1)
+
+        for server in self._servers:
+            await server.wait_closed()
+
+    def _tracked(self, handler):
+        async def serve(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+            task = asyncio.current_task()
+            self._connections[task] = writer
+            try:
+                await handler(reader, writer)
+            except (asyncio.IncompleteReadError, ConnectionError, ssl.SSLError):
+                pass
+            except ValueError as e:
+                # a request that can't be parsed, the connection can't be used after it
+                self._log("error", "Malformed request", error=str(e))
+                _write_response(self._connections.get(task, writer), 400, b"Bad Request")
+            finally:
+                # may have been replaced with a TLS one
+                self._connections.pop(task, writer).close()
+                writer.close()
+
+        return serve
+
+    def _log(self, level: str, msg: str, **fields: t.Any) -> None:
+        self.logs.append({"level": level, "msg": msg, "time": _now(), **fields})
+        del self.logs[:-MAX_LOGS]
+
+    # Admin API
+
+    async def _handle_admin(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        message = await _read_request(reader)
+        while message is not None:
+            self._dispatch_admin(message, writer)
+            await writer.drain()
+            message = await _read_request(reader)
+
+    def _dispatch_admin(self, message: _HttpMessage, writer: asyncio.StreamWriter) -> None:
+        url = urllib.parse.urlsplit(message.target)
+        path = url.path
+        if path.startswith(ADMIN_PREFIX):
+            path = path[len(ADMIN_PREFIX) :]  # noqa: E203
+        route = (message.method, path)
+
+        if route == ("GET", "/simulation"):
+            _json_response(writer, self.simulation.data)
+        elif route == ("PUT", "/simulation"):
+            try:
+                self.simulation = Simulation(json.loads(message.body))
+            except (ValueError, KeyError, UnsupportedMatcher) as e:
+                self._log("error", "Failed to import simulation", error=str(e))
+                _json_response(writer, {"error": f"Invalid simulation: {e}"}, 422)
+                return
+            _json_response(writer, self.simulation.data)
+        elif route == ("DELETE", "/simulation"):
+            self.simulation = Simulation({})
+            _json_response(writer, {})
+        elif route == ("GET", "/hoverfly/mode"):
+            _json_response(writer, {"mode": "simulate"})
+        elif route == ("PUT", "/hoverfly/mode"):
+            mode = json.loads(message.body).get("mode")
+            if mode != "simulate":
+                _json_response(writer, {"error": f"Mode {mode!r} is not supported by the python backend"}, 422)
+                return
+            _json_response(writer, {"mode": mode})
+        elif route == ("GET", "/state"):
+            _json_response(writer, {"state": self.simulation.state})
+        elif route == ("PUT", "/state"):
+            self.simulation.state.clear()
+            self.simulation.state.update(json.loads(message.body).get("state") or {})
+            _json_response(writer, {"state": self.simulation.state})
+        elif route == ("DELETE", "/state"):
+            self.simulation.state.clear()
+            _json_response(writer, {})
+        elif route == ("GET", "/logs"):
+            query = urllib.parse.parse_qs(url.query)
+            logs = _since(self.logs, "time", query)
+            limit = int(query.get("limit", [str(LOGS_PAGE_SIZE)])[0])
+            _json_response(writer, {"logs": logs[-limit:] if limit else []})
+        elif route == ("GET", "/journal"):
+            query = urllib.parse.parse_qs(url.query)
+            journal = _since(self.journal, "timeStarted", query, scale=JOURNAL_TIME_SCALE)
+            offset = int(query.get("offset", ["0"])[0])
+            limit = int(query.get("limit", [str(JOURNAL_PAGE_SIZE)])[0])
+            page = journal[offset : offset + limit]  # noqa: E203
+            _json_response(writer, {"journal": page, "offset": offset, "limit": limit, "total": len(journal)})
+        elif route == ("DELETE", "/journal"):
+            self.journal.clear()
+            _json_response(writer, {})
+        else:
+            _json_response(writer, {"error": "Not found"}, 404)
+
+    # Proxy
+
+    async def _handle_proxy(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        message = await _read_request(reader)
+        scheme = "http"
+
+        if message is not None and message.method == "CONNECT":
+            reader, writer = await self._intercept_tls(message, reader, writer)
+            self._connections[asyncio.current_task()] = writer
+            message = await _read_request(reader)
+            scheme = "https"
+
+        while message is not None:
+            await self._replay(message, writer, scheme)
+            await writer.drain()
+            if (message.header("Connection") or "").lower() == "close":
+                break
+            message = await _read_request(reader)
+
+    async def _intercept_tls(
+        self,
+        message: _HttpMessage,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+    ) -> t.Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        host = message.target.rsplit(":", 1)[0].strip("[]")
+        writer.write(b"HTTP/1.1 200 Connection established\r\n\r\n")
+        await writer.drain()
+
+        loop = asyncio.get_running_loop()
+        tls_reader = asyncio.StreamReader()
+        protocol = asyncio.StreamReaderProtocol(tls_reader)
+        transport = await loop.start_tls(writer.transport, protocol, self._ca.context_for(host), server_side=True)
+        tls_reader.set_transport(transport)
+        return tls_reader, asyncio.StreamWriter(transport, protocol, tls_reader, loop)
+
+    async def _replay(self, message: _HttpMessage, writer: asyncio.StreamWriter, scheme: str) -> None:
+        started, time_started = time.monotonic(), _now()
+        request = _to_request(message, scheme)
+        pair = self.simulation.match(request)
+
+        if pair is None:
+            error = "Could not find a match for request, create or record a valid matcher first!"
+            self._log("error", "There was an error when matching", error=error, request=_describe(request))
+            status, headers = 502, [("Content-Type", "text/plain")]
+            body = f"Hoverfly Error!\n\nThere was an error when matching\n\nGot error: {error}".encode()
+        else:
+            response = pair.response
+            status = response.get("status", 200)
+            body = response.get("body", "")
+            body = base64.b64decode(body) if response.get("encodedBody") else body.encode()
+            headers = [
+                (name, value)
+                for name, values in (response.get("headers") or {}).items()
+                if name.lower() not in SKIPPED_RESPONSE_HEADERS
+                for value in values
+            ]
+            delay = sample_delay(self.simulation.data, request.method, request.destination + request.path, response)
+            if delay:
+                await asyncio.sleep(delay / 1000)
+
+        if not any(name.lower() == "hoverfly" for name, _ in headers):
+            headers.append(("Hoverfly", "Was-Here"))
+
+        _write_response(writer, status, body, headers)
+        self.journal.append(
+            {
+                "request": _describe(request),
+                "response": {"status": status, **_encode_body(body), "headers": _group_headers(headers)},
+                "mode": "simulate",
+                "timeStarted": time_started,
+                "latency": (time.monotonic() - started) * 1000,
+            }
+        )
+
+
+def _to_request(message: _HttpMessage, scheme: str) -> Request:
+    url = urllib.parse.urlsplit(message.target)
+    headers: t.Dict[str, t.List[str]] = {}
+    for name, value in message.headers:
+        if name.lower() not in ("proxy-connection", "proxy-authorization"):
+            headers.setdefault(name, []).append(value)
+
+    return Request(
+        method=message.method,
+        scheme=url.scheme or scheme,
+        destination=url.netloc or message.header("Host") or "",
+        path=url.path or "/",
+        query=urllib.parse.parse_qs(url.query, keep_blank_values=True),
+        headers=headers,
+        body=message.body.decode("utf-8", "replace"),
+    )
+
+
+def _encode_body(body: bytes) -> t.Dict[str, t.Any]:
+    try:
+        return {"body": body.decode(), "encodedBody": False}
+    except UnicodeDecodeError:
+        return {"body": base64.b64encode(body).decode(), "encodedBody": True}
+
+
+def _group_headers(headers: t.Iterable[t.Tuple[str, str]]) -> t.Dict[str, t.List[str]]:
+    grouped: t.Dict[str, t.List[str]] = {}
+    for name, value in headers:
+        grouped.setdefault(name, []).append(value)
+    return grouped
+
+
+def _describe(request: Request) -> t.Dict[str, t.Any]:
+    return {
+        "method": request.method,
+        "scheme": request.scheme,
+        "destination": request.destination,
+        "path": request.path,
+        "query": request.query,
+        "headers": request.headers,
+        "body": request.body,
+    }
+
+
+def _since(
+    entries: t.List[t.Dict[str, t.Any]],
+    time_field: str,
+    query: t.Mapping[str, t.List[str]],
+    scale: int = 1,
+) -> t.List[t.Dict[str, t.Any]]:
+    """Entries at or after `from` query parameter, a Unix timestamp in seconds, or in 1/`scale` of them."""
+    if "from" not in query:
+        return entries
+
+    since = float(query["from"][0]) / scale
+    return [e for e in entries if datetime.datetime.fromisoformat(e[time_field]).timestamp() >= since]
+
+
+def _now() -> str:
+    return datetime.datetime.now(datetime.timezone.utc).isoformat()
@@ -1,21 +1,60 @@
 from __future__ import annotations
 
 import os
+import typing as t
 from pathlib import Path
 
+from .storage import SIMULATION_SUFFIXES, has_simulation_suffix
+
+
+T = t.TypeVar("T")
+
 
 def extract_simulation_name_from_request(request):
-    try:
-        marker = [m for m in request.node.own_markers if m.name == "hoverfly"][0]
-    except IndexError as e:
-        raise RuntimeError("Test does not have Hoverfly marker") from e
+    name = extract_simulation_name_from_marker(_get_marker(request))
+    return name if ".json" in name else f"{name}.json"
+
+
+def get_request_simulation_file(request) -> Path:
+    """Simulation file of the test, see get_simulation_file."""
+    return get_simulation_file(request.config, extract_simulation_name_from_marker(_get_marker(request)))
+
+
+def _get_marker(request):
+    # the marker may be on the test's class or module
+    marker = request.node.get_closest_marker("hoverfly")
+    if marker is None:
+        raise RuntimeError("Test does not have Hoverfly marker")
+
+    return marker
+
 
+def extract_simulation_name_from_marker(marker) -> str:
     if marker.args:
         name = marker.args[0]
     else:
         name = marker.kwargs["name"]
 
-    return name if ".json" in name else f"{name}.json"
+    return name
+
+
+def get_scoped_fixture(request, name: str) -> t.Any:
+    """Value of `name` fixture in the scope of the test's @hoverfly(scope=...)."""
+    scope = request.node._hoverfly_scope
+    return request.getfixturevalue(name if scope == "function" else f"_{scope}{name}")
+
+
+def group_items(items: t.List[T], key: t.Callable[[T], t.Optional[t.Hashable]]) -> None:
+    """Stably reorder items in place, so that items with the same key follow the first one of them.
+    Items with None key stay where they are relative to the groups.
+    """
+    first: t.Dict[t.Hashable, int] = {}
+    positions = []
+    for index, item in enumerate(items):
+        item_key = key(item)
+        positions.append(index if item_key is None else first.setdefault(item_key, index))
+
+    items[:] = [item for _, item in sorted(zip(positions, items), key=lambda p: p[0])]
 
 
 def get_simulations_path(config) -> Path:
@@ -26,6 +65,22 @@ def get_simulations_path(config) -> Path:
     return config.inipath.parent / path
 
 
+def get_simulation_file(config, name: str) -> Path:
+    """Simulation may be referred to with or without a suffix. Without it, an existing
+    .json, .json.gz or .json.zst file is used, falling back to .json for new recordings.
+    """
+    directory = get_simulations_path(config)
+    if has_simulation_suffix(name):
+        return directory / name
+
+    for suffix in SIMULATION_SUFFIXES:
+        path = directory / f"{name}{suffix}"
+        if path.exists():
+            return path
+
+    return directory / f"{name}{SIMULATION_SUFFIXES[0]}"
+
+
 def del_header(pair, header: str):
     try:
         del pair["request"]["headers"][header]
@@ -0,0 +1,46 @@
+from __future__ import annotations
+
+import typing as t
+
+import pytest
+
+from .base import Hoverfly
+
+
+def pytest_hoverfly_phase_timing(config, nodeid: str, phase: str, duration: float) -> None:
+    """Called at the end of every test that used Hoverfly, once per phase of pytest-hoverfly's work.
+
+    :param config: pytest config.
+    :param nodeid: the test.
+    :param phase: one of
+        prepare - checking simulations at collection, reported for the first test that used Hoverfly;
+        image, create, start, ports, ready - starting a container (only start and ready for a local process),
+            reported for the first test that needed it;
+        render - rendering a simulation template for the test;
+        read, upload, mode, state - loading a simulation;
+        logs - reading Hoverfly's logs after the test failed;
+        export, write - saving a recording;
+        delete - deleting a simulation;
+        journal - reading Hoverfly's journal, see --hoverfly-report.
+    :param duration: seconds.
+    """
+
+
+@pytest.hookspec(firstresult=True)
+def pytest_hoverfly_backend(config, name: str) -> t.Optional[t.Iterator[Hoverfly]]:
+    """Start Hoverfly for `--hoverfly-backend=name`, once per session (per worker with pytest-xdist).
+
+    Return a generator that yields a running instance once and stops it when closed,
+    or None if `name` isn't yours. docker, binary and python backends are built in.
+
+    :param config: pytest config.
+    :param name: value of --hoverfly-backend.
+    """
+
+
+def pytest_hoverfly_sanitize_rules(config) -> t.Iterable[str]:
+    """Rules to scrub recordings with, added after the ones from `hoverfly_sanitize` ini option.
+    See pytest_hoverfly.sanitize for the syntax. Called once per session.
+
+    :param config: pytest config.
+    """
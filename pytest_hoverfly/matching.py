@@ -0,0 +1,255 @@
+from __future__ import annotations
+
+import dataclasses as dc
+import fnmatch
+import json
+import re
+import typing as t
+import urllib.parse
+
+
+# Fields that are matched against a single string and may be used to index pairs
+INDEXED_FIELDS = ("method", "destination", "path")
+STRING_FIELDS = INDEXED_FIELDS + ("scheme", "body")
+
+SUPPORTED_MATCHERS = frozenset(("exact", "glob", "regex", "json", "jsonpartial"))
+_INVALID_JSON = object()
+
+IndexKey = t.Tuple[str, str, str]
+
+
+class UnsupportedMatcher(ValueError):
+    pass
+
+
+@dc.dataclass(frozen=True)
+class Request:
+    method: str
+    scheme: str
+    destination: str
+    path: str
+    query: t.Mapping[str, t.List[str]]
+    headers: t.Mapping[str, t.List[str]]
+    body: str
+
+    def field(self, name: str) -> str:
+        return getattr(self, name)
+
+    @property
+    def index_key(self) -> IndexKey:
+        return self.method, self.destination, self.path
+
+
+def _json_contains(expected: t.Any, actual: t.Any) -> bool:
+    if isinstance(expected, dict):
+        return isinstance(actual, dict) and all(
+            k in actual and _json_contains(v, actual[k]) for k, v in expected.items()
+        )
+
+    return expected == actual
+
+
+def _load_json(value: str) -> t.Any:
+    try:
+        return json.loads(value)
+    except ValueError:
+        return _INVALID_JSON
+
+
+def match_value(matcher: t.Mapping[str, t.Any], value: str) -> bool:
+    """Evaluate one of Hoverfly's field matchers against a value."""
+    kind = matcher["matcher"].lower()
+    expected = matcher["value"]
+
+    if kind == "exact":
+        return value == expected
+    if kind == "glob":
+        return fnmatch.fnmatchcase(value, expected)
+    if kind == "regex":
+        return re.search(expected, value) is not None
+    if kind == "json":
+        actual = _load_json(value)
+        return actual is not _INVALID_JSON and actual == _load_json(expected)
+    if kind == "jsonpartial":
+        actual = _load_json(value)
+        return actual is not _INVALID_JSON and _json_contains(_load_json(expected), actual)
+
+    raise UnsupportedMatcher(f"Matcher {matcher['matcher']!r} is not supported")
+
+
+def _check_matchers(matchers: t.Iterable[t.Mapping[str, t.Any]]) -> None:
+    for matcher in matchers:
+        if matcher["matcher"].lower() not in SUPPORTED_MATCHERS:
+            raise UnsupportedMatcher(f"Matcher {matcher['matcher']!r} is not supported")
+
+
+@dc.dataclass
+class Pair:
+    position: int
+    request: t.Mapping[str, t.Any]
+    response: t.Mapping[str, t.Any]
+
+    @property
+    def index_key(self) -> t.Optional[IndexKey]:
+        """Pairs that match method, destination and path exactly can be found without evaluating matchers."""
+        key = []
+        for name in INDEXED_FIELDS:
+            matchers = self.request.get(name) or []
+            if len(matchers) != 1 or matchers[0]["matcher"].lower() != "exact":
+                return None
+            key.append(matchers[0]["value"])
+
+        return key[0], key[1], key[2]
+
+    def score(self, request: Request, state: t.Mapping[str, str]) -> t.Optional[int]:
+        """Number of matchers that matched, or None if any of them didn't."""
+        score = 0
+        for name in STRING_FIELDS:
+            for matcher in self.request.get(name) or []:
+                if not match_value(matcher, request.field(name)):
+                    return None
+                score += 1
+
+        for name, values in (("query", request.query), ("headers", request.headers)):
+            for key, matchers in (self.request.get(name) or {}).items():
+                actual = _get_multi(values, key)
+                if actual is None:
+                    return None
+                for matcher in matchers:
+                    if not match_value(matcher, actual):
+                        return None
+                    score += 1
+
+        for key, value in (self.request.get("requiresState") or {}).items():
+            if state.get(key) != value:
+                return None
+            score += 1
+
+        return score
+
+
+def _get_multi(values: t.Mapping[str, t.List[str]], key: str) -> t.Optional[str]:
+    # Hoverfly joins multiple values with a semicolon, header names are case-insensitive
+    if key in values:
+        return ";".join(values[key])
+
+    lowered = key.lower()
+    for k, v in values.items():
+        if k.lower() == lowered:
+            return ";".join(v)
+
+    return None
+
+
+class Simulation:
+    """Request-response pairs of a Hoverfly simulation with an index for fast lookup.
+
+    Pairs that match method, destination and path exactly are indexed by these fields,
+    so finding candidates for a request takes a dict lookup. Other pairs are evaluated
+    for every request. Among matching pairs the one with most matchers wins, earlier
+    pairs win ties, like Hoverfly's "strongest match" strategy.
+    """
+
+    def __init__(self, data: t.Mapping[str, t.Any]):
+        self.data = data
+        self.state: t.Dict[str, str] = {}
+        self._index: t.Dict[IndexKey, t.List[Pair]] = {}
+        self._unindexed: t.List[Pair] = []
+
+        for position, raw in enumerate(data.get("data", {}).get("pairs", [])):
+            pair = Pair(position, raw["request"], raw["response"])
+            for name in STRING_FIELDS:
+                _check_matchers(pair.request.get(name) or [])
+            for name in ("query", "headers"):
+                for matchers in (pair.request.get(name) or {}).values():
+                    _check_matchers(matchers)
+
+            key = pair.index_key
+            if key is None:
+                self._unindexed.append(pair)
+            else:
+                self._index.setdefault(key, []).append(pair)
+
+            # like Hoverfly, start recorded sequences from their first step
+            for state_key in pair.request.get("requiresState") or {}:
+                if state_key.startswith("sequence:"):
+                    self.state[state_key] = "1"
+
+    def __len__(self) -> int:
+        return sum(map(len, self._index.values())) + len(self._unindexed)
+
+    def candidates(self, request: Request) -> t.List[Pair]:
+        indexed = self._index.get(request.index_key, [])
+        if not self._unindexed:
+            return indexed
+
+        return sorted(indexed + self._unindexed, key=lambda p: p.position)
+
+    def match(self, request: Request) -> t.Optional[Pair]:
+        best: t.Optional[Pair] = None
+        best_score = -1
+        for pair in self.candidates(request):
+            score = pair.score(request, self.state)
+            if score is not None and score > best_score:
+                best, best_score = pair, score
+
+        if best is not None:
+            self.state.update(best.response.get("transitionsState") or {})
+            for key in best.response.get("removesState") or []:
+                self.state.pop(key, None)
+
+        return best
+
+
+def _exact(value: str) -> t.List[t.Dict[str, str]]:
+    return [{"matcher": "exact", "value": value}]
+
+
+def request_from_journal(request: t.Mapping[str, t.Any]) -> Request:
+    query = request.get("query") or {}
+    if isinstance(query, str):
+        # Hoverfly's journal has the raw query string
+        query = urllib.parse.parse_qs(query, keep_blank_values=True)
+
+    return Request(
+        method=request.get("method", ""),
+        scheme=request.get("scheme", ""),
+        destination=request.get("destination", ""),
+        path=request.get("path", ""),
+        query=query,
+        headers=request.get("headers") or {},
+        body=request.get("body", ""),
+    )
+
+
+def pair_from_journal(entry: t.Mapping[str, t.Any]) -> t.Dict[str, t.Any]:
+    """Request-response pair with exact matchers for all fields, like Hoverfly captures them."""
+    request = request_from_journal(entry["request"])
+    pair_request: t.Dict[str, t.Any] = {name: _exact(request.field(name)) for name in ("path", "method", "destination")}
+    pair_request["scheme"] = _exact(request.scheme)
+    pair_request["body"] = _exact(request.body)
+    if request.query:
+        pair_request["query"] = {k: _exact(";".join(v)) for k, v in request.query.items()}
+    pair_request["headers"] = {k: _exact(";".join(v)) for k, v in request.headers.items()}
+
+    response = entry["response"]
+    return {
+        "request": pair_request,
+        "response": {
+            "status": response.get("status", 200),
+            "body": response.get("body", ""),
+            "encodedBody": response.get("encodedBody", False),
+            "headers": response.get("headers") or {},
+            "templated": False,
+        },
+    }
+
+
+def find_missing(data: t.Mapping[str, t.Any], journal: t.Iterable[t.Mapping[str, t.Any]]) -> t.List[t.Dict[str, t.Any]]:
+    """Pairs for journal entries the simulation has no match for, in the order requests were made."""
+    simulation = Simulation(data)
+    return [
+        pair_from_journal(entry)
+        for entry in journal
+        if simulation.match(request_from_journal(entry["request"])) is None
+    ]
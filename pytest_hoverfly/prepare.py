@@ -0,0 +1,202 @@
+from __future__ import annotations
+
+import contextlib
+import dataclasses as dc
+import json
+import os
+import threading
+import typing as t
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from .blobs import BodyStore
+from .matching import STRING_FIELDS
+from .storage import (
+    content_size,
+    file_digest,
+    read_simulation,
+)
+
+
+DEFAULT_CACHE_SIZE = 256 * 1024 * 1024
+# Parsing a simulation takes several times its size in memory. Bigger ones are only hashed
+# at collection, and simulations parsed at the same time don't exceed it together
+MAX_PARSED_SIZE = 64 * 1024 * 1024
+MAX_WORKERS = 8
+
+
+class InvalidSimulation(ValueError):
+    pass
+
+
+@dc.dataclass(frozen=True)
+class PreparedSimulation:
+    """A simulation checked at collection, with what's needed to upload it."""
+
+    path: Path
+    # hash of the file, as file_digest computes it
+    digest: str
+    # modification time and size of the file when it was prepared
+    stat: t.Tuple[int, int]
+    # minified simulation with bodies inlined, None if it's too big to keep in memory
+    payload: t.Optional[bytes] = dc.field(repr=False)
+    # rendered from a template: only the payload may be uploaded, and the digest is its hash
+    rendered: bool = False
+
+    def is_current(self) -> bool:
+        """False if the file has changed since, e.g. a test re-recorded it."""
+        try:
+            return _stat(self.path) == self.stat
+        except OSError:
+            return False
+
+
+class _MemoryBudget:
+    """Bytes that threads may take together. Taking more than is left waits until others are done,
+    unless nothing is taken: a single big simulation doesn't wait forever.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self._used = 0
+        self._condition = threading.Condition()
+
+    @contextlib.contextmanager
+    def reserve(self, size: int) -> t.Iterator[None]:
+        with self._condition:
+            self._condition.wait_for(lambda: self._used == 0 or self._used + size <= self.limit)
+            self._used += size
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._used -= size
+                self._condition.notify_all()
+
+    def try_take(self, size: int) -> bool:
+        """Take `size` bytes for good, if they are left."""
+        with self._condition:
+            if self._used + size > self.limit:
+                return False
+            self._used += size
+            return True
+
+
+def _stat(path: Path) -> t.Tuple[int, int]:
+    st = os.stat(path)
+    return st.st_mtime_ns, st.st_size
+
+
+def _check_matchers(where: str, matchers: t.Any) -> None:
+    if not isinstance(matchers, list) or not all(
+        isinstance(m, dict) and "matcher" in m and "value" in m for m in matchers
+    ):
+        raise InvalidSimulation(f"{where} must be a list of matchers with `matcher` and `value`")
+
+
+def validate_simulation(data: t.Any) -> None:
+    """Check the structure Hoverfly expects from a simulation. Matchers themselves aren't checked,
+    Hoverfly supports more of them than the python backend does.
+    """
+    pairs = data.get("data") if isinstance(data, dict) else None
+    pairs = pairs.get("pairs") if isinstance(pairs, dict) else None
+    if not isinstance(pairs, list):
+        raise InvalidSimulation("`data.pairs` must be a list")
+
+    for i, pair in enumerate(pairs):
+        if not isinstance(pair, dict) or not isinstance(pair.get("request"), dict):
+            raise InvalidSimulation(f"pair {i}: `request` must be an object")
+        if not isinstance(pair.get("response"), dict):
+            raise InvalidSimulation(f"pair {i}: `response` must be an object")
+
+        request, response = pair["request"], pair["response"]
+        for name in STRING_FIELDS:
+            if name in request:
+                _check_matchers(f"pair {i}: `request.{name}`", request[name])
+        for name in ("query", "headers"):
+            fields = request.get(name) or {}
+            if not isinstance(fields, dict):
+                raise InvalidSimulation(f"pair {i}: `request.{name}` must be an object")
+            for key, matchers in fields.items():
+                _check_matchers(f"pair {i}: `request.{name}.{key}`", matchers)
+
+        if not isinstance(response.get("status", 200), int):
+            raise InvalidSimulation(f"pair {i}: `response.status` must be an integer")
+        if not isinstance(response.get("body", ""), str):
+            raise InvalidSimulation(f"pair {i}: `response.body` must be a string")
+
+
+def prepare_simulation(
+    path: Path,
+    body_store: BodyStore,
+    cache_size: int,
+    max_parsed_size: int = MAX_PARSED_SIZE,
+    parsing: t.Optional[_MemoryBudget] = None,
+) -> PreparedSimulation:
+    """Hash, check and minify a simulation. One bigger than `max_parsed_size` is only hashed:
+    Hoverfly reports what's wrong with it when it's loaded. Its size is taken from `parsing`
+    budget while it's parsed.
+    """
+    stat = _stat(path)
+    digest = file_digest(path)
+    size = content_size(path, limit=max_parsed_size)
+    if size > max_parsed_size:
+        return PreparedSimulation(path, digest, stat, None)
+
+    with parsing.reserve(size) if parsing else contextlib.nullcontext():
+        try:
+            data = read_simulation(path)
+        except ValueError as e:
+            raise InvalidSimulation(f"not a valid JSON: {e}") from e
+        validate_simulation(data)
+
+        payload = None
+        if size <= cache_size:
+            body_store.inline(data)
+            payload = json.dumps(data, separators=(",", ":")).encode()
+            if len(payload) > cache_size:
+                payload = None
+
+    return PreparedSimulation(path, digest, stat, payload)
+
+
+def prepare_simulations(
+    paths: t.Iterable[Path],
+    body_store: BodyStore,
+    cache_size: int = DEFAULT_CACHE_SIZE,
+    max_parsed_size: int = MAX_PARSED_SIZE,
+) -> t.Tuple[t.Dict[Path, PreparedSimulation], t.Dict[Path, str]]:
+    """Check and parse simulations in parallel. Returns prepared simulations and errors by path.
+    Parsed simulations are kept while they fit in `cache_size` bytes in total. Simulations
+    bigger than `max_parsed_size` aren't parsed, and the ones parsed at once fit in it together.
+    """
+    paths = sorted(set(paths))
+    prepared: t.Dict[Path, PreparedSimulation] = {}
+    errors: t.Dict[Path, str] = {}
+    parsing = _MemoryBudget(max_parsed_size)
+    cache = _MemoryBudget(cache_size)
+
+    def prepare(path: Path) -> t.Union[PreparedSimulation, str]:
+        if not path.exists():
+            return "file not found"
+        try:
+            result = prepare_simulation(path, body_store, cache_size, max_parsed_size, parsing)
+        except InvalidSimulation as e:
+            return str(e)
+        except Exception as e:
+            # e.g. a broken archive
+            return f"can't read: {e!r}"
+
+        # right away, finished results wait for the slower ones before them
+        if result.payload is not None and not cache.try_take(len(result.payload)):
+            result = dc.replace(result, payload=None)
+        return result
+
+    with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(paths) or 1)) as executor:
+        for path, result in zip(paths, executor.map(prepare, paths)):
+            if isinstance(result, str):
+                errors[path] = result
+            else:
+                prepared[path] = result
+
+    return prepared, errors
@@ -0,0 +1,120 @@
+"""Hoverfly as a subprocess of a local `hoverfly` binary, for machines without Docker."""
+from __future__ import annotations
+
+import atexit
+import contextlib
+import functools
+import shlex
+import shutil
+import socket
+import subprocess
+import tempfile
+import typing as t
+
+from .base import (
+    Hoverfly,
+    HoverflyExited,
+    wait_until_ready,
+)
+from .timing import timed
+
+
+BINARY = "hoverfly"
+HOST = "127.0.0.1"
+# another process may take a free port before Hoverfly binds it
+START_ATTEMPTS = 3
+STOP_TIMEOUT = 5.0
+LOG_TAIL_BYTES = 2000
+
+
+def get_process(
+    binary: str = BINARY,
+    args: t.Optional[str] = None,
+    timeout: float = 3.0,
+    timings: t.Optional[t.Dict[str, float]] = None,
+) -> t.Iterator[Hoverfly]:
+    """Yield a Hoverfly instance running `binary` on free ports, with `args` passed as is.
+    The process is stopped at the end, or when the interpreter exits if the generator is never closed.
+    If `timings` is given, it's filled with durations of startup phases.
+    Variables of an external instance, like HOVERFLY_HOST, are ignored: asking for a process means a local one.
+    """
+    path = shutil.which(binary)
+    if not path:
+        raise FileNotFoundError(
+            f"Hoverfly binary not found: {binary}. Install it from https://docs.hoverfly.io "
+            "or pass its path with --hoverfly-binary"
+        )
+
+    for attempt in range(START_ATTEMPTS):
+        try:
+            process, instance = _start([path, *shlex.split(args or "")], timeout, timings)
+            break
+        except _PortTaken:
+            if attempt == START_ATTEMPTS - 1:
+                raise
+
+    stop = functools.partial(_stop, process)
+    atexit.register(stop)
+    try:
+        yield instance
+    finally:
+        stop()
+        atexit.unregister(stop)
+
+
+class _PortTaken(HoverflyExited):
+    pass
+
+
+def _start(
+    command: t.List[str],
+    timeout: float,
+    timings: t.Optional[t.Dict[str, float]],
+) -> t.Tuple[subprocess.Popen, Hoverfly]:
+    admin_port, proxy_port = _free_ports(2)
+    instance = Hoverfly(HOST, admin_port=admin_port, proxy_port=proxy_port)
+
+    # a file rather than a pipe, so that a chatty Hoverfly never blocks on a full one
+    with tempfile.TemporaryFile() as log:
+        with timed(timings, "start"):
+            process = subprocess.Popen(
+                [*command, "-ap", str(admin_port), "-pp", str(proxy_port)],
+                stdin=subprocess.DEVNULL,
+                stdout=log,
+                stderr=subprocess.STDOUT,
+            )
+
+        try:
+            with timed(timings, "ready"):
+                wait_until_ready(instance, timeout, exited=lambda: process.poll() is not None)
+        except HoverflyExited:
+            log.seek(max(0, log.tell() - LOG_TAIL_BYTES))
+            output = log.read().decode(errors="replace")
+            error = _PortTaken if "address already in use" in output else HoverflyExited
+            raise error(f"Hoverfly exited with code {process.returncode}:\n{output}") from None
+        except BaseException:
+            _stop(process)
+            raise
+
+    return process, instance
+
+
+def _free_ports(count: int) -> t.List[int]:
+    # keep all sockets open until the end, so that the ports differ
+    with contextlib.ExitStack() as stack:
+        sockets = [stack.enter_context(socket.socket()) for _ in range(count)]
+        for sock in sockets:
+            sock.bind((HOST, 0))
+        return [sock.getsockname()[1] for sock in sockets]
+
+
+def _stop(process: subprocess.Popen) -> None:
+    if process.poll() is not None:
+        return
+
+    process.terminate()
+    try:
+        process.wait(STOP_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
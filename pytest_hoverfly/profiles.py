@@ -0,0 +1,175 @@
+"""Latency and faults added to a simulation when it's uploaded, to see how clients
+cope with slow or failing services. Delays use Hoverfly's own delay settings, see
+https://docs.hoverfly.io/en/latest/pages/reference/simulationschema.html
+"""
+from __future__ import annotations
+
+import dataclasses as dc
+import hashlib
+import json
+import math
+import random
+import re
+import typing as t
+
+
+# Matches every URL
+ANY_URL = "."
+FAULT_STATUS = 503
+LOGNORMAL_FIELDS = ("min", "max", "mean", "median")
+# Response fields of stateful sequences, kept when a response is replaced with a fault
+STATE_FIELDS = ("transitionsState", "removesState")
+
+Spec = t.Union[str, int, float]
+
+
+@dc.dataclass(frozen=True)
+class LogNormal:
+    """Log-normal distribution of delays in milliseconds, clamped to [min, max]."""
+
+    min: int
+    max: int
+    mean: int
+    median: int
+
+    def sample(self) -> float:
+        # the same parametrization Hoverfly uses
+        mu = math.log(self.median)
+        sigma = math.sqrt(2 * max(0.0, math.log(self.mean) - mu))
+        return min(max(random.lognormvariate(mu, sigma), self.min), self.max)
+
+
+@dc.dataclass(frozen=True)
+class Delay:
+    """Delay of responses to requests whose URL (host and path) matches `url_pattern` regex."""
+
+    url_pattern: str = ANY_URL
+    # milliseconds
+    fixed: int = 0
+    lognormal: t.Optional[LogNormal] = None
+
+
+@dc.dataclass(frozen=True)
+class Profile:
+    """What to add to a simulation: delays and a share of pairs that respond with `fault_status`."""
+
+    delays: t.Tuple[Delay, ...] = ()
+    fault_rate: float = 0.0
+    fault_status: int = FAULT_STATUS
+
+    def __bool__(self) -> bool:
+        return bool(self.delays) or self.fault_rate > 0
+
+    @property
+    def key(self) -> str:
+        """Tells simulations with different profiles apart."""
+        return hashlib.sha256(json.dumps(dc.asdict(self), sort_keys=True).encode()).hexdigest()[:16]
+
+    @classmethod
+    def from_specs(cls, latency: t.Union[Spec, t.Sequence[Spec], None], faults: t.Optional[Spec]) -> Profile:
+        if latency is None:
+            latency = []
+        elif isinstance(latency, (str, int, float)):
+            latency = [latency]
+        fault_rate, fault_status = parse_faults(faults) if faults is not None else (0.0, FAULT_STATUS)
+
+        return cls(tuple(parse_delay(spec) for spec in latency), fault_rate, fault_status)
+
+    def apply(self, data: t.Dict[str, t.Any], seed: str) -> None:
+        """Add delays to the simulation and replace responses of some pairs with faults.
+        Pairs are picked at random, but the same `seed` picks the same pairs.
+        """
+        global_actions = data.setdefault("data", {}).setdefault("globalActions", {})
+        # Hoverfly uses the first matching delay, so these go before the recorded ones
+        global_actions["delays"] = [
+            {"urlPattern": d.url_pattern, "httpMethod": "", "delay": d.fixed} for d in self.delays if d.fixed
+        ] + (global_actions.get("delays") or [])
+        global_actions["delaysLogNormal"] = [
+            {"urlPattern": d.url_pattern, "httpMethod": "", **dc.asdict(d.lognormal)}
+            for d in self.delays
+            if d.lognormal
+        ] + (global_actions.get("delaysLogNormal") or [])
+
+        if self.fault_rate <= 0:
+            return
+
+        rng = random.Random(seed)
+        for pair in data["data"].get("pairs") or []:
+            if rng.random() < self.fault_rate:
+                response = pair["response"]
+                pair["response"] = {
+                    "status": self.fault_status,
+                    "body": "",
+                    "encodedBody": False,
+                    "headers": {},
+                    "templated": False,
+                    **{name: response[name] for name in STATE_FIELDS if name in response},
+                }
+
+
+def parse_delay(spec: Spec) -> Delay:
+    """`DELAY[@URL_REGEX]`, where DELAY is milliseconds or `lognormal:min=..,max=..,mean=..,median=..`."""
+    text = str(spec)
+    delay, _, url_pattern = text.partition("@")
+    url_pattern = url_pattern or ANY_URL
+
+    if delay.startswith("lognormal:"):
+        try:
+            params = dict(param.split("=", 1) for param in delay[len("lognormal:") :].split(","))  # noqa: E203
+            lognormal = LogNormal(**{name: int(params.pop(name)) for name in LOGNORMAL_FIELDS})
+        except (ValueError, KeyError) as e:
+            raise ValueError(f"Expected `lognormal:min=..,max=..,mean=..,median=..`, got: {text!r}") from e
+        if params:
+            raise ValueError(f"Unknown parameters of lognormal delay: {', '.join(params)}")
+        if not 0 < lognormal.median <= lognormal.mean or lognormal.min > lognormal.max:
+            raise ValueError(f"Expected 0 < median <= mean and min <= max, got: {text!r}")
+        return Delay(url_pattern, lognormal=lognormal)
+
+    try:
+        fixed = int(delay)
+    except ValueError as e:
+        raise ValueError(f"Expected delay in milliseconds or a lognormal one, got: {text!r}") from e
+    if fixed < 0:
+        raise ValueError(f"Delay can't be negative, got: {text!r}")
+    return Delay(url_pattern, fixed=fixed)
+
+
+def parse_faults(spec: Spec) -> t.Tuple[float, int]:
+    """`RATE[:STATUS]`, e.g. `0.1:504` for 10% of pairs responding with 504."""
+    text = str(spec)
+    rate, _, status = text.partition(":")
+    try:
+        result = float(rate), int(status or FAULT_STATUS)
+    except ValueError as e:
+        raise ValueError(f"Expected `RATE[:STATUS]`, got: {text!r}") from e
+    if not 0 <= result[0] <= 1:
+        raise ValueError(f"Fault rate must be between 0 and 1, got: {text!r}")
+    return result
+
+
+def sample_delay(data: t.Mapping[str, t.Any], method: str, url: str, response: t.Mapping[str, t.Any]) -> float:
+    """Milliseconds to wait before sending `response`, as Hoverfly would: a delay of the pair
+    plus the first matching global delay of each kind.
+    """
+    delay = float(response.get("fixedDelay") or 0)
+    if response.get("logNormalDelay"):
+        delay += LogNormal(**{name: response["logNormalDelay"][name] for name in LOGNORMAL_FIELDS}).sample()
+
+    global_actions = (data.get("data") or {}).get("globalActions") or {}
+    for item in global_actions.get("delays") or []:
+        if _matches(item, method, url):
+            delay += item.get("delay") or 0
+            break
+    for item in global_actions.get("delaysLogNormal") or []:
+        if _matches(item, method, url):
+            delay += LogNormal(**{name: item[name] for name in LOGNORMAL_FIELDS}).sample()
+            break
+
+    return delay
+
+
+def _matches(delay: t.Mapping[str, t.Any], method: str, url: str) -> bool:
+    if delay.get("httpMethod") and delay["httpMethod"] != method:
+        return False
+
+    return re.search(delay.get("urlPattern") or ANY_URL, url) is not None
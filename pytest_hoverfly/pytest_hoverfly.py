@@ -1,35 +1,75 @@
 from __future__ import annotations
 
+import contextlib
 import json
 import os
 import typing as t
 from pathlib import Path
 
 import pytest
-import requests
 import typing_extensions as te
+from docker import DockerClient
 
+from . import hooks
+from .background import BackgroundWriter
 from .base import (
     IMAGE,
+    BackgroundContainer,
     Hoverfly,
     get_container,
 )
+from .blobs import BODIES_DIR, BodyStore
+from .client import HoverflyClient
+from .compaction import compact_file, find_simulations
+from .engine import ReplayEngine
 from .helpers import (
-    del_gcloud_credentials,
-    del_header,
     ensure_simulation_dir,
-    extract_simulation_name_from_request,
+    extract_simulation_name_from_marker,
+    get_scoped_fixture,
+    get_simulation_file,
     get_simulations_path,
+    group_items,
+)
+from .prepare import prepare_simulations
+from .process import BINARY, get_process
+from .profiles import Profile
+from .report import (
+    REPORT_PROPERTY,
+    TrafficReport,
+    TrafficReporter,
+)
+from .sanitize import Sanitizer
+from .snapshot import SNAPSHOT_REPOSITORY, build_snapshot
+from .steps import (
+    record_missing,
+    record_simulation,
+    replay_simulation,
+    run,
+)
+from .templates import Substitutions
+from .timing import (
+    PHASE_TIMINGS_PROPERTY,
+    PhaseDurations,
+    timed,
 )
 
 
+# Scopes of @hoverfly(scope=...), in which environment is patched and the simulation is loaded once
+SCOPES = ("function", "class", "module", "session")
+
+
 class HoverflyMarker(te.Protocol):
     def __call__(
         self,
         name: str,
         *,
-        record: bool = False,
+        record: t.Union[bool, te.Literal["missing"]] = False,
         stateful: bool = False,
+        asynchronous: bool = False,
+        latency: t.Union[str, int, t.Sequence[t.Union[str, int]], None] = None,
+        faults: t.Union[str, float, None] = None,
+        scope: te.Literal["function", "class", "module", "session"] = "function",
+        substitutions: t.Union[bool, Substitutions, t.Callable[[Substitutions], Substitutions], None] = None,
     ) -> t.Callable[..., t.Any]:
         ...
 
@@ -71,12 +111,205 @@ def pytest_addoption(parser):
         type=float,
     )
 
+    parser.addoption(
+        "--hoverfly-admin-timeout",
+        dest="hoverfly_admin_timeout",
+        default=30.0,
+        help="Timeout for requests to Hoverfly's admin API.",
+        type=float,
+    )
+
+    parser.addoption(
+        "--hoverfly-reuse-container",
+        dest="hoverfly_reuse_container",
+        action="store_true",
+        default=False,
+        help=(
+            "Leave Hoverfly container running after the session and reuse it in the next one. "
+            "A container is reused only if it was started with the same image and arguments."
+        ),
+    )
+
+    parser.addoption(
+        "--hoverfly-backend",
+        dest="hoverfly_backend",
+        default="docker",
+        help=(
+            "What serves simulations: a Hoverfly container (docker), a local Hoverfly binary (binary), "
+            "an in-process Python engine (python) or a backend of another plugin, see pytest_hoverfly_backend hook. "
+            "The python engine starts instantly and doesn't need Docker, but can't record."
+        ),
+    )
+
+    parser.addoption(
+        "--hoverfly-binary",
+        dest="hoverfly_binary",
+        default=BINARY,
+        help="Hoverfly executable for --hoverfly-backend=binary, looked up in PATH unless it's a path.",
+    )
+
+    parser.addoption(
+        "--hoverfly-compact",
+        dest="hoverfly_compact",
+        action="store_true",
+        default=False,
+        help="Remove redundant pairs from all simulations in --hoverfly-simulation-path and exit.",
+    )
+
+    parser.addoption(
+        "--hoverfly-build-image",
+        dest="hoverfly_build_image",
+        action="store_true",
+        default=False,
+        help=(
+            "Build a Docker image of --hoverfly-image with all simulations in --hoverfly-simulation-path, "
+            "print its name and exit. Sessions with the same simulations start Hoverfly from it."
+        ),
+    )
+
+    parser.addoption(
+        "--hoverfly-snapshot-repository",
+        dest="hoverfly_snapshot_repository",
+        default=None,
+        help=(
+            f"Repository of images built with --hoverfly-build-image, {SNAPSHOT_REPOSITORY} by default. "
+            "If it's given, a missing image is pulled from it."
+        ),
+    )
+
+    parser.addoption(
+        "--hoverfly-body-threshold",
+        dest="hoverfly_body_threshold",
+        default=None,
+        help=(
+            "When recording, store response bodies larger than this many bytes in a shared "
+            f"{BODIES_DIR} directory inside --hoverfly-simulation-path instead of the simulation file. "
+            "Identical bodies are stored once."
+        ),
+        type=int,
+    )
+
+    parser.addoption(
+        "--hoverfly-report",
+        dest="hoverfly_report",
+        action="store_true",
+        default=False,
+        help=(
+            "Report how many requests each test sent through Hoverfly, how many didn't match "
+            "the simulation, and latency and bytes per destination."
+        ),
+    )
+
+    parser.addoption(
+        "--hoverfly-report-json",
+        dest="hoverfly_report_json",
+        default=None,
+        help="Also save the report from --hoverfly-report to this file as JSON. Implies --hoverfly-report.",
+        type=Path,
+    )
+
+    parser.addoption(
+        "--hoverfly-durations",
+        dest="hoverfly_durations",
+        default=None,
+        metavar="N",
+        help=(
+            "Show N slowest phases of pytest-hoverfly's work, like starting Hoverfly or uploading "
+            "a simulation (N=0 for all)."
+        ),
+        type=int,
+    )
+
+    parser.addoption(
+        "--hoverfly-group-by-simulation",
+        dest="hoverfly_group_by_simulation",
+        action="store_true",
+        default=False,
+        help=(
+            "Run tests that use the same simulation one after another, so that it's uploaded once. "
+            "Tests may run in a different order and module or class fixtures may be set up more than once."
+        ),
+    )
+
+    parser.addoption(
+        "--hoverfly-background-teardown",
+        dest="hoverfly_background_teardown",
+        action="store_true",
+        default=False,
+        help=(
+            "Save recordings in background while the next tests run. Tests that replay a recording wait "
+            "until it's saved, and failures to save it are reported as errors of the test that recorded it."
+        ),
+    )
+
+    parser.addoption(
+        "--hoverfly-latency",
+        dest="hoverfly_latency",
+        action="append",
+        default=[],
+        metavar="DELAY[@URL_REGEX]",
+        help=(
+            "Delay responses of replayed simulations by this many milliseconds, or by a random delay from "
+            "lognormal:min=..,max=..,mean=..,median=.. distribution. Only for URLs (host and path) matching "
+            "the regex if it's given. May be repeated, the first matching delay applies."
+        ),
+    )
+
+    parser.addoption(
+        "--hoverfly-faults",
+        dest="hoverfly_faults",
+        default=None,
+        metavar="RATE[:STATUS]",
+        help=(
+            "Make this share of pairs of replayed simulations respond with an error, 503 unless STATUS is given. "
+            "The same pairs are picked in every run."
+        ),
+    )
+
     parser.addoption(
         "--hoverfly-args",
         dest="hoverfly_args",
         help="Arguments for hoverfly command. Passed as is.",
     )
 
+    parser.addini(
+        "hoverfly_sanitize",
+        type="linelist",
+        default=[],
+        help=(
+            "Rules to scrub recordings with, one per line: `header NAME`, `query NAME`, `body JSON_PATH` "
+            "or `regex PATTERN`, optionally followed by a replacement. Without it, the target is removed."
+        ),
+    )
+
+    parser.addini(
+        "hoverfly_sanitize_defaults",
+        type="bool",
+        default=True,
+        help="Also remove Authorization, User-Agent and other credentials from recordings.",
+    )
+
+
+def pytest_addhooks(pluginmanager):
+    pluginmanager.add_hookspecs(hooks)
+
+
+def pytest_cmdline_main(config):
+    if config.option.hoverfly_build_image:
+        repository = config.option.hoverfly_snapshot_repository or SNAPSHOT_REPOSITORY
+        directory = ensure_simulation_dir(config)
+        print(build_snapshot(DockerClient.from_env(), config.option.hoverfly_image, directory, repository))
+        return 0
+
+    if not config.option.hoverfly_compact:
+        return None
+
+    for path in find_simulations([ensure_simulation_dir(config)]):
+        result = compact_file(path)
+        print(f"{path}: {result.pairs_before} -> {result.pairs_after} pairs")
+
+    return 0
+
 
 @pytest.hookimpl(tryfirst=True, hookwrapper=True)
 def pytest_runtest_makereport(item):
@@ -99,6 +332,142 @@ def pytest_runtest_makereport(item):
 @pytest.hookimpl(tryfirst=True)
 def pytest_configure(config):
     config.addinivalue_line("markers", "hoverfly(simulation): run Hoverfly with the specified simulation")
+    # filled by hoverfly_instance, reported in pytest_terminal_summary
+    config._hoverfly_startup_timings = {}
+    # started by pytest_itemcollected, awaited by hoverfly_instance
+    config._hoverfly_background_container = None
+    # startup is reported as phases of the first test that needed Hoverfly
+    config._hoverfly_startup_reported = False
+    # simulations checked at collection, by path, and how long that took
+    config._hoverfly_prepared = {}
+    config._hoverfly_collection_timings = {}
+
+    try:
+        # latency and faults for all replayed simulations, tests may override them
+        config._hoverfly_profile = Profile.from_specs(config.option.hoverfly_latency, config.option.hoverfly_faults)
+    except ValueError as e:
+        raise pytest.UsageError(str(e)) from e
+
+    # applied to every recording
+    rules = config.getini("hoverfly_sanitize")
+    for hook_rules in config.hook.pytest_hoverfly_sanitize_rules(config=config):
+        rules.extend(hook_rules)
+    try:
+        config._hoverfly_sanitizer = Sanitizer.compile(rules, defaults=config.getini("hoverfly_sanitize_defaults"))
+    except ValueError as e:
+        raise pytest.UsageError(str(e)) from e
+
+    if config.option.hoverfly_report or config.option.hoverfly_report_json:
+        config.pluginmanager.register(TrafficReporter(config), "hoverfly-report")
+
+    config._hoverfly_writer = None
+    if config.option.hoverfly_background_teardown:
+        config._hoverfly_writer = BackgroundWriter()
+        config.pluginmanager.register(config._hoverfly_writer, "hoverfly-background")
+
+    if config.option.hoverfly_durations is not None:
+        config.pluginmanager.register(PhaseDurations(config), "hoverfly-durations")
+
+    try:
+        from . import async_fixtures
+    except ImportError:
+        # pytest-hoverfly[asyncio] is not installed
+        pass
+    else:
+        config.pluginmanager.register(async_fixtures, "hoverfly-asyncio")
+
+
+def pytest_itemcollected(item):
+    """Start Hoverfly as soon as the first test that needs it is collected,
+    so that container startup overlaps with collection of the remaining tests.
+    """
+    config = item.config
+    if config._hoverfly_background_container or config.option.collectonly:
+        return
+
+    # the python engine starts in milliseconds, no need to hide it
+    if config.option.hoverfly_backend != "docker":
+        return
+
+    if item.get_closest_marker(name="hoverfly"):
+        config._hoverfly_background_container = BackgroundContainer(**_container_kwargs(config))
+
+
+@pytest.hookimpl(trylast=True)
+def pytest_collection_modifyitems(config, items):
+    """Group tests by simulation if asked. Check simulations of collected tests, so that a missing
+    or broken file fails the run right away. Don't keep a container that was started for tests that got deselected.
+    """
+    if config.option.hoverfly_group_by_simulation:
+        # under pytest-xdist every worker does the same, and workers get consecutive tests
+        group_items(items, _simulation_key)
+
+    if config.option.hoverfly_simulation_path and not config.option.collectonly:
+        _prepare_simulations(config, items)
+
+    background_container = config._hoverfly_background_container
+    if background_container and not any(item.get_closest_marker(name="hoverfly") for item in items):
+        background_container.stop()
+        config._hoverfly_background_container = None
+
+
+def _simulation_key(item) -> t.Optional[t.Tuple[str, bool, bool]]:
+    marker = item.get_closest_marker(name="hoverfly")
+    if not marker or not (marker.args or "name" in marker.kwargs):
+        return None
+
+    name = extract_simulation_name_from_marker(marker)
+    if item.config.option.hoverfly_simulation_path:
+        # so that `name` and `name.json` are the same simulation
+        name = str(get_simulation_file(item.config, name))
+
+    return name, bool(marker.kwargs.get("record")), bool(marker.kwargs.get("stateful"))
+
+
+def _prepare_simulations(config, items) -> None:
+    replayed, recorded = set(), set()
+    for item in items:
+        marker = item.get_closest_marker(name="hoverfly")
+        if not marker or not (marker.args or "name" in marker.kwargs):
+            continue
+
+        path = get_simulation_file(config, extract_simulation_name_from_marker(marker))
+        record = marker.kwargs.get("record", False)
+        if record is True:
+            recorded.add(path)
+        elif record != "missing" or path.exists():
+            # record="missing" records from scratch if there's no simulation yet
+            replayed.add(path)
+
+    # these will be overwritten anyway
+    paths = replayed - recorded
+    if not paths:
+        return
+
+    with timed(config._hoverfly_collection_timings, "prepare"):
+        prepared, errors = prepare_simulations(paths, BodyStore(get_simulations_path(config) / BODIES_DIR))
+
+    if errors:
+        lines = "\n".join(f"  {path}: {error}" for path, error in errors.items())
+        raise pytest.UsageError(f"Invalid Hoverfly simulations:\n{lines}")
+
+    config._hoverfly_prepared = prepared
+
+
+def pytest_sessionfinish(session):
+    # in case hoverfly_instance was never requested
+    background_container = session.config._hoverfly_background_container
+    if background_container:
+        background_container.stop()
+
+
+def pytest_terminal_summary(terminalreporter, config):
+    timings = getattr(config, "_hoverfly_startup_timings", None)
+    if not timings or config.option.verbose < 1:
+        return
+
+    phases = ", ".join(f"{phase} {duration:.3f}s" for phase, duration in timings.items())
+    terminalreporter.write_line(f"Hoverfly started in {sum(timings.values()):.3f}s: {phases}")
 
 
 @pytest.hookimpl(tryfirst=True)
@@ -110,20 +479,100 @@ def pytest_runtest_setup(item):
 
     ensure_simulation_dir(item.config)
 
-    stateful = marker.kwargs.pop("stateful", False)
-    record = marker.kwargs.pop("record", False)
+    # a copy, the marker is shared by all parametrized tests
+    kwargs = dict(marker.kwargs)
+    stateful = kwargs.pop("stateful", False)
+    record = kwargs.pop("record", False)
+    asynchronous = kwargs.pop("asynchronous", False)
+    latency = kwargs.pop("latency", None)
+    faults = kwargs.pop("faults", None)
+    scope = kwargs.pop("scope", "function")
+    substitutions = kwargs.pop("substitutions", None)
+
+    if set(kwargs) - {"name"}:
+        raise RuntimeError(f"Unknown argments passed to @hoverfly: {kwargs}")
+
+    if record and item.config.option.hoverfly_backend == "python":
+        raise RuntimeError("Recording is not supported by the python backend, use --hoverfly-backend=docker")
+
+    if asynchronous and not item.config.pluginmanager.has_plugin("hoverfly-asyncio"):
+        raise RuntimeError(
+            "@hoverfly(asynchronous=True) needs pytest-asyncio and aiohttp: pip install pytest-hoverfly[asyncio]"
+        )
+
+    if record not in (True, False, "missing"):
+        raise RuntimeError(f"@hoverfly(record=...) must be True, False or 'missing', got: {record!r}")
+
+    if record == "missing" and stateful:
+        raise RuntimeError("@hoverfly(record='missing') can't be combined with stateful")
+
+    if (latency is not None or faults is not None) and record:
+        raise RuntimeError("@hoverfly(latency=..., faults=...) only apply to replayed simulations, not to recordings")
+
+    if scope not in SCOPES:
+        raise RuntimeError(f"@hoverfly(scope=...) must be one of {', '.join(SCOPES)}, got: {scope!r}")
+
+    if scope != "function" and record:
+        raise RuntimeError("@hoverfly(scope=...) only applies to replayed simulations, recordings are per test")
+
+    if substitutions not in (None, False) and record:
+        raise RuntimeError(
+            "@hoverfly(substitutions=...) only applies to replayed simulations, templates aren't recorded"
+        )
+
+    item._hoverfly_profile = _profile(item.config._hoverfly_profile, latency, faults)
+    item._hoverfly_scope = scope
+    item._hoverfly_substitutions = _substitutions(item, substitutions)
+
+    prefix = "_async" if asynchronous else ""
+    if record == "missing":
+        item.fixturenames.append(f"{prefix}_missing_simulation_recorder")
+    elif record:
+        item.fixturenames.append(
+            f"{prefix}_stateful_simulation_recorder" if stateful else f"{prefix}_simulation_recorder"
+        )
+    else:
+        item.fixturenames.append(f"{prefix}_simulation_replayer")
 
-    if set(marker.kwargs) - {"name"}:
-        raise RuntimeError(f"Unknown argments passed to @hoverfly: {marker.kwargs}")
+    if item.config.pluginmanager.has_plugin("hoverfly-report"):
+        item.fixturenames.append("_traffic_reporter")
 
-    if record:
-        item.fixturenames.append("_stateful_simulation_recorder" if stateful else "_simulation_recorder")
-    else:
-        item.fixturenames.append("_simulation_replayer")
+
+def _substitutions(item, substitutions) -> t.Optional[Substitutions]:
+    """Test parameters, updated with the marker's substitutions. None if the simulation isn't a template."""
+    if substitutions is None or substitutions is False:
+        return None
+
+    params = dict(item.callspec.params) if hasattr(item, "callspec") else {}
+    if callable(substitutions):
+        substitutions = substitutions(params)
+    if substitutions is not True:
+        params.update(substitutions)
+    return params
+
+
+def _profile(default: Profile, latency, faults) -> Profile:
+    """The marker's latency and faults replace those of command line options."""
+    try:
+        override = Profile.from_specs(latency, faults)
+    except ValueError as e:
+        raise RuntimeError(f"Invalid @hoverfly arguments: {e}") from e
+
+    return Profile(
+        delays=default.delays if latency is None else override.delays,
+        fault_rate=default.fault_rate if faults is None else override.fault_rate,
+        fault_status=default.fault_status if faults is None else override.fault_status,
+    )
 
 
 @pytest.fixture
-def _simulation_recorder(hoverfly_instance: Hoverfly, request, _patch_env):
+def _simulation_recorder(
+    hoverfly_client: HoverflyClient,
+    request,
+    _patch_env,
+    _body_store: BodyStore,
+    _phase_timings: t.Dict[str, float],
+):
     """Use to start Hoverfly and have it proxy-and-record all network requests.
     At the end of the test a `simulation.json` will appear in ${SIMULATIONS_DIR}.
 
@@ -132,137 +581,263 @@ def _simulation_recorder(hoverfly_instance: Hoverfly, request, _patch_env):
 
     See README.md for details on how to use the generated file.
     """
-    yield from _recorder(hoverfly_instance, request, stateful=False)
+    steps = record_simulation(hoverfly_client, request, _body_store, _phase_timings, stateful=False)
+    run(hoverfly_client, steps)
+    yield
+    run(hoverfly_client, steps)
 
 
 @pytest.fixture
-def _stateful_simulation_recorder(hoverfly_instance: Hoverfly, request, _patch_env):
+def _stateful_simulation_recorder(
+    hoverfly_client: HoverflyClient,
+    request,
+    _patch_env,
+    _body_store: BodyStore,
+    _phase_timings: t.Dict[str, float],
+):
     """Use this for stateful services, where response to the same request is not
     always the same. E.g. when you poll a service waiting for some job to finish.
 
     See also:
         https://docs.hoverfly.io/en/latest/pages/tutorials/basic/capturingsequences/capturingsequences.html
     """
-    yield from _recorder(hoverfly_instance, request, stateful=True)
+    steps = record_simulation(hoverfly_client, request, _body_store, _phase_timings, stateful=True)
+    run(hoverfly_client, steps)
+    yield
+    run(hoverfly_client, steps)
+
+
+@pytest.fixture
+def _missing_simulation_recorder(
+    hoverfly_client: HoverflyClient,
+    request,
+    _patch_env,
+    _body_store: BodyStore,
+    _phase_timings: t.Dict[str, float],
+):
+    """Replay the existing simulation, but let requests it has no match for through to real
+    services (Hoverfly's spy mode). At the end of the test only these requests are added
+    to the simulation. If there's no simulation yet, it's recorded from scratch.
+    """
+    steps = record_missing(hoverfly_client, request, _body_store, _phase_timings)
+    run(hoverfly_client, steps)
+    yield
+    run(hoverfly_client, steps)
 
 
 @pytest.fixture(scope="session")
 def hoverfly_instance(request) -> Hoverfly:
     """Returns Hoverfly's instance host and ports.
 
-    Two modes are supported:
+    Several modes are supported:
     1. Externally managed instance. You provide connection details via
-    environment variables, and nothing is done.
+    environment variables, and nothing is done. Ignored by the python and binary backends.
     Env vars:
         ${HOVERFLY_HOST}
         ${HOVERFLY_PROXY_PORT}
         ${HOVERFLY_ADMIN_PORT}
+    or, to give each pytest-xdist worker its own instance:
+        ${HOVERFLY_INSTANCES}=host:proxy_port:admin_port,host:proxy_port:admin_port,...
 
-    2. Instance managed by plugin. Container will be created and destroyed after.
-    """
-    yield from get_container(
-        create_container_kwargs={"command": request.config.option.hoverfly_args},
-        image=request.config.option.hoverfly_image,
-        timeout=request.config.option.hoverfly_start_timeout,
-    )
+    2. With --hoverfly-backend=python, an in-process engine that replays simulations.
 
+    3. With --hoverfly-backend=binary, a local Hoverfly process on free ports, stopped after.
 
-@pytest.fixture
-def _simulation_replayer(hoverfly_instance: Hoverfly, request, _patch_env):
-    """Upload given simulation file to Hoverfly and set it to simulate mode.
-    Clean up Hoverfly state at the end. If test failed and Hoverfly's last
-    log record is an error, print it. Usually that error is the reason for
-    test failure.
+    4. Instance managed by plugin. Container will be created and destroyed after,
+    unless --hoverfly-reuse-container is passed.
+    Under pytest-xdist every worker starts its own container. The container is started
+    in background during collection if any of the collected tests is marked with @hoverfly.
+
+    Other plugins may add backends with pytest_hoverfly_backend hook.
     """
-    # so that requests to hoverfly admin endpoint are not proxied :)
-    session = requests.Session()
-    session.trust_env = False
+    name = request.config.option.hoverfly_backend
+    backend = request.config.hook.pytest_hoverfly_backend(config=request.config, name=name)
+    if backend is None:
+        raise pytest.UsageError(f"Unknown Hoverfly backend: {name}")
 
-    filename = extract_simulation_name_from_request(request)
+    yield from backend
 
-    # noinspection PyTypeChecker
-    with open(get_simulations_path(request.config) / filename) as f:
-        data = f.read()
 
-    res = session.put(f"{hoverfly_instance.admin_endpoint}/simulation", data=data)
-    res.raise_for_status()
+@pytest.hookimpl(trylast=True)
+def pytest_hoverfly_backend(config, name: str) -> t.Optional[t.Iterator[Hoverfly]]:
+    if name == "python":
+        return _python_backend()
 
-    res = session.put(f"{hoverfly_instance.admin_endpoint}/hoverfly/mode", json={"mode": "simulate"})
-    res.raise_for_status()
+    if name == "binary":
+        return get_process(
+            binary=config.option.hoverfly_binary,
+            args=config.option.hoverfly_args,
+            timeout=config.option.hoverfly_start_timeout,
+            timings=config._hoverfly_startup_timings,
+        )
 
-    yield
+    if name == "docker":
+        return _docker_backend(config)
+
+    return None
+
+
+def _python_backend() -> t.Iterator[Hoverfly]:
+    engine = ReplayEngine()
+    try:
+        yield engine.start()
+    finally:
+        engine.stop()
+
+
+def _docker_backend(config) -> t.Iterator[Hoverfly]:
+    background_container = config._hoverfly_background_container
+    if not background_container:
+        yield from get_container(**_container_kwargs(config))
+        return
+
+    try:
+        yield background_container.result()
+    finally:
+        background_container.stop()
+
+
+def _container_kwargs(config) -> t.Dict[str, t.Any]:
+    return dict(
+        create_container_kwargs={"command": config.option.hoverfly_args},
+        image=config.option.hoverfly_image,
+        timeout=config.option.hoverfly_start_timeout,
+        reuse=config.option.hoverfly_reuse_container,
+        timings=config._hoverfly_startup_timings,
+        snapshot_of=get_simulations_path(config) if config.option.hoverfly_simulation_path else None,
+        snapshot_repository=config.option.hoverfly_snapshot_repository or SNAPSHOT_REPOSITORY,
+        pull_snapshot=config.option.hoverfly_snapshot_repository is not None,
+    )
+
+
+@pytest.fixture(scope="session")
+def hoverfly_client(hoverfly_instance: Hoverfly, request) -> HoverflyClient:
+    """Client for the admin API of `hoverfly_instance`, shared by all tests.
+    A simulation left loaded by the last test is deleted at the end of the session.
+    """
+    client = HoverflyClient(hoverfly_instance, timeout=request.config.option.hoverfly_admin_timeout)
+
+    yield client
+
+    try:
+        # with background teardown, recorders leave their simulations too
+        if client.loaded_simulation or request.config._hoverfly_writer:
+            client.delete_simulation()
+    finally:
+        client.close()
 
-    # see pytest_runtest_makereport
-    if request.node.rep_setup.passed and request.node.rep_call.failed:
-        resp = session.get(f"{hoverfly_instance.admin_endpoint}/logs")
-        resp.raise_for_status()
-        logs = resp.json()["logs"]
-        last_log = logs[-1]
-        if "error" in last_log:
-            print("----------------------------")
-            print("Hoverfly's log has an error!")
-            print(last_log["error"])
 
-    r = session.delete(f"{hoverfly_instance.admin_endpoint}/simulation")
-    r.raise_for_status()
+@pytest.fixture(scope="session")
+def _body_store(request) -> BodyStore:
+    """Response bodies shared by simulations. Kept for the whole session to cache bodies used by many tests."""
+    return BodyStore(ensure_simulation_dir(request.config) / BODIES_DIR)
 
 
 @pytest.fixture
-def _patch_env(request, hoverfly_instance: Hoverfly):
-    os.environ["HTTP_PROXY"] = hoverfly_instance.proxy_url
-    os.environ["HTTPS_PROXY"] = hoverfly_instance.proxy_url
+def _phase_timings(request, hoverfly_instance: Hoverfly) -> t.Dict[str, float]:
+    """Durations of phases of pytest-hoverfly's work in the test.
+    Passed to pytest_hoverfly_phase_timing hook when the test ends.
+    """
+    config = request.config
+    timings: t.Dict[str, float] = {}
+    if not config._hoverfly_startup_reported:
+        config._hoverfly_startup_reported = True
+        timings.update(config._hoverfly_collection_timings)
+        timings.update(config._hoverfly_startup_timings)
 
-    # So that aiohttp and requests trust hoverfly
-    # Default cert is from
-    # https://hoverfly.readthedocs.io/en/latest/pages/tutorials/basic/https/https.html
-    path_to_cert = request.config.option.hoverfly_cert
-    if not path_to_cert.exists():
-        raise ValueError(f"Cert file not found: {path_to_cert}")
+    yield timings
 
-    os.environ["SSL_CERT_FILE"] = str(path_to_cert)
-    os.environ["REQUESTS_CA_BUNDLE"] = str(path_to_cert)
+    for phase, duration in timings.items():
+        config.hook.pytest_hoverfly_phase_timing(
+            config=config, nodeid=request.node.nodeid, phase=phase, duration=duration
+        )
 
-    yield
+    if config.pluginmanager.has_plugin("hoverfly-durations"):
+        request.node.user_properties.append((PHASE_TIMINGS_PROPERTY, json.dumps(timings)))
 
-    del os.environ["HTTP_PROXY"]
-    del os.environ["HTTPS_PROXY"]
-    del os.environ["SSL_CERT_FILE"]
-    del os.environ["REQUESTS_CA_BUNDLE"]
 
+@pytest.fixture
+def _simulation_replayer(
+    hoverfly_client: HoverflyClient,
+    request,
+    _body_store: BodyStore,
+    _phase_timings: t.Dict[str, float],
+):
+    """Upload given simulation file to Hoverfly and set it to simulate mode.
+    If the same simulation is already loaded, only restore Hoverfly state, so
+    that stateful sequences start over. If test failed and Hoverfly's last
+    log record is an error, print it. Usually that error is the reason for
+    test failure.
 
-def _recorder(hoverfly_instance: Hoverfly, request, stateful: bool):
-    filename = extract_simulation_name_from_request(request)
+    Environment is patched and the simulation file is checked once per @hoverfly(scope=...).
+    """
+    get_scoped_fixture(request, "_patch_env")
+    loaded = get_scoped_fixture(request, "_loaded_simulations")
+    steps = replay_simulation(hoverfly_client, request, _body_store, _phase_timings, loaded)
+    run(hoverfly_client, steps)
+    yield
+    run(hoverfly_client, steps)
 
-    # so that requests to hoverfly admin endpoint are not proxied :)
-    session = requests.Session()
-    session.trust_env = False
 
-    resp = session.put(
-        f"{hoverfly_instance.admin_endpoint}/hoverfly/mode",
-        json={
-            "mode": "capture",
-            # capture all headers
-            "arguments": {"headersWhitelist": ["*"], "stateful": stateful},
-        },
-    )
-    resp.raise_for_status()
+@pytest.fixture
+def _traffic_reporter(hoverfly_client: HoverflyClient, request, _phase_timings: t.Dict[str, float]):
+    """Aggregate Hoverfly's journal of the test into a report, see --hoverfly-report."""
+    with timed(_phase_timings, "journal"):
+        hoverfly_client.delete_journal()
 
     yield
 
-    resp = session.get(f"{hoverfly_instance.admin_endpoint}/simulation")
-    data = resp.json()
+    with timed(_phase_timings, "journal"):
+        report = TrafficReport.from_journal(request.node.nodeid, hoverfly_client.iter_journal())
+    request.node.user_properties.append((REPORT_PROPERTY, json.dumps(report.as_dict())))
 
-    # Delete common sensitive or excess data
-    for pair in data["data"]["pairs"]:
-        del_header(pair, "Authorization")
-        del_header(pair, "User-Agent")
-        del_header(pair, "X-Goog-Api-Client")
-        del_header(pair, "Private-Token")
-        del_gcloud_credentials(pair)
 
-    # noinspection PyTypeChecker
-    with open(get_simulations_path(request.config) / filename, "w+") as f:
-        json.dump(data, f, indent=2)
+@contextlib.contextmanager
+def _patched_env(hoverfly_instance: Hoverfly, default_cert: Path) -> t.Iterator[None]:
+    # So that aiohttp and requests trust hoverfly
+    # Default cert is from
+    # https://hoverfly.readthedocs.io/en/latest/pages/tutorials/basic/https/https.html
+    path_to_cert = hoverfly_instance.cert or default_cert
+    if not path_to_cert.exists():
+        raise ValueError(f"Cert file not found: {path_to_cert}")
 
-    r = session.delete(f"{hoverfly_instance.admin_endpoint}/simulation")
-    r.raise_for_status()
+    patch = {
+        "HTTP_PROXY": hoverfly_instance.proxy_url,
+        "HTTPS_PROXY": hoverfly_instance.proxy_url,
+        "SSL_CERT_FILE": str(path_to_cert),
+        "REQUESTS_CA_BUNDLE": str(path_to_cert),
+    }
+    # restored rather than deleted, a broader scope may have patched them already
+    saved = {name: os.environ.get(name) for name in patch}
+    os.environ.update(patch)
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+def _scoped_fixtures(scope: str) -> t.Tuple[t.Callable[..., t.Any], t.Callable[..., t.Any]]:
+    prefix = "" if scope == "function" else f"_{scope}"
+
+    @pytest.fixture(scope=scope, name=f"{prefix}_patch_env")
+    def patch_env(request, hoverfly_instance: Hoverfly):
+        """Send requests of HTTP clients through Hoverfly and make clients trust its certificate."""
+        with _patched_env(hoverfly_instance, request.config.option.hoverfly_cert):
+            yield
+
+    @pytest.fixture(scope=scope, name=f"{prefix}_loaded_simulations")
+    def loaded_simulations() -> t.Dict[t.Tuple[Path, Profile], t.Optional[str]]:
+        """What tests of the scope loaded: HoverflyClient.loaded_simulation by a file and a profile."""
+        return {}
+
+    return patch_env, loaded_simulations
+
+
+_patch_env, _loaded_simulations = _scoped_fixtures("function")
+_class_patch_env, _class_loaded_simulations = _scoped_fixtures("class")
+_module_patch_env, _module_loaded_simulations = _scoped_fixtures("module")
+_session_patch_env, _session_loaded_simulations = _scoped_fixtures("session")
@@ -0,0 +1,167 @@
+from __future__ import annotations
+
+import base64
+import dataclasses as dc
+import json
+import typing as t
+from pathlib import Path
+
+
+# Prefix of the response Hoverfly sends when no pair matched a request
+UNMATCHED_BODY_PREFIX = "Hoverfly Error!"
+# Name of the test's user property holding its report
+REPORT_PROPERTY = "hoverfly_traffic"
+
+
+@dc.dataclass
+class DestinationStats:
+    requests: int = 0
+    # milliseconds, as in Hoverfly's journal
+    latency: float = 0.0
+    max_latency: float = 0.0
+    request_bytes: int = 0
+    response_bytes: int = 0
+
+    def add(self, other: DestinationStats) -> None:
+        self.requests += other.requests
+        self.latency += other.latency
+        self.max_latency = max(self.max_latency, other.max_latency)
+        self.request_bytes += other.request_bytes
+        self.response_bytes += other.response_bytes
+
+
+@dc.dataclass
+class TrafficReport:
+    """Requests a test sent through Hoverfly, aggregated from Hoverfly's journal."""
+
+    nodeid: str
+    requests: int = 0
+    unmatched: int = 0
+    destinations: t.Dict[str, DestinationStats] = dc.field(default_factory=dict)
+
+    @property
+    def matched(self) -> int:
+        return self.requests - self.unmatched
+
+    @property
+    def latency(self) -> float:
+        return sum(d.latency for d in self.destinations.values())
+
+    @classmethod
+    def from_journal(cls, nodeid: str, entries: t.Iterable[t.Mapping[str, t.Any]]) -> TrafficReport:
+        report = cls(nodeid)
+        for entry in entries:
+            request, response = entry.get("request") or {}, entry.get("response") or {}
+            latency = float(entry.get("latency") or 0.0)
+
+            report.requests += 1
+            if is_unmatched(response):
+                report.unmatched += 1
+
+            stats = report.destinations.setdefault(request.get("destination", ""), DestinationStats())
+            stats.add(
+                DestinationStats(
+                    requests=1,
+                    latency=latency,
+                    max_latency=latency,
+                    request_bytes=_body_size(request),
+                    response_bytes=_body_size(response),
+                )
+            )
+
+        return report
+
+    def as_dict(self) -> t.Dict[str, t.Any]:
+        return {**dc.asdict(self), "matched": self.matched}
+
+    @classmethod
+    def from_dict(cls, data: t.Mapping[str, t.Any]) -> TrafficReport:
+        destinations = {name: DestinationStats(**stats) for name, stats in data["destinations"].items()}
+        return cls(data["nodeid"], data["requests"], data["unmatched"], destinations)
+
+
+def is_unmatched(response: t.Mapping[str, t.Any]) -> bool:
+    return response.get("status") == 502 and (response.get("body") or "").startswith(UNMATCHED_BODY_PREFIX)
+
+
+def _body_size(message: t.Mapping[str, t.Any]) -> int:
+    body = message.get("body") or ""
+    return len(base64.b64decode(body)) if message.get("encodedBody") else len(body.encode())
+
+
+def by_destination(reports: t.Iterable[TrafficReport]) -> t.Dict[str, DestinationStats]:
+    total: t.Dict[str, DestinationStats] = {}
+    for report in reports:
+        for name, stats in report.destinations.items():
+            total.setdefault(name, DestinationStats()).add(stats)
+
+    return total
+
+
+def format_summary(reports: t.Sequence[TrafficReport], top: int = 10) -> t.List[str]:
+    lines = [
+        f"{sum(r.requests for r in reports)} requests in {len(reports)} tests, "
+        f"{sum(r.unmatched for r in reports)} unmatched",
+        "Tests with most requests:",
+    ]
+    for report in sorted(reports, key=lambda r: r.requests, reverse=True)[:top]:
+        lines.append(
+            f"  {report.requests:6d} requests {report.unmatched:6d} unmatched {report.latency:10.1f}ms  {report.nodeid}"
+        )
+
+    lines.append("Destinations:")
+    destinations = sorted(by_destination(reports).items(), key=lambda item: item[1].requests, reverse=True)
+    for name, stats in destinations:
+        lines.append(
+            f"  {stats.requests:6d} requests {stats.latency / stats.requests:8.1f}ms avg "
+            f"{stats.max_latency:8.1f}ms max "
+            f"{stats.request_bytes:10d}B sent {stats.response_bytes:10d}B received  {name}"
+        )
+
+    return lines
+
+
+def write_report(path: Path, reports: t.Iterable[TrafficReport]) -> None:
+    reports = list(reports)
+    data = {
+        "tests": [r.as_dict() for r in reports],
+        "destinations": {name: dc.asdict(stats) for name, stats in by_destination(reports).items()},
+    }
+    with open(path, "w") as f:
+        json.dump(data, f, indent=2)
+
+
+class TrafficReporter:
+    """Collects traffic reports of tests, see --hoverfly-report.
+
+    Reports travel as a user property of the teardown report, so they reach
+    the JUnit XML and, with pytest-xdist, the controller process.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.reports: t.List[TrafficReport] = []
+
+    def pytest_runtest_logreport(self, report) -> None:
+        if report.when != "teardown":
+            return
+
+        for name, value in report.user_properties:
+            if name == REPORT_PROPERTY:
+                self.reports.append(TrafficReport.from_dict(json.loads(value)))
+
+    def pytest_terminal_summary(self, terminalreporter) -> None:
+        if not self.reports:
+            return
+
+        terminalreporter.section("Hoverfly traffic")
+        for line in format_summary(self.reports):
+            terminalreporter.write_line(line)
+
+    def pytest_sessionfinish(self, session) -> None:
+        path = self.config.option.hoverfly_report_json
+        # xdist workers only see their own tests, the controller writes the report
+        if path is None or hasattr(self.config, "workerinput"):
+            return
+
+        write_report(path, self.reports)
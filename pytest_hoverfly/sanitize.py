@@ -0,0 +1,239 @@
+"""Rules that scrub recordings before they are saved, see `hoverfly_sanitize` ini option.
+
+A rule is `KIND TARGET [REPLACEMENT]`:
+    header NAME - request and response headers, case-insensitive;
+    query NAME - request query parameters;
+    body JSON_PATH - fields of JSON request and response bodies, e.g. `$.token` or `$.items[*].id`;
+    regex PATTERN - matches in response bodies.
+Without a replacement, what the rule targets is removed. A replacement of a body field is parsed
+as JSON if it can be, e.g. `0` or `null`, and is a string otherwise.
+
+Requests are matched against recorded values, so a replacement would match only requests that
+send it. Instead, replaced request headers and query parameters match any value, and request
+body fields are removed, whether there is a replacement or not, and match any value too.
+"""
+from __future__ import annotations
+
+import dataclasses as dc
+import json
+import re
+import typing as t
+
+from .helpers import del_gcloud_credentials
+
+
+# What the recorder has always removed
+DEFAULT_RULES = (
+    "header Authorization",
+    "header User-Agent",
+    "header X-Goog-Api-Client",
+    "header Private-Token",
+)
+# Any key of an object or item of an array
+WILDCARD = "*"
+# Matchers of JSON request bodies
+JSON_BODY_MATCHERS = frozenset(("exact", "json", "jsonpartial"))
+# Put in place of a replaced request header or query parameter
+ANY_VALUE_MATCHER = {"matcher": "glob", "value": "*"}
+# Replacement of body fields that are removed
+REMOVE = object()
+
+_PATH_STEP = re.compile(r"\.([^.\[\]]+)|\[(\d+|\*)\]")
+_MISSING = object()
+
+PathStep = t.Union[str, int]
+
+
+@dc.dataclass(frozen=True)
+class BodyRule:
+    path: t.Tuple[PathStep, ...]
+    # JSON value, or REMOVE
+    replacement: t.Any = REMOVE
+
+
+@dc.dataclass(frozen=True)
+class Sanitizer:
+    """Rules compiled once per session and applied to all pairs of a recording in one pass."""
+
+    # by lowercase name, None removes the header or parameter
+    headers: t.Mapping[str, t.Optional[str]] = dc.field(default_factory=dict)
+    query: t.Mapping[str, t.Optional[str]] = dc.field(default_factory=dict)
+    body: t.Tuple[BodyRule, ...] = ()
+    patterns: t.Tuple[t.Tuple[t.Pattern[str], str], ...] = ()
+    gcloud_credentials: bool = False
+
+    @classmethod
+    def compile(cls, rules: t.Iterable[str], defaults: bool = True) -> Sanitizer:
+        """Raises ValueError if a rule is invalid. With `defaults`, DEFAULT_RULES go first and
+        credentials sent to Google's OAuth server are removed.
+        """
+        headers: t.Dict[str, t.Optional[str]] = {}
+        query: t.Dict[str, t.Optional[str]] = {}
+        body = []
+        patterns = []
+
+        for rule in [*DEFAULT_RULES, *rules] if defaults else rules:
+            kind, target, replacement = _split(rule)
+            if kind == "header":
+                headers[target.lower()] = replacement
+            elif kind == "query":
+                query[target.lower()] = replacement
+            elif kind == "body":
+                body.append(BodyRule(parse_path(target), REMOVE if replacement is None else _json_value(replacement)))
+            elif kind == "regex":
+                try:
+                    patterns.append((re.compile(target), replacement or ""))
+                except re.error as e:
+                    raise ValueError(f"Invalid sanitizer rule {rule!r}: {e}") from e
+            else:
+                raise ValueError(f"Invalid sanitizer rule {rule!r}: expected header, query, body or regex")
+
+        return cls(headers, query, tuple(body), tuple(patterns), gcloud_credentials=defaults)
+
+    def apply(self, data: t.Dict[str, t.Any]) -> None:
+        for pair in data["data"]["pairs"]:
+            self._sanitize_request(pair["request"])
+            self._sanitize_response(pair["response"])
+            if self.gcloud_credentials:
+                del_gcloud_credentials(pair)
+
+    def _sanitize_request(self, request: t.Dict[str, t.Any]) -> None:
+        headers = request.get("headers") or {}
+        _loosen_matchers(headers, self.headers)
+        _loosen_matchers(request.get("query") or {}, self.query)
+
+        if not self.body:
+            return
+
+        changed = False
+        for matcher in request.get("body") or []:
+            if matcher.get("matcher", "").lower() not in JSON_BODY_MATCHERS:
+                continue
+
+            value = _load_json(matcher.get("value"))
+            if not any([_apply_path(value, rule.path, REMOVE) for rule in self.body]):
+                continue
+
+            # requests with any value of the removed fields match, formatting doesn't matter either
+            matcher["matcher"] = "jsonPartial"
+            matcher["value"] = json.dumps(value)
+            changed = True
+
+        if changed:
+            _pop_header(headers, "content-length")
+
+    def _sanitize_response(self, response: t.Dict[str, t.Any]) -> None:
+        headers = response.get("headers") or {}
+        for name in list(headers):
+            replacement = self.headers.get(name.lower(), _MISSING)
+            if replacement is None:
+                del headers[name]
+            elif replacement is not _MISSING:
+                headers[name] = [replacement for _ in headers[name]]
+
+        body = response.get("body")
+        if not body or response.get("encodedBody") or (not self.body and not self.patterns):
+            return
+
+        if self.body:
+            value = _load_json(body)
+            if any([_apply_path(value, rule.path, rule.replacement) for rule in self.body]):
+                body = json.dumps(value)
+        for pattern, replacement in self.patterns:
+            body = pattern.sub(replacement, body)
+
+        if body != response["body"]:
+            response["body"] = body
+            # Hoverfly would send the length of the original body
+            _pop_header(headers, "content-length")
+
+
+def parse_path(path: str) -> t.Tuple[PathStep, ...]:
+    """`$.key`, `$.key[0]`, `$.items[*].id` and so on."""
+    if not path.startswith("$"):
+        raise ValueError(f"JSON path must start with $, got: {path!r}")
+
+    steps: t.List[PathStep] = []
+    position = 1
+    while position < len(path):
+        match = _PATH_STEP.match(path, position)
+        if not match:
+            raise ValueError(f"Invalid JSON path {path!r} at {path[position:]!r}")
+        key, index = match.groups()
+        steps.append(key if key is not None else WILDCARD if index == WILDCARD else int(index))
+        position = match.end()
+
+    if not steps:
+        raise ValueError(f"JSON path must point to a field, got: {path!r}")
+    return tuple(steps)
+
+
+def _split(rule: str) -> t.Tuple[str, str, t.Optional[str]]:
+    parts = rule.split(maxsplit=2)
+    if len(parts) < 2:
+        raise ValueError(f"Invalid sanitizer rule {rule!r}: expected `KIND TARGET [REPLACEMENT]`")
+
+    return parts[0], parts[1], parts[2] if len(parts) == 3 else None
+
+
+def _loosen_matchers(fields: t.Dict[str, t.Any], rules: t.Mapping[str, t.Optional[str]]) -> None:
+    for name in list(fields):
+        replacement = rules.get(name.lower(), _MISSING)
+        if replacement is None:
+            del fields[name]
+        elif replacement is not _MISSING:
+            # a request with any value matches, as long as it has one
+            fields[name] = [dict(ANY_VALUE_MATCHER)]
+
+
+def _pop_header(headers: t.Dict[str, t.Any], name: str) -> None:
+    for header in [h for h in headers if h.lower() == name]:
+        del headers[header]
+
+
+def _json_value(text: str) -> t.Any:
+    try:
+        return json.loads(text)
+    except ValueError:
+        return text
+
+
+def _load_json(value: t.Any) -> t.Any:
+    if not isinstance(value, str) or value.lstrip()[:1] not in ("{", "["):
+        return _MISSING
+
+    try:
+        return json.loads(value)
+    except ValueError:
+        return _MISSING
+
+
+def _apply_path(value: t.Any, path: t.Tuple[PathStep, ...], replacement: t.Any) -> bool:
+    """Remove or replace what `path` points to in `value`. Tells whether anything changed."""
+    step, rest = path[0], path[1:]
+    if isinstance(value, dict):
+        keys: t.List[t.Any] = list(value) if step == WILDCARD else [step] if step in value else []
+    elif isinstance(value, list):
+        if step == WILDCARD:
+            keys = list(range(len(value)))
+        else:
+            keys = [step] if isinstance(step, int) and step < len(value) else []
+    else:
+        return False
+
+    changed = False
+    # from the end, so that removing array items doesn't shift the ones left to visit
+    for key in reversed(keys):
+        if rest:
+            changed |= _apply_path(value[key], rest, replacement)
+        elif replacement is REMOVE:
+            del value[key]
+            changed = True
+        else:
+            value[key] = replacement
+            changed = True
+
+    return changed
+
+
+DEFAULT_SANITIZER = Sanitizer.compile(())
@@ -0,0 +1,102 @@
+"""Docker images of Hoverfly with simulations baked in, see --hoverfly-build-image."""
+from __future__ import annotations
+
+import hashlib
+import io
+import tarfile
+import tempfile
+import typing as t
+from pathlib import Path
+
+from docker import DockerClient
+from docker.errors import APIError, ImageNotFound
+
+from .blobs import BODIES_DIR
+from .storage import file_digest
+
+
+SNAPSHOT_REPOSITORY = "pytest-hoverfly-simulations"
+SNAPSHOT_LABEL = "pytest-hoverfly.snapshot"
+# Where simulations are in the image
+SIMULATIONS_DIR = "/simulations"
+
+# Hoverfly resolves relative bodyFile against its working directory
+DOCKERFILE = """\
+FROM {image}
+COPY simulations {simulations}
+WORKDIR {simulations}/{bodies}
+LABEL {label}={key}
+"""
+
+
+def snapshot_key(image: str, directory: Path) -> str:
+    """Content hash of the simulations directory and the base image name."""
+    digest = hashlib.sha256(image.encode())
+    for path in sorted(p for p in directory.rglob("*") if p.is_file()):
+        digest.update(f"\0{path.relative_to(directory).as_posix()}\0{file_digest(path)}".encode())
+
+    return digest.hexdigest()[:16]
+
+
+def build_context(image: str, directory: Path, key: str) -> t.BinaryIO:
+    """Tar with a Dockerfile and the simulations, simulations may be too big to keep in memory."""
+    dockerfile = DOCKERFILE.format(
+        image=image, simulations=SIMULATIONS_DIR, bodies=BODIES_DIR, label=SNAPSHOT_LABEL, key=key
+    ).encode()
+
+    context = tempfile.TemporaryFile()
+    with tarfile.open(fileobj=context, mode="w") as tar:
+        info = tarfile.TarInfo("Dockerfile")
+        info.size = len(dockerfile)
+        tar.addfile(info, io.BytesIO(dockerfile))
+        tar.add(directory, arcname="simulations")
+        # so that WORKDIR exists even without body files
+        if not (directory / BODIES_DIR).exists():
+            info = tarfile.TarInfo(f"simulations/{BODIES_DIR}")
+            info.type = tarfile.DIRTYPE
+            info.mode = 0o755
+            tar.addfile(info)
+
+    context.seek(0)
+    return context
+
+
+def build_snapshot(docker: DockerClient, image: str, directory: Path, repository: str = SNAPSHOT_REPOSITORY) -> str:
+    """Build a snapshot image of simulations in `directory` on top of `image`. Returns its name."""
+    key = snapshot_key(image, directory)
+    tag = f"{repository}:{key}"
+    with build_context(image, directory, key) as context:
+        docker.images.build(fileobj=context, custom_context=True, tag=tag, rm=True)
+
+    return tag
+
+
+def find_snapshot(
+    docker: DockerClient,
+    image: str,
+    directory: Path,
+    repository: str = SNAPSHOT_REPOSITORY,
+    pull: bool = False,
+) -> t.Optional[str]:
+    """Name of the snapshot image of simulations in `directory` as they are now, if there's one.
+    With `pull`, it's looked for in the registry of `repository` too.
+    """
+    # hashing simulations takes a while, don't do it if there are no snapshots at all
+    if not pull and not docker.images.list(name=repository, filters={"label": SNAPSHOT_LABEL}):
+        return None
+
+    tag = f"{repository}:{snapshot_key(image, directory)}"
+    try:
+        docker.images.get(tag)
+        return tag
+    except ImageNotFound:
+        if not pull:
+            return None
+
+    try:
+        docker.images.pull(tag)
+    except APIError:
+        # including ImageNotFound: the simulations have changed since the snapshot was pushed
+        return None
+
+    return tag
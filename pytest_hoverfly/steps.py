@@ -0,0 +1,436 @@
+"""What fixtures do with Hoverfly's admin API, written once for sync and async tests.
+
+Functions here are generators of `Call`s of HoverflyClient methods, which AsyncHoverflyClient
+has too. `run` makes the calls with a HoverflyClient. `run_async` awaits them with an
+AsyncHoverflyClient and runs the code in between in a thread, since it reads and writes files.
+Steps of a fixture stop at TEST, and the rest of them is run after the test.
+"""
+from __future__ import annotations
+
+import asyncio
+import dataclasses as dc
+import datetime
+import json
+import re
+import sys
+import time
+import typing as t
+from pathlib import Path
+
+import typing_extensions as te
+
+from .base import Hoverfly
+from .blobs import BodyStore, uses_body_files
+from .compaction import compact_simulation
+from .helpers import get_request_simulation_file
+from .matching import UnsupportedMatcher, find_missing
+from .prepare import PreparedSimulation, prepare_simulation
+from .profiles import Profile
+from .report import is_unmatched
+from .sanitize import DEFAULT_SANITIZER, Sanitizer
+from .storage import (
+    file_digest,
+    iter_chunks,
+    read_simulation,
+    simulation_reader,
+    write_simulation,
+)
+from .templates import render_simulation
+from .timing import timed
+
+
+# How much is fetched from Hoverfly and printed when a test fails
+DIAGNOSTICS_JOURNAL_LIMIT = 100
+DIAGNOSTICS_LOGS_LIMIT = 20
+DIAGNOSTICS_UNMATCHED_LIMIT = 3
+DIAGNOSTICS_MAX_CHARS = 2000
+
+T = t.TypeVar("T")
+
+
+@dc.dataclass(frozen=True)
+class Call:
+    method: str
+    args: t.Tuple[t.Any, ...] = ()
+    kwargs: t.Mapping[str, t.Any] = dc.field(default_factory=dict)
+
+
+def call(method: str, *args: t.Any, **kwargs: t.Any) -> Call:
+    return Call(method, args, kwargs)
+
+
+# Yielded where the test runs
+TEST = Call("")
+
+Steps = t.Generator[Call, t.Any, T]
+
+
+class Client(te.Protocol):
+    """What steps read and set on both clients, besides calling them."""
+
+    hoverfly: Hoverfly
+    loaded_simulation: t.Optional[str]
+    initial_state: t.Dict[str, str]
+
+
+def run(client: t.Any, steps: Steps[T]) -> t.Optional[T]:
+    """Make calls of `steps` until they end or reach TEST. Returns what they return."""
+    send, value = steps.send, None
+    while True:
+        done, result = _advance(send, value)
+        if done:
+            return result
+        if result is TEST:
+            return None
+
+        try:
+            send, value = steps.send, getattr(client, result.method)(*result.args, **result.kwargs)
+        except Exception as e:
+            send, value = steps.throw, e
+
+
+async def run_async(client: t.Any, steps: Steps[T]) -> t.Optional[T]:
+    """Same as `run`, but awaits the calls and doesn't block the event loop on the rest."""
+    loop = asyncio.get_running_loop()
+    send, value = steps.send, None
+    while True:
+        done, result = await loop.run_in_executor(None, _advance, send, value)
+        if done:
+            return result
+        if result is TEST:
+            return None
+
+        try:
+            send, value = steps.send, await getattr(client, result.method)(*result.args, **result.kwargs)
+        except Exception as e:
+            send, value = steps.throw, e
+
+
+def _advance(send: t.Callable[[t.Any], Call], value: t.Any) -> t.Tuple[bool, t.Any]:
+    # StopIteration can't be set on a future
+    try:
+        return False, send(value)
+    except StopIteration as e:
+        return True, e.value
+
+
+def replay_simulation(
+    client: Client,
+    request,
+    body_store: BodyStore,
+    timings: t.Dict[str, float],
+    loaded: t.Dict[t.Hashable, t.Optional[str]],
+) -> Steps[None]:
+    """Load the simulation of the test, unless the last test of the scope has, see `_simulation_replayer`.
+    `loaded` is what tests of the scope loaded. If the test fails, print why Hoverfly might be the reason.
+    """
+    path = get_request_simulation_file(request)
+    profile = request.node._hoverfly_profile
+    prepared = _prepared_simulation(request, path, body_store, timings)
+    key = _loaded_key(path, profile, prepared)
+
+    if client.loaded_simulation and loaded.get(key) == client.loaded_simulation:
+        # loaded by a previous test of the scope, and nothing else was loaded since
+        with timed(timings, "state"):
+            yield call("put_state", client.initial_state)
+    else:
+        _wait_for_recording(request.config, path)
+        yield from load_simulation(client, path, body_store, timings, prepared, profile)
+        loaded[key] = client.loaded_simulation
+    started = time.time()
+
+    yield TEST
+
+    # see pytest_runtest_makereport
+    if request.node.rep_setup.passed and request.node.rep_call.failed:
+        with timed(timings, "logs"):
+            yield from print_diagnostics(since=started)
+
+
+def record_simulation(
+    client: Client, request, body_store: BodyStore, timings: t.Dict[str, float], stateful: bool
+) -> Steps[None]:
+    """Record all requests of the test, see `_simulation_recorder`."""
+    path = get_request_simulation_file(request)
+
+    # otherwise pairs of a previously replayed simulation would end up in the recording.
+    # Reused or external instances may have one loaded by someone else, so don't rely on loaded_simulation
+    with timed(timings, "delete"):
+        yield call("delete_simulation")
+
+    # capture all headers
+    with timed(timings, "mode"):
+        yield call("set_mode", "capture", {"headersWhitelist": ["*"], "stateful": stateful})
+
+    yield TEST
+
+    with timed(timings, "export"):
+        data = yield call("get_simulation")
+
+    yield from _write(request, path, timings, save_recording, data, path, body_store)
+
+
+def record_missing(client: Client, request, body_store: BodyStore, timings: t.Dict[str, float]) -> Steps[None]:
+    """Record only requests the simulation has no match for, see `_missing_simulation_recorder`."""
+    path = get_request_simulation_file(request)
+    _wait_for_recording(request.config, path)
+    if not path.exists():
+        yield from record_simulation(client, request, body_store, timings, stateful=False)
+        return
+
+    yield from load_simulation(client, path, body_store, timings, request.config._hoverfly_prepared.get(path))
+    # it's not in simulate mode anymore, so the next test must load it again
+    client.loaded_simulation = None
+    with timed(timings, "mode"):
+        yield call("set_mode", "spy")
+    with timed(timings, "journal"):
+        yield call("delete_journal")
+
+    yield TEST
+
+    with timed(timings, "export"):
+        journal = yield from read_journal()
+
+    yield from _write(request, path, timings, _add_missing, path, journal, body_store)
+
+
+def _write(request, path: Path, timings: t.Dict[str, float], save: t.Callable[..., None], *args: t.Any) -> Steps[None]:
+    """Save a recording with `save(*args, body_threshold, sanitizer)`, in background if there's a writer."""
+    config = request.config
+    args = (*args, config.option.hoverfly_body_threshold, config._hoverfly_sanitizer)
+    writer = config._hoverfly_writer
+    if writer:
+        # the next test loads or deletes a simulation anyway
+        writer.submit(request.node, path, save, *args)
+        return
+
+    with timed(timings, "write"):
+        save(*args)
+
+    with timed(timings, "delete"):
+        yield call("delete_simulation")
+
+
+def read_journal(page_size: int = 500) -> Steps[t.List[t.Dict[str, t.Any]]]:
+    """All journal entries, see HoverflyClient.iter_journal."""
+    entries: t.List[t.Dict[str, t.Any]] = []
+    while True:
+        page = yield call("get_journal", len(entries), page_size)
+        page_entries = page.get("journal") or []
+        entries.extend(page_entries)
+        if not page_entries or len(entries) >= page.get("total", len(entries)):
+            return entries
+
+
+def load_simulation(
+    client: Client,
+    path: Path,
+    body_store: BodyStore,
+    timings: t.Optional[t.Dict[str, float]] = None,
+    prepared: t.Optional[PreparedSimulation] = None,
+    profile: t.Optional[Profile] = None,
+) -> Steps[None]:
+    """Load the simulation into Hoverfly in simulate mode, unless it's loaded already.
+    If `timings` is given, it's filled with durations of phases. A simulation `prepared`
+    at collection is used unless the file has changed since. Latency and faults of `profile`
+    are added to the uploaded simulation. A `prepared` simulation rendered from a template is always used.
+    """
+    if prepared and not prepared.rendered and not prepared.is_current():
+        prepared = None
+
+    with timed(timings, "read"):
+        digest = prepared.digest if prepared else file_digest(path)
+    if profile:
+        # the same file with another profile is another simulation
+        digest = f"{digest}:{profile.key}"
+
+    if client.loaded_simulation == digest:
+        # deleting state would also delete steps of sequences Hoverfly sets on import
+        with timed(timings, "state"):
+            yield call("put_state", client.initial_state)
+        return
+
+    # if the upload fails midway, we don't know what's loaded
+    client.loaded_simulation = None
+    # Hoverfly started from a snapshot image has body files, no need to send them, unless
+    # a recording of this session wrote new ones. A rendered template exists only with bodies inlined
+    inline = not client.hoverfly.body_files or bool(body_store.written or (prepared and prepared.rendered))
+
+    if profile:
+        with timed(timings, "read"):
+            data = _read_inlined(path, body_store if inline else None, prepared)
+            profile.apply(data, seed=path.name)
+        with timed(timings, "upload"):
+            yield call("put_simulation", json.dumps(data))
+    elif inline and prepared and prepared.payload is not None:
+        with timed(timings, "upload"):
+            yield call("put_simulation", prepared.payload)
+    elif inline and body_store.directory.exists() and uses_body_files(path):
+        # Hoverfly may not have access to the store, so put bodies back in place
+        with timed(timings, "read"):
+            data = _read_inlined(path, body_store)
+        with timed(timings, "upload"):
+            yield call("put_simulation", json.dumps(data))
+    else:
+        # stream the file instead of reading it into memory, simulations may be huge.
+        # Reading is a part of the upload then
+        with timed(timings, "upload"), simulation_reader(path) as stream:
+            yield call("put_simulation", iter_chunks(stream))
+
+    with timed(timings, "mode"):
+        yield call("set_mode", "simulate")
+    with timed(timings, "state"):
+        client.initial_state = yield call("get_state")
+    client.loaded_simulation = digest
+
+
+def _read_inlined(
+    path: Path,
+    body_store: t.Optional[BodyStore],
+    prepared: t.Optional[PreparedSimulation] = None,
+) -> t.Dict[str, t.Any]:
+    """Read the simulation with bodies put back in place, unless there's no `body_store`."""
+    if body_store is None:
+        return read_simulation(path)
+
+    if prepared and prepared.payload is not None:
+        return json.loads(prepared.payload)
+
+    data = read_simulation(path)
+    body_store.inline(data)
+    return data
+
+
+def _prepared_simulation(
+    request,
+    path: Path,
+    body_store: BodyStore,
+    timings: t.Optional[t.Dict[str, float]] = None,
+) -> t.Optional[PreparedSimulation]:
+    """The simulation prepared at collection, or rendered for the test if it's a template."""
+    config = request.config
+    prepared = config._hoverfly_prepared.get(path)
+    substitutions = request.node._hoverfly_substitutions
+    if substitutions is None:
+        return prepared
+
+    with timed(timings, "render"):
+        if prepared is None or prepared.payload is None or not prepared.is_current():
+            _wait_for_recording(config, path)
+            # templates are kept in memory whatever their size, there are few of them
+            prepared = config._hoverfly_prepared[path] = prepare_simulation(
+                path, body_store, sys.maxsize, max_parsed_size=sys.maxsize
+            )
+
+        try:
+            return render_simulation(prepared, substitutions)
+        except ValueError as e:
+            raise RuntimeError(f"Can't render {path}: {e}") from e
+
+
+def _loaded_key(path: Path, profile: Profile, prepared: t.Optional[PreparedSimulation]) -> t.Hashable:
+    """Tells simulations loaded in a scope apart: renders of a template are different simulations."""
+    return (prepared.digest if prepared and prepared.rendered else path), profile
+
+
+def _wait_for_recording(config, path: Path) -> None:
+    """Wait until a recording of a previous test is written, see --hoverfly-background-teardown."""
+    if config._hoverfly_writer:
+        config._hoverfly_writer.wait_for(path)
+
+
+def save_recording(
+    data: t.Dict[str, t.Any],
+    path: Path,
+    body_store: BodyStore,
+    body_threshold: t.Optional[int],
+    sanitizer: t.Optional[Sanitizer] = DEFAULT_SANITIZER,
+) -> None:
+    """Sanitize, compact and write a recording. No `sanitizer` means it's sanitized already."""
+    if sanitizer is not None:
+        sanitizer.apply(data)
+
+    compact_simulation(data)
+    if body_threshold is not None:
+        body_store.externalize(data, body_threshold)
+    write_simulation(path, data)
+
+
+def _add_missing(
+    path: Path,
+    journal: t.List[t.Dict[str, t.Any]],
+    body_store: BodyStore,
+    body_threshold: t.Optional[int],
+    sanitizer: Sanitizer = DEFAULT_SANITIZER,
+) -> None:
+    data = read_simulation(path)
+    try:
+        missing = find_missing(data, journal)
+    except UnsupportedMatcher as e:
+        raise RuntimeError(f"Can't tell which requests are missing from {path}: {e}") from e
+
+    if missing:
+        # pairs already in the file have been sanitized when they were recorded
+        sanitizer.apply({"data": {"pairs": missing}})
+        data["data"]["pairs"].extend(missing)
+        save_recording(data, path, body_store, body_threshold, sanitizer=None)
+
+
+def print_diagnostics(since: float) -> Steps[None]:
+    """Print requests Hoverfly couldn't match, with the closest miss Hoverfly found for them,
+    or else the last error from Hoverfly's log. Only entries since the test started are fetched,
+    so it doesn't get slower as a long-running Hoverfly accumulates logs.
+    """
+    journal = yield call("get_journal", limit=DIAGNOSTICS_JOURNAL_LIMIT, since=since)
+    if not _print_unmatched(journal["journal"], since):
+        _print_log_error((yield call("get_logs", limit=DIAGNOSTICS_LOGS_LIMIT, since=since)), since)
+
+
+def _print_unmatched(journal: t.List[t.Dict[str, t.Any]], since: float) -> bool:
+    unmatched = [e for e in _logged_since(journal, "timeStarted", since) if is_unmatched(e.get("response") or {})]
+    if not unmatched:
+        return False
+
+    print("----------------------------")
+    print("Hoverfly couldn't match requests!")
+    for entry in unmatched[:DIAGNOSTICS_UNMATCHED_LIMIT]:
+        req = entry["request"]
+        print(f"{req.get('method')} {req.get('scheme')}://{req.get('destination')}{req.get('path')}")
+        print(_truncate(entry["response"]["body"]))
+    if len(unmatched) > DIAGNOSTICS_UNMATCHED_LIMIT:
+        print(f"...and {len(unmatched) - DIAGNOSTICS_UNMATCHED_LIMIT} more")
+    return True
+
+
+def _print_log_error(logs: t.List[t.Dict[str, t.Any]], since: float) -> None:
+    errors = [log["error"] for log in _logged_since(logs, "time", since) if "error" in log]
+    if errors:
+        print("----------------------------")
+        print("Hoverfly's log has an error!")
+        print(_truncate(errors[-1]))
+
+
+def _logged_since(entries: t.List[t.Dict[str, t.Any]], field: str, since: float) -> t.List[t.Dict[str, t.Any]]:
+    """Hoverfly filters entries by whole seconds or milliseconds, drop those of the previous test
+    logged in the same one.
+    """
+    return [e for e in entries if (_parse_time(e.get(field)) or since) >= since]
+
+
+def _parse_time(value: t.Optional[str]) -> t.Optional[float]:
+    if not value:
+        return None
+
+    # Hoverfly uses "Z" and up to 9 digits of a second, older Pythons understand neither
+    value = re.sub(r"\.\d+", lambda m: m.group()[:7].ljust(7, "0"), value.replace("Z", "+00:00"))
+    try:
+        return datetime.datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        return None
+
+
+def _truncate(text: str) -> str:
+    if len(text) <= DIAGNOSTICS_MAX_CHARS:
+        return text
+
+    return f"{text[:DIAGNOSTICS_MAX_CHARS]}... ({len(text) - DIAGNOSTICS_MAX_CHARS} more characters)"
@@ -0,0 +1,106 @@
+from __future__ import annotations
+
+import contextlib
+import gzip
+import hashlib
+import io
+import json
+import typing as t
+from pathlib import Path
+
+
+# Order matters: it's the order in which files are looked up when a simulation name has no suffix
+SIMULATION_SUFFIXES = (".json", ".json.gz", ".json.zst")
+CHUNK_SIZE = 1024 * 1024
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError as e:
+        raise RuntimeError(
+            "zstandard is required to work with .json.zst simulations. "
+            "Install it with `pip install pytest-hoverfly[zstd]`."
+        ) from e
+
+    return zstandard
+
+
+def has_simulation_suffix(name: str) -> bool:
+    return name.endswith(SIMULATION_SUFFIXES)
+
+
+def is_compressed(path: Path) -> bool:
+    return path.suffix in (".gz", ".zst")
+
+
+def file_digest(path: Path) -> str:
+    """Hash a file without reading it into memory at once."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter_chunks(f):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def iter_chunks(stream: t.BinaryIO, size: int = CHUNK_SIZE) -> t.Iterator[bytes]:
+    return iter(lambda: stream.read(size), b"")
+
+
+@contextlib.contextmanager
+def simulation_reader(path: Path) -> t.Iterator[t.BinaryIO]:
+    """Open a simulation for reading. Compressed files are decompressed on the fly."""
+    with open(path, "rb") as f:
+        if path.name.endswith(".gz"):
+            with gzip.GzipFile(fileobj=f) as g:
+                yield g
+        elif path.name.endswith(".zst"):
+            with _zstandard().ZstdDecompressor().stream_reader(f) as z:
+                yield z
+        else:
+            yield f
+
+
+@contextlib.contextmanager
+def simulation_writer(path: Path) -> t.Iterator[t.TextIO]:
+    """Open a simulation for writing. The file is compressed according to its suffix."""
+    if path.name.endswith(".gz"):
+        with gzip.open(path, "wt", encoding="utf-8") as f:
+            yield f
+    elif path.name.endswith(".zst"):
+        with open(path, "wb") as raw:
+            writer = _zstandard().ZstdCompressor().stream_writer(raw, closefd=False)
+            with io.TextIOWrapper(writer, encoding="utf-8") as f:
+                yield f
+    else:
+        with open(path, "w+") as f:
+            yield f
+
+
+def content_size(path: Path, limit: t.Optional[int] = None) -> int:
+    """Size of the simulation, decompressed. Compressed files are decompressed without keeping
+    them in memory, and only until `limit` is exceeded.
+    """
+    if not is_compressed(path):
+        return path.stat().st_size
+
+    size = 0
+    with simulation_reader(path) as stream:
+        for chunk in iter_chunks(stream):
+            size += len(chunk)
+            if limit is not None and size > limit:
+                break
+
+    return size
+
+
+def read_simulation(path: Path) -> t.Dict[str, t.Any]:
+    with simulation_reader(path) as stream:
+        return json.load(stream)
+
+
+def write_simulation(path: Path, data: t.Mapping[str, t.Any]) -> None:
+    with simulation_writer(path) as f:
+        # nobody reads compressed files, so don't waste space on indentation
+        json.dump(data, f, indent=None if is_compressed(path) else 2)
@@ -0,0 +1,39 @@
+"""Simulations rendered from a template for each test, see @hoverfly(..., substitutions=...)."""
+from __future__ import annotations
+
+import dataclasses as dc
+import hashlib
+import json
+import re
+import typing as t
+
+from .prepare import PreparedSimulation
+
+
+# Only inside JSON strings, so that templates are valid simulations themselves
+PLACEHOLDER = re.compile(r"\$\{(\w+)\}")
+
+Substitutions = t.Mapping[str, t.Any]
+
+
+def render(template: bytes, substitutions: Substitutions) -> bytes:
+    """Replace `${name}` placeholders with `str()` of values, escaped for JSON strings."""
+
+    def replace(match: t.Match[str]) -> str:
+        name = match.group(1)
+        if name not in substitutions:
+            raise ValueError(f"no substitution for ${{{name}}}")
+        return json.dumps(str(substitutions[name]))[1:-1]
+
+    return PLACEHOLDER.sub(replace, template.decode()).encode()
+
+
+def render_simulation(template: PreparedSimulation, substitutions: Substitutions) -> PreparedSimulation:
+    """Render a simulation prepared with its payload. Renders with the same content have the same
+    digest, so a simulation is uploaded again only when it's different.
+    """
+    if template.payload is None:
+        raise ValueError(f"{template.path} has to be kept in memory to be rendered")
+
+    payload = render(template.payload, substitutions)
+    return dc.replace(template, digest=hashlib.sha256(payload).hexdigest(), payload=payload, rendered=True)
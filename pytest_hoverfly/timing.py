@@ -0,0 +1,64 @@
+from __future__ import annotations
+
+import collections
+import contextlib
+import json
+import time
+import typing as t
+
+
+# Name of the test's user property holding durations of its phases
+PHASE_TIMINGS_PROPERTY = "hoverfly_phase_timings"
+
+
+@contextlib.contextmanager
+def timed(timings: t.Optional[t.Dict[str, float]], phase: str) -> t.Iterator[None]:
+    """Add duration of the block to `timings[phase]`, if `timings` is given."""
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        if timings is not None:
+            timings[phase] = timings.get(phase, 0.0) + time.monotonic() - start
+
+
+class PhaseDurations:
+    """Reports slowest phases of pytest-hoverfly's work, see --hoverfly-durations.
+
+    Durations travel as a user property of the teardown report, so that
+    with pytest-xdist they reach the controller process.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.durations: t.List[t.Tuple[float, str, str]] = []
+
+    def pytest_runtest_logreport(self, report) -> None:
+        if report.when != "teardown":
+            return
+
+        for name, value in report.user_properties:
+            if name == PHASE_TIMINGS_PROPERTY:
+                for phase, duration in json.loads(value).items():
+                    self.durations.append((duration, phase, report.nodeid))
+
+    def pytest_terminal_summary(self, terminalreporter) -> None:
+        if not self.durations:
+            return
+
+        limit = self.config.option.hoverfly_durations
+        durations = sorted(self.durations, reverse=True)
+        if limit:
+            terminalreporter.write_sep("=", f"slowest {limit} pytest-hoverfly phases")
+            durations = durations[:limit]
+        else:
+            terminalreporter.write_sep("=", "slowest pytest-hoverfly phases")
+
+        for duration, phase, nodeid in durations:
+            terminalreporter.write_line(f"{duration:.3f}s {phase:8s} {nodeid}")
+
+        totals: t.Dict[str, float] = collections.defaultdict(float)
+        for duration, phase, _ in self.durations:
+            totals[phase] += duration
+        phases = ", ".join(f"{phase} {total:.3f}s" for phase, total in sorted(totals.items(), key=lambda i: -i[1]))
+        terminalreporter.write_line(f"{sum(totals.values()):.3f}s in total: {phases}")
@@ -0,0 +1,98 @@
+from __future__ import annotations
+
+import asyncio
+import json
+from pathlib import Path
+
+import pytest
+
+from pytest_hoverfly.engine import ReplayEngine
+
+
+pytest.importorskip("aiohttp")
+pytest.importorskip("pytest_asyncio")
+
+from pytest_hoverfly.async_client import AsyncHoverflyClient  # noqa: E402
+
+
+CURDIR = Path(__file__).parent
+
+
+def test_async_client():
+    engine = ReplayEngine()
+    instance = engine.start()
+    simulation = (CURDIR / "simulations" / "stateful_job_simulation.json").read_bytes()
+
+    async def main():
+        async with AsyncHoverflyClient(instance) as client:
+            await client.put_simulation(simulation)
+            await client.set_mode("simulate")
+            assert await client.get_state() == {"sequence:1": "1"}
+            assert len((await client.get_simulation())["data"]["pairs"]) == len(json.loads(simulation)["data"]["pairs"])
+            assert (await client.get_journal())["journal"] == []
+
+    try:
+        asyncio.run(main())
+    finally:
+        engine.stop()
+
+
+def test_async_replayer(testdir):
+    testdir.makepyfile(
+        """
+import aiohttp
+import pytest
+from pytest_hoverfly import hoverfly
+
+
+@pytest.mark.asyncio
+@hoverfly('archive_org_simulation', asynchronous=True)
+async def test_simulation_replayer(async_hoverfly_client):
+    connector = aiohttp.TCPConnector(ssl=async_hoverfly_client.ssl_context)
+    async with aiohttp.ClientSession(trust_env=True, connector=connector) as session:
+        url = 'https://archive.org/metadata/SPD-SLRSY-1867/metadata/identifier'
+        # recorded with requests, which sends the Connection header
+        headers = {'Accept': 'application/json', 'Connection': 'keep-alive'}
+        async with session.get(url, headers=headers) as resp:
+            assert await resp.json() == {"result": "SPD-SLRSY-1867"}
+
+    assert async_hoverfly_client.loaded_simulation
+
+
+# the simulation loaded by the async test is reused
+@hoverfly('archive_org_simulation')
+def test_sync_after_async(hoverfly_client):
+    assert hoverfly_client.loaded_simulation
+    """
+    )
+
+    result = testdir.runpytest_subprocess(
+        "--hoverfly-simulation-path", str(CURDIR / "simulations"), "--hoverfly-backend", "python"
+    )
+
+    result.assert_outcomes(passed=2)
+
+
+def test_async_unmatched_requests_are_printed(testdir):
+    testdir.makepyfile(
+        """
+import aiohttp
+import pytest
+from pytest_hoverfly import hoverfly
+
+
+@pytest.mark.asyncio
+@hoverfly('archive_org_simulation', asynchronous=True)
+async def test_unmatched():
+    async with aiohttp.ClientSession(trust_env=True) as session:
+        async with session.get('http://archive.org/unmatched') as resp:
+            assert resp.status == 200
+    """
+    )
+
+    result = testdir.runpytest_subprocess(
+        "--hoverfly-simulation-path", str(CURDIR / "simulations"), "--hoverfly-backend", "python"
+    )
+
+    result.assert_outcomes(failed=1)
+    result.stdout.fnmatch_lines(["*Hoverfly couldn't match requests!*", "GET http://archive.org/unmatched"])
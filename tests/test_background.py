@@ -0,0 +1,67 @@
+from __future__ import annotations
+
+import threading
+import time
+from pathlib import Path
+
+from pytest_hoverfly.background import BackgroundWriter
+
+
+def test_wait_for_pending_write():
+    written = threading.Event()
+
+    def write():
+        time.sleep(0.05)
+        written.set()
+
+    writer = BackgroundWriter()
+    writer.submit(None, Path("simulation.json"), write)
+    # nothing to wait for
+    writer.wait_for(Path("other.json"))
+
+    writer.wait_for(Path("simulation.json"))
+    assert written.is_set()
+    writer.pytest_sessionfinish(None)
+
+
+def test_failed_write_is_reported_on_its_test(testdir):
+    testdir.makeconftest(
+        """
+import time
+from pathlib import Path
+
+import pytest
+
+
+def _fail():
+    time.sleep(0.05)
+    raise OSError("No space left on device")
+
+
+@pytest.fixture
+def recording(request):
+    yield
+    request.config._hoverfly_writer.submit(request.node, Path("simulation.json"), _fail)
+    """
+    )
+    testdir.makepyfile(
+        """
+def test_recorded(recording):
+    pass
+
+
+def test_next():
+    pass
+    """
+    )
+
+    result = testdir.runpytest_subprocess("--hoverfly-background-teardown")
+
+    result.assert_outcomes(passed=2, errors=1)
+    result.stdout.fnmatch_lines(
+        [
+            "*ERROR at teardown of test_recorded*",
+            "Saving the recording in background failed:",
+            "*OSError: No space left on device",
+        ]
+    )
@@ -0,0 +1,146 @@
+from __future__ import annotations
+
+import base64
+import copy
+import dataclasses as dc
+from pathlib import Path
+
+from pytest_hoverfly.blobs import (
+    BODIES_DIR,
+    BodyStore,
+    uses_body_files,
+)
+from pytest_hoverfly.client import HoverflyClient
+from pytest_hoverfly.engine import ReplayEngine
+from pytest_hoverfly.steps import load_simulation, run
+from pytest_hoverfly.storage import read_simulation, write_simulation
+
+
+CURDIR = Path(__file__).parent
+
+
+def _simulation(*bodies, encoded=False):
+    pairs = [
+        {
+            "request": {"path": [{"matcher": "exact", "value": f"/{i}"}]},
+            "response": {"status": 200, "body": body, "encodedBody": encoded},
+        }
+        for i, body in enumerate(bodies)
+    ]
+    return {"data": {"pairs": pairs}}
+
+
+def test_large_bodies_are_stored_once(tmp_path):
+    store = BodyStore(tmp_path)
+    data = _simulation("small", "x" * 100, "x" * 100)
+
+    assert store.externalize(data, threshold=10) == 2
+
+    responses = [p["response"] for p in data["data"]["pairs"]]
+    assert responses[0] == {"status": 200, "body": "small", "encodedBody": False}
+    assert responses[1]["body"] == ""
+    assert responses[1]["bodyFile"] == responses[2]["bodyFile"]
+    assert [p.name for p in tmp_path.iterdir()] == [responses[1]["bodyFile"]]
+
+
+def test_bodies_are_inlined_back(tmp_path):
+    store = BodyStore(tmp_path)
+    binary = base64.b64encode(bytes(range(256))).decode()
+    original = _simulation(binary, encoded=True)
+    data = copy.deepcopy(original)
+    store.externalize(data, threshold=0)
+
+    # a fresh store reads bodies from disk
+    assert BodyStore(tmp_path).inline(data) == 1
+    assert data == original
+
+
+def test_unknown_body_files_are_left_to_hoverfly(tmp_path):
+    data = _simulation("")
+    data["data"]["pairs"][0]["response"]["bodyFile"] = "responses/report.pdf"
+
+    assert BodyStore(tmp_path).inline(data) == 0
+    assert data["data"]["pairs"][0]["response"]["bodyFile"] == "responses/report.pdf"
+
+
+def test_cache_is_bounded(tmp_path):
+    store = BodyStore(tmp_path, cache_size=10)
+    first, second = store.put(b"a" * 6), store.put(b"b" * 6)
+
+    assert store.get(first) == b"a" * 6
+    assert store.get(second) == b"b" * 6
+    assert list(store._cache) == [second]
+
+
+def test_uses_body_files(tmp_path):
+    data = _simulation("x" * 100)
+    path = tmp_path / "simulation.json.gz"
+    write_simulation(path, data)
+    assert not uses_body_files(path)
+
+    BodyStore(tmp_path / BODIES_DIR).externalize(data, threshold=10)
+    write_simulation(path, data)
+    assert uses_body_files(path)
+
+
+def test_externalized_bodies_are_replayed(testdir):
+    simulations = testdir.mkdir("simulations")
+    data = read_simulation(CURDIR / "simulations" / "archive_org_simulation.json")
+    BodyStore(Path(simulations) / BODIES_DIR).externalize(data, threshold=0)
+    write_simulation(Path(simulations) / "archive_org_simulation.json", data)
+
+    testdir.makepyfile(
+        """
+import requests
+from pytest_hoverfly import hoverfly
+
+
+@hoverfly('archive_org_simulation')
+def test_simulation_replayer():
+    resp = requests.get(
+        'https://archive.org/metadata/SPD-SLRSY-1867/metadata/identifier',
+        headers={'Accept': 'application/json'},
+    )
+
+    assert resp.json() == {"result": "SPD-SLRSY-1867"}
+    """
+    )
+
+    result = testdir.runpytest_subprocess(
+        "--hoverfly-simulation-path", str(simulations), "--hoverfly-backend", "python"
+    )
+
+    result.assert_outcomes(passed=1)
+
+
+def test_written_bodies_are_tracked(tmp_path):
+    BodyStore(tmp_path).put(b"old")
+    store = BodyStore(tmp_path)
+
+    store.put(b"old")
+    assert not store.written
+    assert store.written == {store.put(b"new")}
+
+
+def test_bodies_recorded_by_session_are_sent_to_snapshot(tmp_path):
+    """A snapshot image has only body files that existed when it was built."""
+    engine = ReplayEngine()
+    client = HoverflyClient(dc.replace(engine.start(), body_files=True))
+    store = BodyStore(tmp_path / BODIES_DIR)
+    path = tmp_path / "simulation.json"
+    data = _simulation("x" * 100)
+    store.externalize(data, threshold=10)
+    write_simulation(path, data)
+
+    try:
+        run(client, load_simulation(client, path, store))
+        assert client.get_simulation()["data"]["pairs"][0]["response"]["body"] == "x" * 100
+
+        # as if the session had started from an image built with the body
+        store.written.clear()
+        client.loaded_simulation = None
+        run(client, load_simulation(client, path, store))
+        assert client.get_simulation()["data"]["pairs"][0]["response"]["body"] == ""
+    finally:
+        client.close()
+        engine.stop()
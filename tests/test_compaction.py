@@ -0,0 +1,114 @@
+from __future__ import annotations
+
+import copy
+import json
+import typing as t
+from pathlib import Path
+
+from pytest_hoverfly.compaction import compact_file, compact_simulation
+from pytest_hoverfly.matching import Request, Simulation
+from pytest_hoverfly.storage import read_simulation
+
+
+CURDIR = Path(__file__).parent
+
+
+def _pair(path, body, date="Sun, 29 Jan 2023 14:47:47 GMT", step=None, next_step=None):
+    pair = {
+        "request": {
+            "method": [{"matcher": "exact", "value": "GET"}],
+            "destination": [{"matcher": "exact", "value": "example.com"}],
+            "path": [{"matcher": "exact", "value": path}],
+        },
+        "response": {"status": 200, "body": body, "headers": {"Date": [date]}},
+    }
+    if step:
+        pair["request"]["requiresState"] = {"sequence:1": step}
+    if next_step:
+        pair["response"]["transitionsState"] = {"sequence:1": next_step}
+    return pair
+
+
+def _sequence(*bodies):
+    """Steps of /job like Hoverfly captures them: the last one transitions to a step that doesn't exist."""
+    return [
+        _pair("/job", body, date=f"Sun, 29 Jan 2023 14:47:{i:02} GMT", step=str(i), next_step=str(i + 1))
+        for i, body in enumerate(bodies, start=1)
+    ]
+
+
+def _get(simulation: Simulation, path: str) -> t.Optional[str]:
+    request = Request("GET", "https", "example.com", path, {}, {}, "")
+    pair = simulation.match(request)
+    return pair and pair.response["body"]
+
+
+def test_duplicate_pairs_are_removed():
+    data = {"data": {"pairs": [_pair("/a", "first"), _pair("/b", "b"), _pair("/a", "retry", date="later")]}}
+
+    result = compact_simulation(data)
+
+    assert (result.pairs_before, result.pairs_after) == (3, 2)
+    assert [p["response"]["body"] for p in data["data"]["pairs"]] == ["first", "b"]
+
+
+def test_sequences_are_kept_by_default():
+    data = {"data": {"pairs": _sequence("running", "done", "done")}}
+
+    assert compact_simulation(data).removed == 0
+    simulation = Simulation(data)
+    assert [_get(simulation, "/job") for _ in range(4)] == ["running", "done", "done", None]
+
+
+def test_repeated_responses_at_the_end_are_collapsed():
+    data = {"data": {"pairs": _sequence("running", "running", "running", "done", "done")}}
+
+    result = compact_simulation(data, sequences=True)
+
+    # the steps in the middle are served as many times as they were recorded
+    assert result.pairs_after == 4
+    simulation = Simulation(data)
+    assert [_get(simulation, "/job") for _ in range(6)] == ["running", "running", "running", "done", "done", "done"]
+
+
+def test_sequences_with_distinct_responses_are_kept():
+    pairs = _sequence("queued", "running", "done")
+
+    assert compact_simulation({"data": {"pairs": pairs}}, sequences=True).removed == 0
+
+
+def test_recorded_sequence_is_replayed_the_same():
+    data = read_simulation(CURDIR / "simulations" / "stateful_job_simulation.json")
+    data["data"]["pairs"].append(copy.deepcopy(data["data"]["pairs"][-1]))
+    data["data"]["pairs"][-1]["request"]["requiresState"] = {"sequence:1": "3"}
+    data["data"]["pairs"][-1]["response"]["transitionsState"] = {"sequence:1": "4"}
+
+    compact_simulation(data, sequences=True)
+
+    simulation = Simulation(data)
+    request = Request("GET", "https", "example.com", "/job", {}, {}, "")
+    assert [json.loads(simulation.match(request).response["body"])["status"] for _ in range(3)] == [
+        "running",
+        "done",
+        "done",
+    ]
+
+
+def test_compact_file_keeps_untouched_files(tmp_path):
+    path = tmp_path / "simulation.json"
+    original = (CURDIR / "simulations" / "archive_org_simulation.json").read_text()
+    path.write_text(original)
+
+    assert compact_file(path).removed == 0
+    assert path.read_text() == original
+
+
+def test_compact_option(testdir, tmp_path):
+    pairs = [_pair("/a", "first"), _pair("/a", "retry")]
+    (tmp_path / "simulation.json").write_text(json.dumps({"data": {"pairs": pairs}}))
+
+    result = testdir.runpytest_subprocess("--hoverfly-simulation-path", tmp_path, "--hoverfly-compact")
+
+    assert result.ret == 0
+    result.stdout.fnmatch_lines(["*simulation.json: 2 -> 1 pairs"])
+    assert len(json.loads((tmp_path / "simulation.json").read_text())["data"]["pairs"]) == 1
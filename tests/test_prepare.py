@@ -0,0 +1,190 @@
+from __future__ import annotations
+
+import json
+import os
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+from pytest_hoverfly import storage
+from pytest_hoverfly.blobs import BODIES_DIR, BodyStore
+from pytest_hoverfly.prepare import (
+    InvalidSimulation,
+    prepare_simulations,
+    validate_simulation,
+)
+from pytest_hoverfly.storage import write_simulation
+
+
+CURDIR = Path(__file__).parent
+
+
+def _simulation(body="hello"):
+    return {
+        "data": {
+            "pairs": [
+                {
+                    "request": {
+                        "path": [{"matcher": "exact", "value": "/"}],
+                        "query": {"q": [{"matcher": "glob", "value": "*"}]},
+                    },
+                    "response": {"status": 200, "body": body},
+                }
+            ]
+        },
+        "meta": {"schemaVersion": "v5"},
+    }
+
+
+@pytest.mark.parametrize(
+    "data, error",
+    [
+        ({}, "`data.pairs` must be a list"),
+        ({"data": {"pairs": [{"response": {}}]}}, "pair 0: `request` must be an object"),
+        ({"data": {"pairs": [{"request": {}}]}}, "pair 0: `response` must be an object"),
+        ({"data": {"pairs": [{"request": {"path": "/"}, "response": {}}]}}, "pair 0: `request.path` must be a list"),
+        (
+            {"data": {"pairs": [{"request": {"headers": {"A": [{"value": "b"}]}}, "response": {}}]}},
+            "pair 0: `request.headers.A` must be a list",
+        ),
+        ({"data": {"pairs": [{"request": {}, "response": {"status": "200"}}]}}, "`response.status` must be"),
+    ],
+    ids=["no_pairs", "no_request", "no_response", "not_matchers", "no_matcher", "status"],
+)
+def test_validate_simulation(data, error):
+    with pytest.raises(InvalidSimulation, match=error):
+        validate_simulation(data)
+
+
+def test_prepare_simulations(tmp_path):
+    good, compressed = tmp_path / "good.json", tmp_path / "good.json.gz"
+    write_simulation(good, _simulation())
+    write_simulation(compressed, _simulation())
+    (tmp_path / "broken.json").write_text("{")
+    (tmp_path / "invalid.json").write_text(json.dumps({"data": {}}))
+
+    prepared, errors = prepare_simulations(
+        [good, compressed, tmp_path / "broken.json", tmp_path / "invalid.json", tmp_path / "missing.json"],
+        BodyStore(tmp_path / BODIES_DIR),
+    )
+
+    assert set(prepared) == {good, compressed}
+    assert json.loads(prepared[good].payload) == _simulation()
+    assert prepared[compressed].payload == prepared[good].payload
+    assert errors[tmp_path / "missing.json"] == "file not found"
+    assert errors[tmp_path / "broken.json"].startswith("not a valid JSON")
+    assert errors[tmp_path / "invalid.json"] == "`data.pairs` must be a list"
+
+
+def test_prepared_payload_has_bodies_inlined(tmp_path):
+    store = BodyStore(tmp_path / BODIES_DIR)
+    data = _simulation("x" * 100)
+    store.externalize(data, threshold=10)
+    write_simulation(tmp_path / "simulation.json", data)
+
+    prepared, _ = prepare_simulations([tmp_path / "simulation.json"], store)
+
+    payload = json.loads(prepared[tmp_path / "simulation.json"].payload)
+    assert payload["data"]["pairs"][0]["response"]["body"] == "x" * 100
+
+
+def test_prepared_payloads_are_bounded(tmp_path):
+    paths = [tmp_path / "a.json", tmp_path / "b.json"]
+    for path in paths:
+        write_simulation(path, _simulation("x" * 1000))
+
+    # minified, both fit in the size of the original file, but not together
+    prepared, _ = prepare_simulations(paths, BodyStore(tmp_path / BODIES_DIR), cache_size=paths[0].stat().st_size)
+
+    # the other one doesn't fit, it's read from disk again when loaded
+    assert sorted(prepared[path].payload is None for path in paths) == [False, True]
+    assert all(prepared[path].digest for path in paths)
+
+
+def test_big_simulations_are_not_parsed(tmp_path):
+    small, big = tmp_path / "small.json", tmp_path / "big.json.gz"
+    write_simulation(small, _simulation())
+    # not even valid, but it's too big to check at collection
+    write_simulation(big, {"data": {"pairs": "x" * 10000}})
+
+    prepared, errors = prepare_simulations([small, big], BodyStore(tmp_path / BODIES_DIR), max_parsed_size=1000)
+
+    assert not errors
+    assert prepared[small].payload is not None
+    assert prepared[big].payload is None
+    assert prepared[big].digest
+
+
+def test_simulations_parsed_at_once_fit_in_memory_limit(tmp_path, monkeypatch):
+    paths = [tmp_path / f"{i}.json" for i in range(8)]
+    for path in paths:
+        write_simulation(path, _simulation())
+    lock = threading.Lock()
+    parsing = []
+    most = 0
+
+    def read_simulation(path):
+        nonlocal most
+        with lock:
+            parsing.append(path)
+            most = max(most, len(parsing))
+        time.sleep(0.01)
+        with lock:
+            parsing.remove(path)
+        return storage.read_simulation(path)
+
+    monkeypatch.setattr("pytest_hoverfly.prepare.read_simulation", read_simulation)
+    size = paths[0].stat().st_size
+
+    prepared, _ = prepare_simulations(paths, BodyStore(tmp_path / BODIES_DIR), max_parsed_size=size * 2)
+
+    assert len(prepared) == 8
+    assert most == 2
+
+
+def test_changed_simulation_is_not_current(tmp_path):
+    path = tmp_path / "simulation.json"
+    write_simulation(path, _simulation())
+    prepared, _ = prepare_simulations([path], BodyStore(tmp_path / BODIES_DIR))
+    assert prepared[path].is_current()
+
+    write_simulation(path, _simulation("changed"))
+    os.utime(path, ns=(0, 0))
+    assert not prepared[path].is_current()
+
+
+def test_invalid_simulation_fails_collection(testdir):
+    simulations = testdir.mkdir("simulations")
+    (Path(simulations) / "broken.json").write_text("{")
+
+    testdir.makepyfile(
+        """
+from pytest_hoverfly import hoverfly
+
+
+@hoverfly('broken')
+def test_broken():
+    pass
+
+
+@hoverfly('missing')
+def test_missing():
+    pass
+
+
+@hoverfly('new', record=True)
+def test_recorded():
+    pass
+    """
+    )
+
+    result = testdir.runpytest_subprocess(
+        "--hoverfly-simulation-path", str(simulations), "--hoverfly-backend", "python"
+    )
+
+    assert result.ret == pytest.ExitCode.USAGE_ERROR
+    result.stderr.fnmatch_lines(["*Invalid Hoverfly simulations:", "*broken.json: not a valid JSON*"])
+    result.stderr.fnmatch_lines(["*missing.json: file not found"])
+    assert "new.json" not in result.stderr.str()
@@ -0,0 +1,108 @@
+from __future__ import annotations
+
+import sys
+import textwrap
+
+import pytest
+
+from pytest_hoverfly.base import HoverflyExited
+from pytest_hoverfly.process import get_process
+
+
+# Pretends to be Hoverfly: answers on the admin port and accepts connections on the proxy one
+FAKE_HOVERFLY = """
+import argparse
+import http.server
+import threading
+
+parser = argparse.ArgumentParser()
+parser.add_argument("-ap", type=int)
+parser.add_argument("-pp", type=int)
+parser.add_argument("-webserver", action="store_true")
+args = parser.parse_args()
+
+
+class Admin(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write(b'{"state": {}}')
+
+
+proxy = http.server.ThreadingHTTPServer(("127.0.0.1", args.pp), Admin)
+threading.Thread(target=proxy.serve_forever, daemon=True).start()
+http.server.ThreadingHTTPServer(("127.0.0.1", args.ap), Admin).serve_forever()
+"""
+
+
+def _binary(tmp_path, source):
+    path = tmp_path / "hoverfly"
+    path.write_text(f"#!{sys.executable}\n{textwrap.dedent(source)}")
+    path.chmod(0o755)
+    return str(path)
+
+
+@pytest.fixture(autouse=True)
+def external_instance(monkeypatch):
+    # as on CI, where a Hoverfly service is running for the docker backend
+    monkeypatch.setenv("HOVERFLY_HOST", "hoverfly.invalid")
+    monkeypatch.setenv("HOVERFLY_PROXY_PORT", "8500")
+    monkeypatch.setenv("HOVERFLY_ADMIN_PORT", "8888")
+
+
+def test_process_is_started_and_stopped(tmp_path):
+    timings = {}
+    process = get_process(binary=_binary(tmp_path, FAKE_HOVERFLY), args="-webserver", timeout=10, timings=timings)
+
+    instance = next(process)
+    assert instance.host != "hoverfly.invalid"
+    assert instance.is_ready()
+    assert list(timings) == ["start", "ready"]
+
+    process.close()
+    assert not instance.admin_endpoint_is_ready()
+
+
+def test_process_that_exited_is_reported(tmp_path):
+    binary = _binary(tmp_path, "import sys; print('flag provided but not defined'); sys.exit(2)")
+
+    # without waiting for the timeout
+    with pytest.raises(HoverflyExited, match="code 2:\nflag provided but not defined"):
+        next(get_process(binary=binary, timeout=60))
+
+
+def test_missing_binary():
+    with pytest.raises(FileNotFoundError, match="--hoverfly-binary"):
+        next(get_process(binary="no-such-hoverfly"))
+
+
+def test_backend_from_plugin(testdir):
+    testdir.makeconftest(
+        """
+from pytest_hoverfly.base import Hoverfly
+
+
+def _fake():
+    yield Hoverfly("fake", 1, 2)
+    print("FAKE STOPPED")
+
+
+def pytest_hoverfly_backend(config, name):
+    if name == "fake":
+        return _fake()
+    """
+    )
+    testdir.makepyfile(
+        """
+def test_instance(hoverfly_instance):
+    assert hoverfly_instance.host == "fake"
+    """
+    )
+
+    result = testdir.runpytest_subprocess("--hoverfly-backend", "fake", "-s")
+    result.assert_outcomes(passed=1)
+    result.stdout.fnmatch_lines(["*FAKE STOPPED*"])
+
+    result = testdir.runpytest_subprocess("--hoverfly-backend", "unknown")
+    result.assert_outcomes(errors=1)
+    result.stdout.fnmatch_lines(["*Unknown Hoverfly backend: unknown*"])
@@ -0,0 +1,154 @@
+from __future__ import annotations
+
+from pathlib import Path
+
+import pytest
+
+from pytest_hoverfly.profiles import (
+    Delay,
+    LogNormal,
+    Profile,
+    parse_delay,
+    parse_faults,
+    sample_delay,
+)
+
+
+CURDIR = Path(__file__).parent
+
+
+def _simulation(pairs=10):
+    return {
+        "data": {
+            "pairs": [
+                {
+                    "request": {"path": [{"matcher": "exact", "value": f"/{i}"}]},
+                    "response": {"status": 200, "body": "ok", "transitionsState": {"sequence:1": "2"}},
+                }
+                for i in range(pairs)
+            ]
+        }
+    }
+
+
+def test_parse_delay():
+    assert parse_delay(200) == Delay(fixed=200)
+    assert parse_delay("50@api\\.example\\.com") == Delay("api\\.example\\.com", fixed=50)
+    assert parse_delay("lognormal:min=10,max=2000,mean=200,median=150@/slow") == Delay(
+        "/slow", lognormal=LogNormal(min=10, max=2000, mean=200, median=150)
+    )
+
+
+@pytest.mark.parametrize(
+    "spec",
+    [
+        "fast",
+        "-1",
+        "lognormal:min=10",
+        "lognormal:min=1,max=2,mean=3,median=4",
+        "lognormal:min=1,max=9,mean=3,median=2,x=1",
+    ],
+    ids=["not_a_number", "negative", "incomplete", "median_above_mean", "unknown_parameter"],
+)
+def test_invalid_delay(spec):
+    with pytest.raises(ValueError):
+        parse_delay(spec)
+
+
+def test_parse_faults():
+    assert parse_faults(0.1) == (0.1, 503)
+    assert parse_faults("0.5:504") == (0.5, 504)
+    with pytest.raises(ValueError):
+        parse_faults("2")
+
+
+def test_delays_go_before_recorded_ones():
+    data = _simulation()
+    data["data"]["globalActions"] = {"delays": [{"urlPattern": ".", "httpMethod": "", "delay": 1}]}
+
+    Profile.from_specs(["100@example", "lognormal:min=1,max=9,mean=3,median=2"], None).apply(data, seed="s")
+
+    actions = data["data"]["globalActions"]
+    assert [d["delay"] for d in actions["delays"]] == [100, 1]
+    assert actions["delaysLogNormal"] == [
+        {"urlPattern": ".", "httpMethod": "", "min": 1, "max": 9, "mean": 3, "median": 2}
+    ]
+    # the first matching delay of each kind and the pair's own delay add up
+    assert 100 + 1 <= sample_delay(data, "GET", "example.com/", {}) <= 100 + 9
+    assert 5 + 1 + 1 <= sample_delay(data, "GET", "other.com/", {"fixedDelay": 5}) <= 5 + 1 + 9
+
+
+def test_faults_are_reproducible():
+    profile = Profile.from_specs(None, "0.5:504")
+    first, second = _simulation(100), _simulation(100)
+    profile.apply(first, seed="simulation.json")
+    profile.apply(second, seed="simulation.json")
+
+    statuses = [pair["response"]["status"] for pair in first["data"]["pairs"]]
+    assert first == second
+    assert 20 < statuses.count(504) < 80
+    # sequences still advance
+    assert all(pair["response"]["transitionsState"] for pair in first["data"]["pairs"])
+
+
+def test_profile_key():
+    assert not Profile()
+    assert Profile.from_specs(100, None).key != Profile.from_specs(200, None).key
+
+
+def test_latency_and_faults_are_replayed(testdir):
+    testdir.makepyfile(
+        """
+import time
+
+import requests
+from pytest_hoverfly import hoverfly
+
+
+def _get():
+    started = time.monotonic()
+    resp = requests.get(
+        'https://archive.org/metadata/SPD-SLRSY-1867/metadata/identifier',
+        headers={'Accept': 'application/json'},
+    )
+    return resp, time.monotonic() - started
+
+
+@hoverfly('archive_org_simulation')
+def test_option():
+    resp, elapsed = _get()
+    assert resp.status_code == 200
+    assert elapsed >= 0.2
+
+
+@hoverfly('archive_org_simulation', latency="0@archive.org")
+def test_marker_latency():
+    resp, elapsed = _get()
+    assert elapsed < 0.2
+
+
+@hoverfly('archive_org_simulation', faults="1:504")
+def test_marker_faults():
+    resp, elapsed = _get()
+    assert resp.status_code == 504
+    assert elapsed >= 0.2
+    """
+    )
+
+    result = testdir.runpytest_subprocess(
+        "--hoverfly-simulation-path",
+        str(CURDIR / "simulations"),
+        "--hoverfly-backend",
+        "python",
+        "--hoverfly-latency",
+        "200",
+    )
+
+    result.assert_outcomes(passed=3)
+
+
+def test_invalid_latency_option(testdir):
+    result = testdir.runpytest_subprocess("--hoverfly-latency", "soon")
+
+    assert result.ret == pytest.ExitCode.USAGE_ERROR
+    result.stderr.fnmatch_lines(["*Expected delay in milliseconds*"])
@@ -1,11 +1,36 @@
 from __future__ import annotations
 
+import itertools
 import json
 import os
 from pathlib import Path
+from types import SimpleNamespace
 
 import pytest
 import requests
+from docker import DockerClient
+
+from pytest_hoverfly.base import (
+    IMAGE,
+    REUSE_LABEL,
+    BackgroundContainer,
+    Hoverfly,
+    backoff,
+    reuse_key,
+    select_for_worker,
+    wait_until_ready,
+)
+from pytest_hoverfly.helpers import (
+    extract_simulation_name_from_request,
+    get_request_simulation_file,
+    get_simulation_file,
+    group_items,
+)
+from pytest_hoverfly.storage import (
+    iter_chunks,
+    simulation_reader,
+    simulation_writer,
+)
 
 
 CURDIR = Path(__file__).parent
@@ -132,6 +157,47 @@ def test_stateful_simulation_recorder():
     assert "SPD-SLRSY-1867" in simulation["data"]["pairs"][0]["response"]["body"]
 
 
+def test_hoverfly_decorator_missing_recorder(testdir, tmpdir):
+    """This test hits a network!"""
+    simulation_path = tmpdir / "archive_org_simulation.json"
+    simulation_path.write_text((CURDIR / "simulations" / "archive_org_simulation.json").read_text(), "utf-8")
+    testdir.makepyfile(
+        """
+import requests
+from pytest_hoverfly import hoverfly
+
+@hoverfly('archive_org_simulation', record="missing")
+def test_missing_recorder():
+    # replayed from the simulation
+    resp = requests.get(
+        'https://archive.org/metadata/SPD-SLRSY-1867/metadata/identifier',
+        headers={'Accept': 'application/json'},
+    )
+    assert resp.json() == {"result": "SPD-SLRSY-1867"}
+
+    # goes to archive.org and gets recorded
+    resp = requests.get(
+        'https://archive.org/metadata/SPD-SLRSY-1867/metadata/title',
+        headers={'Accept': 'application/json', 'Accept-Encoding': 'identity'},
+    )
+    assert "result" in resp.json()
+    """
+    )
+
+    result = testdir.runpytest_subprocess("--hoverfly-simulation-path", tmpdir, "-vv")
+
+    result.assert_outcomes(passed=1)
+
+    with open(simulation_path) as f:
+        simulation = json.load(f)
+
+    paths = [pair["request"]["path"][0]["value"] for pair in simulation["data"]["pairs"]]
+    assert paths == [
+        "/metadata/SPD-SLRSY-1867/metadata/identifier",
+        "/metadata/SPD-SLRSY-1867/metadata/title",
+    ]
+
+
 def test_hoverfly_decorator_stateful_recorder(testdir, tmpdir):
     """This test hits a network!"""
     # create a temporary pytest test file
@@ -230,3 +296,340 @@ def test_timeout_parsing(request):
     )
 
     result.assert_outcomes(passed=1)
+
+
+def test_external_instances_from_env():
+    env = {"HOVERFLY_INSTANCES": "localhost:8500:8888, hoverfly-2:8501:8889"}
+
+    assert Hoverfly.list_from_env(env) == [Hoverfly("localhost", 8888, 8500), Hoverfly("hoverfly-2", 8889, 8501)]
+    assert Hoverfly.try_from_env({**env, "PYTEST_XDIST_WORKER": "gw1"}) == Hoverfly("hoverfly-2", 8889, 8501)
+    assert Hoverfly.try_from_env(env) == Hoverfly("localhost", 8888, 8500)
+
+
+def test_single_external_instance_is_not_shared_by_workers():
+    env = {"HOVERFLY_HOST": "localhost", "HOVERFLY_PROXY_PORT": "8500", "HOVERFLY_ADMIN_PORT": "8888"}
+
+    assert Hoverfly.try_from_env(env) == Hoverfly("localhost", 8888, 8500)
+    assert Hoverfly.try_from_env({**env, "PYTEST_XDIST_WORKER": "gw0", "PYTEST_XDIST_WORKER_COUNT": "1"}) == (
+        Hoverfly("localhost", 8888, 8500)
+    )
+    # gw0 would share it with the other worker
+    with pytest.raises(RuntimeError, match="Not enough Hoverfly instances for 2 xdist workers: 1 provided"):
+        Hoverfly.try_from_env({**env, "PYTEST_XDIST_WORKER": "gw0", "PYTEST_XDIST_WORKER_COUNT": "2"})
+    with pytest.raises(RuntimeError):
+        Hoverfly.try_from_env({**env, "PYTEST_XDIST_WORKER": "gw3"})
+
+
+def test_not_enough_external_instances():
+    instances = [Hoverfly("localhost", 8888, 8500), Hoverfly("localhost", 8889, 8501)]
+
+    with pytest.raises(RuntimeError):
+        select_for_worker(instances, "gw2")
+
+
+def test_same_simulation_is_reused(testdir):
+    """Consecutive tests with the same simulation must not affect each other."""
+    testdir.makepyfile(
+        """
+import requests
+from pytest_hoverfly import hoverfly
+
+
+@hoverfly('archive_org_simulation')
+def test_first():
+    resp = requests.get(
+        'https://archive.org/metadata/SPD-SLRSY-1867/metadata/identifier',
+        headers={'Accept': 'application/json'},
+    )
+
+    assert resp.json() == {"result": "SPD-SLRSY-1867"}
+
+
+@hoverfly('archive_org_simulation')
+def test_second():
+    resp = requests.get(
+        'https://archive.org/metadata/SPD-SLRSY-1867/metadata/identifier',
+        headers={'Accept': 'application/json'},
+    )
+
+    assert resp.json() == {"result": "SPD-SLRSY-1867"}
+    """
+    )
+
+    result = testdir.runpytest_subprocess("--hoverfly-simulation-path", str(CURDIR / "simulations"), "-vv")
+
+    result.assert_outcomes(passed=2)
+
+
+@pytest.mark.parametrize("suffix", (".json", ".json.gz", ".json.zst"))
+def test_simulation_storage_roundtrip(tmp_path, suffix):
+    path = tmp_path / f"simulation{suffix}"
+    simulation = json.loads((CURDIR / "simulations" / "archive_org_simulation.json").read_text())
+
+    with simulation_writer(path) as f:
+        json.dump(simulation, f)
+
+    with simulation_reader(path) as stream:
+        assert json.loads(b"".join(iter_chunks(stream, size=64))) == simulation
+
+
+def test_simulation_file_resolution(tmp_path):
+    config = SimpleNamespace(option=SimpleNamespace(hoverfly_simulation_path=tmp_path))
+
+    assert get_simulation_file(config, "simulation") == tmp_path / "simulation.json"
+    assert get_simulation_file(config, "simulation.json.gz") == tmp_path / "simulation.json.gz"
+
+    (tmp_path / "simulation.json.zst").touch()
+    assert get_simulation_file(config, "simulation") == tmp_path / "simulation.json.zst"
+    request = SimpleNamespace(
+        config=config, node=SimpleNamespace(get_closest_marker=lambda name: pytest.mark.hoverfly("simulation").mark)
+    )
+    # the name keeps referring to a .json file, only the path is resolved
+    assert extract_simulation_name_from_request(request) == "simulation.json"
+    assert get_request_simulation_file(request) == tmp_path / "simulation.json.zst"
+
+
+def test_hoverfly_client(testdir):
+    """hoverfly_client gives access to the simulation loaded for the test."""
+    testdir.makepyfile(
+        """
+from pytest_hoverfly import hoverfly
+
+
+@hoverfly('archive_org_simulation')
+def test_client(hoverfly_client):
+    assert len(hoverfly_client.get_simulation()["data"]["pairs"]) == 1
+    assert hoverfly_client.loaded_simulation
+    """
+    )
+
+    result = testdir.runpytest_subprocess("--hoverfly-simulation-path", str(CURDIR / "simulations"), "-vv")
+
+    result.assert_outcomes(passed=1)
+
+
+def test_reuse_key():
+    ports = {"8500/tcp": None, "8888/tcp": None}
+    key = reuse_key(IMAGE, ports, {"command": None}, None)
+
+    assert key == reuse_key(IMAGE, ports, {"command": None}, None)
+    assert key != reuse_key(IMAGE, ports, {"command": "-webserver"}, None)
+    assert key != reuse_key("spectolabs/hoverfly:v1.3.6", ports, {"command": None}, None)
+    assert key != reuse_key(IMAGE, ports, {"command": None}, "gw1")
+
+
+def test_reuse_container(testdir):
+    """Second session must pick up the container left by the first one."""
+    testdir.makepyfile(
+        """
+def test_instance(hoverfly_instance):
+    print(f"ADMIN PORT: {hoverfly_instance.admin_port}")
+    """
+    )
+
+    ports = []
+    for _ in range(2):
+        result = testdir.runpytest_subprocess("--hoverfly-reuse-container", "-s")
+        result.assert_outcomes(passed=1)
+        ports += [line for line in result.outlines if line.startswith("ADMIN PORT")]
+
+    docker = DockerClient.from_env()
+    for container in docker.containers.list(filters={"label": REUSE_LABEL}):
+        container.remove(v=True, force=True)
+
+    assert len(ports) == 2
+    assert ports[0] == ports[1]
+
+
+def test_backoff_is_capped():
+    delays = list(itertools.islice(backoff(initial=0.001, cap=0.1), 20))
+
+    assert all(0 < d <= 0.1 for d in delays)
+    assert max(delays[-5:]) > 0.05
+
+
+def test_wait_until_ready_timeout():
+    # nothing listens on port 1
+    with pytest.raises(TimeoutError):
+        wait_until_ready(Hoverfly("localhost", 1, 1), timeout=0.05)
+
+
+def test_background_container_with_external_instance(monkeypatch):
+    monkeypatch.setenv("HOVERFLY_INSTANCES", "localhost:8500:8888")
+
+    container = BackgroundContainer()
+
+    assert container.result() == Hoverfly("localhost", 8888, 8500)
+    container.stop()
+    container.stop()
+
+
+def test_phase_timings(testdir):
+    testdir.makeconftest(
+        """
+import json
+
+
+def pytest_hoverfly_phase_timing(config, nodeid, phase, duration):
+    with open("phases.jsonl", "a") as f:
+        f.write(json.dumps([nodeid.split("::")[-1], phase]) + "\\n")
+    """
+    )
+    testdir.makepyfile(
+        """
+from pytest_hoverfly import hoverfly
+
+
+@hoverfly('archive_org_simulation')
+def test_first():
+    pass
+
+
+@hoverfly('archive_org_simulation')
+def test_second():
+    pass
+    """
+    )
+
+    result = testdir.runpytest_subprocess(
+        "--hoverfly-simulation-path",
+        str(CURDIR / "simulations"),
+        "--hoverfly-backend",
+        "python",
+        "--hoverfly-durations",
+        "2",
+    )
+
+    result.assert_outcomes(passed=2)
+    result.stdout.fnmatch_lines(["*slowest 2 pytest-hoverfly phases*", "*s in total: *"])
+    phases = [tuple(json.loads(line)) for line in (testdir.tmpdir / "phases.jsonl").readlines()]
+    # the simulation is uploaded by the first test, the second one only restores state
+    assert phases == [
+        ("test_first", "prepare"),
+        ("test_first", "read"),
+        ("test_first", "upload"),
+        ("test_first", "mode"),
+        ("test_first", "state"),
+        ("test_second", "read"),
+        ("test_second", "state"),
+    ]
+
+
+def test_group_items():
+    items = ["a1", "x", "b1", "a2", "y", "b2", "a3"]
+
+    group_items(items, key=lambda item: item[0] if item[0] in "ab" else None)
+
+    assert items == ["a1", "a2", "a3", "x", "b1", "b2", "y"]
+
+
+def test_group_by_simulation(testdir):
+    testdir.makeconftest(
+        """
+def pytest_hoverfly_phase_timing(config, nodeid, phase, duration):
+    if phase == "upload":
+        with open("uploads.txt", "a") as f:
+            f.write(nodeid.split("::")[-1] + "\\n")
+    """
+    )
+    testdir.makepyfile(
+        """
+from pytest_hoverfly import hoverfly
+
+
+@hoverfly('archive_org_simulation')
+def test_a1():
+    pass
+
+
+@hoverfly('stateful_job_simulation')
+def test_b1():
+    pass
+
+
+def test_without_simulation():
+    pass
+
+
+@hoverfly('archive_org_simulation.json')
+def test_a2():
+    pass
+
+
+@hoverfly('stateful_job_simulation')
+def test_b2():
+    pass
+    """
+    )
+
+    result = testdir.runpytest_subprocess(
+        "--hoverfly-simulation-path",
+        str(CURDIR / "simulations"),
+        "--hoverfly-backend",
+        "python",
+        "--hoverfly-group-by-simulation",
+        "-vv",
+    )
+
+    result.assert_outcomes(passed=5)
+    result.stdout.fnmatch_lines(["*test_a1*", "*test_a2*", "*test_b1*", "*test_b2*", "*test_without_simulation*"])
+    assert (testdir.tmpdir / "uploads.txt").read().split() == ["test_a1", "test_b1"]
+
+
+def test_group_by_simulation_without_name(testdir):
+    testdir.makepyfile(
+        """
+from pytest_hoverfly import hoverfly
+
+
+@hoverfly()
+def test_nameless():
+    pass
+
+
+@hoverfly('archive_org_simulation')
+def test_named():
+    pass
+    """
+    )
+
+    result = testdir.runpytest_subprocess(
+        "--hoverfly-simulation-path",
+        str(CURDIR / "simulations"),
+        "--hoverfly-backend",
+        "python",
+        "--hoverfly-group-by-simulation",
+        "-vv",
+    )
+
+    # the nameless marker fails its own test, not the collection
+    result.assert_outcomes(passed=1, errors=1)
+
+
+def test_unmatched_requests_after_long_journal_are_printed(testdir):
+    """Only the journal since the failed test started is fetched, however long it is."""
+    testdir.makepyfile(
+        """
+import requests
+from pytest_hoverfly import hoverfly
+
+
+@hoverfly('archive_org_simulation')
+def test_first():
+    for _ in range(101):
+        requests.get('http://archive.org/first')
+
+
+@hoverfly('archive_org_simulation')
+def test_second():
+    requests.get('http://archive.org/second')
+    assert False
+    """
+    )
+
+    result = testdir.runpytest_subprocess("--hoverfly-simulation-path", str(CURDIR / "simulations"))
+
+    result.assert_outcomes(passed=1, failed=1)
+    output = result.stdout.str()
+    assert "GET http://archive.org/second" in output
+    assert "GET http://archive.org/first" not in output
@@ -0,0 +1,351 @@
+from __future__ import annotations
+
+import base64
+import json
+import socket
+import time
+from pathlib import Path
+
+import pytest
+import requests
+
+from pytest_hoverfly.client import HoverflyClient
+from pytest_hoverfly.engine import ReplayEngine
+from pytest_hoverfly.matching import (
+    Request,
+    Simulation,
+    find_missing,
+)
+
+
+CURDIR = Path(__file__).parent
+SIMULATIONS = sorted((CURDIR / "simulations").glob("*.json"))
+
+
+@pytest.fixture
+def engine():
+    engine = ReplayEngine()
+    instance = engine.start()
+    client = HoverflyClient(instance)
+
+    yield instance, client
+
+    client.close()
+    engine.stop()
+
+
+def _request(method="GET", path="/", query=None, headers=None, body="") -> Request:
+    return Request(
+        method=method,
+        scheme="https",
+        destination="example.com",
+        path=path,
+        query=query or {},
+        headers=headers or {},
+        body=body,
+    )
+
+
+def _pair(path, body, matcher="exact", **request):
+    return {
+        "request": {
+            "method": [{"matcher": "exact", "value": "GET"}],
+            "destination": [{"matcher": "exact", "value": "example.com"}],
+            "path": [{"matcher": matcher, "value": path}],
+            **request,
+        },
+        "response": {"status": 200, "body": body},
+    }
+
+
+def _exact_value(matchers, default=""):
+    exact = [m["value"] for m in matchers or [] if m["matcher"] == "exact"]
+    return exact[0] if exact else default
+
+
+@pytest.mark.parametrize("simulation_path", SIMULATIONS, ids=lambda p: p.name)
+def test_recorded_simulations_are_replayed(engine, simulation_path):
+    """Every recorded pair must be served for a request built from its matchers."""
+    instance, client = engine
+    simulation = json.loads(simulation_path.read_text())
+    client.put_simulation(simulation_path.read_bytes())
+    client.set_mode("simulate")
+
+    for pair in simulation["data"]["pairs"]:
+        request, response = pair["request"], pair["response"]
+        headers = {k: _exact_value(v) for k, v in request.get("headers", {}).items()}
+        scheme, destination, path = (_exact_value(request[name]) for name in ("scheme", "destination", "path"))
+        resp = requests.request(
+            _exact_value(request["method"]),
+            f"{scheme}://{destination}{path}",
+            headers=headers,
+            data=_exact_value(request.get("body")),
+            proxies={"http": instance.proxy_url, "https": instance.proxy_url},
+            verify=str(instance.cert),
+        )
+
+        expected_body = base64.b64decode(response["body"]) if response["encodedBody"] else response["body"].encode()
+        assert resp.status_code == response["status"]
+        assert resp.content == expected_body
+        assert resp.headers["Hoverfly"] == "Was-Here"
+
+
+def test_unmatched_request(engine):
+    instance, client = engine
+    client.put_simulation(json.dumps({"data": {"pairs": []}}))
+
+    resp = requests.get("http://example.com/", proxies={"http": instance.proxy_url})
+
+    assert resp.status_code == 502
+    assert "Could not find a match" in client.get_logs()[-1]["error"]
+    assert len(client.get_journal()["journal"]) == 1
+
+
+@pytest.mark.parametrize(
+    "garbage",
+    [b"garbage\r\n\r\n", b"GET / HTTP/1.1\r\nno colon\r\n\r\n", b"GET / HTTP/1.1\r\nContent-Length: x\r\n\r\n"],
+    ids=["request_line", "header", "content_length"],
+)
+def test_malformed_request(engine, garbage):
+    instance, client = engine
+    client.put_simulation(json.dumps({"data": {"pairs": [_pair("/", "ok")]}}))
+
+    with socket.create_connection((instance.host, instance.proxy_port), timeout=5) as conn:
+        conn.sendall(garbage)
+        assert conn.recv(1024).startswith(b"HTTP/1.1 400 Bad Request\r\n")
+
+    assert client.get_logs()[-1]["msg"] == "Malformed request"
+    # the engine keeps serving
+    assert requests.get("http://example.com/", proxies={"http": instance.proxy_url}).text == "ok"
+
+
+def test_journal_since(engine):
+    instance, client = engine
+    client.put_simulation(json.dumps({"data": {"pairs": []}}))
+    requests.get("http://example.com/first", proxies={"http": instance.proxy_url})
+    # the journal is filtered by whole milliseconds
+    time.sleep(0.002)
+    since = time.time()
+    requests.get("http://example.com/second", proxies={"http": instance.proxy_url})
+
+    [entry] = client.get_journal(since=since)["journal"]
+    assert entry["request"]["path"] == "/second"
+
+
+def test_recording_is_not_supported(engine):
+    _, client = engine
+
+    with pytest.raises(requests.HTTPError):
+        client.set_mode("capture")
+
+
+def test_strongest_match_wins():
+    simulation = Simulation(
+        {
+            "data": {
+                "pairs": [
+                    _pair("/items", "exact"),
+                    _pair("/*", "glob", matcher="glob"),
+                    _pair("/items", "with query", query={"page": [{"matcher": "exact", "value": "2"}]}),
+                ]
+            }
+        }
+    )
+
+    assert simulation.match(_request(path="/items")).response["body"] == "exact"
+    assert simulation.match(_request(path="/items", query={"page": ["2"]})).response["body"] == "with query"
+    assert simulation.match(_request(path="/other")).response["body"] == "glob"
+    assert simulation.match(_request(method="POST", path="/items")) is None
+
+
+def test_stateful_sequence():
+    first = _pair("/job", "running", requiresState={"sequence:1": "1"})
+    first["response"]["transitionsState"] = {"sequence:1": "2"}
+    second = _pair("/job", "done", requiresState={"sequence:1": "2"})
+    simulation = Simulation({"data": {"pairs": [first, second]}})
+
+    assert simulation.match(_request(path="/job")).response["body"] == "running"
+    assert simulation.match(_request(path="/job")).response["body"] == "done"
+
+
+def test_python_backend(testdir):
+    testdir.makepyfile(
+        """
+import requests
+from pytest_hoverfly import hoverfly
+
+
+@hoverfly('archive_org_simulation')
+def test_simulation_replayer():
+    resp = requests.get(
+        'https://archive.org/metadata/SPD-SLRSY-1867/metadata/identifier',
+        headers={'Accept': 'application/json'},
+    )
+
+    assert resp.json() == {"result": "SPD-SLRSY-1867"}
+    assert 'Hoverfly' in resp.headers
+    """
+    )
+
+    result = testdir.runpytest_subprocess(
+        "--hoverfly-simulation-path", str(CURDIR / "simulations"), "--hoverfly-backend", "python", "-vv"
+    )
+
+    result.assert_outcomes(passed=1)
+
+
+def test_stateful_simulation_starts_over_in_every_test(testdir):
+    """The simulation is uploaded once, but sequences must start from the first step in each test."""
+    testdir.makepyfile(
+        """
+import pytest
+import requests
+from pytest_hoverfly import hoverfly
+
+
+@pytest.mark.parametrize("attempt", range(2))
+@hoverfly('stateful_job_simulation')
+def test_job(attempt):
+    assert requests.get('https://example.com/job').json() == {"status": "running"}
+    assert requests.get('https://example.com/job').json() == {"status": "done"}
+    """
+    )
+
+    result = testdir.runpytest_subprocess(
+        "--hoverfly-simulation-path", str(CURDIR / "simulations"), "--hoverfly-backend", "python", "-vv"
+    )
+
+    result.assert_outcomes(passed=2)
+
+
+def test_unmatched_requests_of_failed_test_are_printed(testdir):
+    testdir.makepyfile(
+        """
+import requests
+from pytest_hoverfly import hoverfly
+
+
+@hoverfly('archive_org_simulation')
+def test_first():
+    requests.get('https://archive.org/first')
+    assert False
+
+
+@hoverfly('archive_org_simulation')
+def test_second():
+    requests.get('https://archive.org/second')
+    assert False
+    """
+    )
+
+    result = testdir.runpytest_subprocess(
+        "--hoverfly-simulation-path", str(CURDIR / "simulations"), "--hoverfly-backend", "python"
+    )
+
+    result.assert_outcomes(failed=2)
+    output = result.stdout.str()
+    first, second = output.split("___ test_second ___")
+    assert "GET https://archive.org/first" in first
+    assert "Could not find a match" in first
+    # requests of the previous test are not reported again
+    assert "GET https://archive.org/first" not in second
+    assert "GET https://archive.org/second" in second
+
+
+def test_find_missing(engine):
+    instance, client = engine
+    data = json.loads((CURDIR / "simulations" / "archive_org_simulation.json").read_text())
+    client.put_simulation(json.dumps(data))
+    proxies = {"http": instance.proxy_url, "https": instance.proxy_url}
+
+    requests.get(
+        "https://archive.org/metadata/SPD-SLRSY-1867/metadata/identifier",
+        headers={"Accept": "application/json"},
+        proxies=proxies,
+        verify=str(instance.cert),
+    )
+    requests.get("http://archive.org/metadata/other?page=2", proxies=proxies)
+
+    missing = find_missing(data, client.get_journal()["journal"])
+
+    assert [pair["request"]["path"][0]["value"] for pair in missing] == ["/metadata/other"]
+    assert missing[0]["request"]["query"] == {"page": [{"matcher": "exact", "value": "2"}]}
+    assert missing[0]["response"]["status"] == 502
+
+    data["data"]["pairs"].extend(missing)
+    assert find_missing(data, client.get_journal()["journal"]) == []
+
+
+def test_module_scoped_simulation(testdir):
+    testdir.makeconftest(
+        """
+import json
+
+
+def pytest_hoverfly_phase_timing(config, nodeid, phase, duration):
+    with open("phases.jsonl", "a") as f:
+        f.write(json.dumps([nodeid.split("::")[-1], phase]) + "\\n")
+    """
+    )
+    testdir.makepyfile(
+        test_a="""
+import os
+
+import pytest
+import requests
+from pytest_hoverfly import hoverfly
+
+
+@pytest.mark.parametrize("attempt", range(3))
+@hoverfly('stateful_job_simulation', scope='module')
+def test_job(attempt):
+    assert requests.get('https://example.com/job').json() == {"status": "running"}
+    assert requests.get('https://example.com/job').json() == {"status": "done"}
+
+
+def test_env_is_patched_until_the_end_of_module():
+    assert os.environ["HTTPS_PROXY"]
+    """,
+        test_b="""
+import os
+
+
+def test_env_is_restored():
+    assert "HTTPS_PROXY" not in os.environ
+    """,
+    )
+
+    result = testdir.runpytest_subprocess(
+        "--hoverfly-simulation-path", str(CURDIR / "simulations"), "--hoverfly-backend", "python", "-p", "no:randomly"
+    )
+
+    result.assert_outcomes(passed=5)
+    phases = [tuple(json.loads(line)) for line in (testdir.tmpdir / "phases.jsonl").readlines()]
+    # only the first test reads and uploads the simulation, the others restore state
+    assert [phase for test, phase in phases if test != "test_job[0]"] == ["state", "state"]
+    assert ("test_job[0]", "upload") in phases
+
+
+def test_class_marker(testdir):
+    testdir.makepyfile(
+        """
+import requests
+from pytest_hoverfly import hoverfly
+
+
+@hoverfly('stateful_job_simulation', scope='class')
+class TestJob:
+    def test_running(self):
+        assert requests.get('https://example.com/job').json() == {"status": "running"}
+
+    def test_sequence_starts_over(self):
+        assert requests.get('https://example.com/job').json() == {"status": "running"}
+        assert requests.get('https://example.com/job').json() == {"status": "done"}
+    """
+    )
+
+    result = testdir.runpytest_subprocess(
+        "--hoverfly-simulation-path", str(CURDIR / "simulations"), "--hoverfly-backend", "python", "-p", "no:randomly"
+    )
+
+    result.assert_outcomes(passed=2)
@@ -0,0 +1,78 @@
+from __future__ import annotations
+
+import base64
+import json
+from pathlib import Path
+
+from pytest_hoverfly.report import TrafficReport
+
+
+CURDIR = Path(__file__).parent
+
+
+def _entry(destination, status=200, body="", latency=1.0, encoded=False):
+    return {
+        "request": {"destination": destination, "body": "q"},
+        "response": {"status": status, "body": body, "encodedBody": encoded},
+        "latency": latency,
+    }
+
+
+def test_report_from_journal():
+    journal = [
+        _entry("example.com", body="hello", latency=2.0),
+        _entry("example.com", body=base64.b64encode(b"\x00\x01").decode(), encoded=True, latency=4.0),
+        _entry("archive.org", status=502, body="Hoverfly Error!\n\nThere was an error when matching"),
+    ]
+
+    report = TrafficReport.from_journal("test_a", journal)
+
+    assert (report.requests, report.matched, report.unmatched) == (3, 2, 1)
+    stats = report.destinations["example.com"]
+    assert (stats.requests, stats.latency, stats.max_latency) == (2, 6.0, 4.0)
+    assert (stats.request_bytes, stats.response_bytes) == (2, 7)
+    assert TrafficReport.from_dict(json.loads(json.dumps(report.as_dict()))) == report
+
+
+def test_hoverfly_report(testdir):
+    testdir.makepyfile(
+        """
+import requests
+from pytest_hoverfly import hoverfly
+
+
+@hoverfly('archive_org_simulation')
+def test_matched():
+    for _ in range(30):
+        requests.get(
+            'https://archive.org/metadata/SPD-SLRSY-1867/metadata/identifier',
+            headers={'Accept': 'application/json'},
+        )
+
+
+@hoverfly('archive_org_simulation')
+def test_unmatched():
+    assert requests.get('https://archive.org/unknown').status_code == 502
+    """
+    )
+
+    result = testdir.runpytest_subprocess(
+        "--hoverfly-simulation-path",
+        str(CURDIR / "simulations"),
+        "--hoverfly-backend",
+        "python",
+        "--hoverfly-report-json",
+        "report.json",
+        "--junitxml",
+        "junit.xml",
+    )
+
+    result.assert_outcomes(passed=2)
+    result.stdout.fnmatch_lines(["*Hoverfly traffic*", "31 requests in 2 tests, 1 unmatched"])
+    report = json.loads((testdir.tmpdir / "report.json").read_text("utf-8"))
+    assert [(t["nodeid"].split("::")[-1], t["requests"], t["unmatched"]) for t in report["tests"]] == [
+        ("test_matched", 30, 0),
+        ("test_unmatched", 1, 1),
+    ]
+    assert report["destinations"]["archive.org"]["requests"] == 31
+    assert 'name="hoverfly_traffic"' in (testdir.tmpdir / "junit.xml").read_text("utf-8")
@@ -0,0 +1,186 @@
+from __future__ import annotations
+
+import json
+
+import pytest
+
+from pytest_hoverfly.matching import (
+    Request,
+    Simulation,
+    match_value,
+)
+from pytest_hoverfly.sanitize import Sanitizer, parse_path
+
+
+def _exact(value):
+    return [{"matcher": "exact", "value": value}]
+
+
+def _pair(request_body="", response_body="", **headers):
+    return {
+        "request": {
+            "destination": _exact("api.example.com"),
+            "path": _exact("/login"),
+            "query": {"api_key": _exact("secret"), "page": _exact("1")},
+            "body": _exact(request_body),
+            "headers": {
+                "Authorization": _exact("Bearer secret"),
+                "X-Request-Id": _exact("7b5d"),
+                "Content-Length": _exact(str(len(request_body))),
+            },
+        },
+        "response": {
+            "status": 200,
+            "body": response_body,
+            "encodedBody": False,
+            "headers": {"X-Request-Id": ["7b5d"], "Content-Length": [str(len(response_body))], **headers},
+        },
+    }
+
+
+def _sanitize(pair, rules, defaults=True):
+    data = {"data": {"pairs": [pair]}}
+    Sanitizer.compile(rules, defaults=defaults).apply(data)
+    return data["data"]["pairs"][0]
+
+
+def test_defaults():
+    pair = _sanitize(_pair(), [])
+
+    assert "Authorization" not in pair["request"]["headers"]
+    assert "X-Request-Id" in pair["request"]["headers"]
+    assert "Authorization" in _sanitize(_pair(), [], defaults=False)["request"]["headers"]
+
+
+def test_headers_and_query():
+    pair = _sanitize(_pair(), ["header x-request-id", "header Set-Cookie session=0", "query API_KEY"], defaults=False)
+
+    assert "X-Request-Id" not in pair["request"]["headers"]
+    assert "X-Request-Id" not in pair["response"]["headers"]
+    assert list(pair["request"]["query"]) == ["page"]
+
+    pair = _sanitize(_pair(**{"Set-Cookie": ["session=42", "theme=dark"]}), ["header Set-Cookie session=0"])
+    assert pair["response"]["headers"]["Set-Cookie"] == ["session=0", "session=0"]
+
+
+def test_body_fields():
+    request_body = json.dumps({"user": "me", "password": "hunter2", "nonce": 17})
+    response_body = json.dumps({"token": "abc", "items": [{"id": 1, "at": "now"}, {"id": 2, "at": "now"}]})
+
+    pair = _sanitize(
+        _pair(request_body, response_body),
+        ["body $.password", "body $.nonce 0", "body $.token REDACTED", "body $.items[*].at"],
+    )
+
+    assert json.loads(pair["response"]["body"]) == {"token": "REDACTED", "items": [{"id": 1}, {"id": 2}]}
+    assert "Content-Length" not in pair["response"]["headers"]
+    assert "Content-Length" not in pair["request"]["headers"]
+    # a removed field matches any value
+    [matcher] = pair["request"]["body"]
+    assert matcher["matcher"] == "jsonPartial"
+    assert match_value(matcher, json.dumps({"user": "me", "password": "other", "nonce": "0"}))
+
+
+def test_replaced_request_fields_match_any_value():
+    pair = _sanitize(
+        _pair(json.dumps({"user": "me", "ts": "2024-05-01T10:00:00Z"})),
+        ["header X-Request-Id <id>", "query api_key <key>", "body $.ts <ts>"],
+    )
+
+    assert pair["request"]["headers"]["X-Request-Id"] == [{"matcher": "glob", "value": "*"}]
+    assert pair["request"]["body"] == [{"matcher": "jsonPartial", "value": '{"user": "me"}'}]
+    request = Request(
+        "GET",
+        "https",
+        "api.example.com",
+        "/login",
+        {"api_key": ["fresh"], "page": ["1"]},
+        {"X-Request-Id": ["c0ffee"]},
+        json.dumps({"ts": "2026-10-17T12:00:00Z", "user": "me"}),
+    )
+    assert Simulation({"data": {"pairs": [pair]}}).match(request) is not None
+
+
+def test_body_replacement_is_json():
+    response_body = json.dumps({"count": 3, "next": "/page/2", "token": "abc"})
+
+    pair = _sanitize(
+        _pair(response_body=response_body), ["body $.count 0", "body $.next null", "body $.token REDACTED"]
+    )
+
+    assert json.loads(pair["response"]["body"]) == {"count": 0, "next": None, "token": "REDACTED"}
+
+
+def test_regex():
+    pair = _sanitize(
+        _pair(response_body='{"created": "2024-05-01T10:00:00Z"}'),
+        [r"regex \d{4}-\d\d-\d\dT\d\d:\d\d:\d\dZ 2000-01-01T00:00:00Z"],
+    )
+
+    assert pair["response"]["body"] == '{"created": "2000-01-01T00:00:00Z"}'
+
+
+def test_not_json_body_is_left_alone():
+    pair = _sanitize(_pair("password=hunter2", "<html></html>"), ["body $.password"])
+
+    assert pair["request"]["body"] == _exact("password=hunter2")
+    assert pair["response"]["body"] == "<html></html>"
+
+
+def test_parse_path():
+    assert parse_path("$.items[0].tags[*]") == ("items", 0, "tags", "*")
+    assert parse_path("$.*.id") == ("*", "id")
+
+
+@pytest.mark.parametrize(
+    "rule",
+    ["header", "cookie session", "body token", "body $", "body $.items[x]", "regex ("],
+    ids=["no_target", "unknown_kind", "no_dollar", "no_field", "bad_index", "bad_regex"],
+)
+def test_invalid_rule(rule):
+    with pytest.raises(ValueError):
+        Sanitizer.compile([rule])
+
+
+def test_rules_from_ini_and_hook(testdir):
+    testdir.makeini(
+        """
+[pytest]
+hoverfly_sanitize =
+    header X-Request-Id
+    body $.token REDACTED
+    """
+    )
+    testdir.makeconftest(
+        """
+def pytest_hoverfly_sanitize_rules(config):
+    return ["query api_key"]
+    """
+    )
+    testdir.makepyfile(
+        """
+def test_rules(request):
+    sanitizer = request.config._hoverfly_sanitizer
+    assert sanitizer.headers["x-request-id"] is None
+    assert sanitizer.query == {"api_key": None}
+    assert sanitizer.body[0].replacement == "REDACTED"
+    """
+    )
+
+    result = testdir.runpytest_subprocess()
+
+    result.assert_outcomes(passed=1)
+
+
+def test_invalid_rule_in_ini(testdir):
+    testdir.makeini(
+        """
+[pytest]
+hoverfly_sanitize = cookie session
+    """
+    )
+
+    result = testdir.runpytest_subprocess()
+
+    assert result.ret == pytest.ExitCode.USAGE_ERROR
+    result.stderr.fnmatch_lines(["*Invalid sanitizer rule 'cookie session'*"])
@@ -0,0 +1,85 @@
+from __future__ import annotations
+
+import tarfile
+from types import SimpleNamespace
+
+import pytest
+from docker.errors import ImageNotFound
+
+from pytest_hoverfly.snapshot import (
+    SNAPSHOT_REPOSITORY,
+    build_context,
+    find_snapshot,
+    snapshot_key,
+)
+
+
+@pytest.fixture
+def simulations(tmp_path):
+    (tmp_path / "simulation.json").write_text('{"data": {"pairs": []}}')
+    return tmp_path
+
+
+def _docker(snapshots=(), local=(), remote=()):
+    pulled = []
+
+    def get(tag):
+        if tag not in local:
+            raise ImageNotFound(tag)
+
+    def pull(tag):
+        if tag not in remote:
+            raise ImageNotFound(tag)
+        pulled.append(tag)
+
+    images = SimpleNamespace(list=lambda **kwargs: list(snapshots), get=get, pull=pull, pulled=pulled)
+    return SimpleNamespace(images=images)
+
+
+def test_snapshot_key(simulations):
+    key = snapshot_key("spectolabs/hoverfly", simulations)
+    assert snapshot_key("spectolabs/hoverfly", simulations) == key
+    assert snapshot_key("spectolabs/hoverfly:v1.3.0", simulations) != key
+
+    (simulations / "simulation.json").write_text('{"data": {"pairs": [{}]}}')
+    assert snapshot_key("spectolabs/hoverfly", simulations) != key
+
+
+def test_build_context(simulations):
+    with build_context("spectolabs/hoverfly", simulations, "abc") as context:
+        with tarfile.open(fileobj=context) as tar:
+            names = tar.getnames()
+            dockerfile = tar.extractfile("Dockerfile").read().decode()
+
+    assert "simulations/simulation.json" in names
+    assert "simulations/_bodies" in names
+    assert dockerfile.startswith("FROM spectolabs/hoverfly\n")
+    assert "pytest-hoverfly.snapshot=abc" in dockerfile
+
+
+def test_no_snapshots(simulations, monkeypatch):
+    def fail(*args):
+        raise AssertionError("simulations shouldn't be hashed")
+
+    monkeypatch.setattr("pytest_hoverfly.snapshot.snapshot_key", fail)
+
+    assert find_snapshot(_docker(), "spectolabs/hoverfly", simulations) is None
+
+
+def test_local_snapshot(simulations):
+    tag = f"{SNAPSHOT_REPOSITORY}:{snapshot_key('spectolabs/hoverfly', simulations)}"
+
+    assert find_snapshot(_docker(["stale"], local=[tag]), "spectolabs/hoverfly", simulations) == tag
+    (simulations / "simulation.json").write_text("{}")
+    assert find_snapshot(_docker(["stale"], local=[tag]), "spectolabs/hoverfly", simulations) is None
+
+
+def test_pulled_snapshot(simulations):
+    tag = f"registry.example.com/simulations:{snapshot_key('spectolabs/hoverfly', simulations)}"
+    docker = _docker(remote=[tag])
+
+    assert (
+        find_snapshot(docker, "spectolabs/hoverfly", simulations, "registry.example.com/simulations", pull=True) == tag
+    )
+    assert docker.images.pulled == [tag]
+    assert find_snapshot(_docker(), "spectolabs/hoverfly", simulations, pull=True) is None
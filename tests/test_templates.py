@@ -0,0 +1,98 @@
+from __future__ import annotations
+
+import json
+
+import pytest
+
+from pytest_hoverfly.prepare import PreparedSimulation
+from pytest_hoverfly.templates import render, render_simulation
+
+
+def _template():
+    data = {
+        "data": {
+            "pairs": [
+                {
+                    "request": {
+                        "method": [{"matcher": "exact", "value": "GET"}],
+                        "destination": [{"matcher": "exact", "value": "example.com"}],
+                        "path": [{"matcher": "exact", "value": "/items/${item_id}"}],
+                    },
+                    "response": {"status": 200, "body": '{"id": "${item_id}", "price": "$5"}'},
+                }
+            ]
+        }
+    }
+    return json.dumps(data)
+
+
+def test_render():
+    assert render(b'{"a": "${x} and ${y}", "b": "$x"}', {"x": 1, "y": 'say "hi"'}) == (
+        b'{"a": "1 and say \\"hi\\"", "b": "$x"}'
+    )
+    with pytest.raises(ValueError, match=r"no substitution for \$\{y\}"):
+        render(b'"${y}"', {"x": 1})
+
+
+def test_render_simulation(tmp_path):
+    payload = _template().encode()
+    template = PreparedSimulation(tmp_path / "item.json", "digest", (0, 0), payload)
+
+    first = render_simulation(template, {"item_id": 1})
+    assert first.rendered
+    assert json.loads(first.payload)["data"]["pairs"][0]["request"]["path"][0]["value"] == "/items/1"
+    # same content, same digest
+    assert render_simulation(template, {"item_id": 1}).digest == first.digest
+    assert render_simulation(template, {"item_id": 2}).digest != first.digest
+
+    with pytest.raises(ValueError):
+        render_simulation(PreparedSimulation(tmp_path / "item.json", "digest", (0, 0), None), {"item_id": 1})
+
+
+def test_parametrized_template(testdir, tmp_path):
+    simulations = tmp_path / "simulations"
+    simulations.mkdir()
+    (simulations / "item.json").write_text(_template())
+    testdir.makeconftest(
+        """
+import json
+
+
+def pytest_hoverfly_phase_timing(config, nodeid, phase, duration):
+    with open("phases.jsonl", "a") as f:
+        f.write(json.dumps([nodeid.split("::")[-1], phase]) + "\\n")
+    """
+    )
+    testdir.makepyfile(
+        """
+import pytest
+import requests
+from pytest_hoverfly import hoverfly
+
+
+@pytest.mark.parametrize("item_id", [1, 2, 2], ids=["a", "b", "c"])
+@hoverfly('item', substitutions=True, scope='module')
+def test_item(item_id):
+    assert requests.get(f'http://example.com/items/{item_id}').json() == {"id": str(item_id), "price": "$5"}
+
+
+@hoverfly('item', substitutions=lambda params: {"item_id": "x"})
+def test_factory():
+    assert requests.get('http://example.com/items/x').json()["id"] == "x"
+
+
+@hoverfly('item', substitutions={})
+def test_missing():
+    pass
+    """
+    )
+
+    result = testdir.runpytest_subprocess(
+        "--hoverfly-simulation-path", str(simulations), "--hoverfly-backend", "python", "-p", "no:randomly", "-vv"
+    )
+
+    result.assert_outcomes(passed=4, errors=1)
+    result.stdout.fnmatch_lines(["*Can't render*item.json: no substitution for ${item_id}"])
+    phases = [tuple(json.loads(line)) for line in (testdir.tmpdir / "phases.jsonl").readlines()]
+    # the third test renders the same simulation as the second one
+    assert [test for test, phase in phases if phase == "upload"] == ["test_item[a]", "test_item[b]", "test_factory"]